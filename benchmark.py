@@ -0,0 +1,402 @@
+"""Banco de pruebas de rendimiento del pipeline de ``query_nl``.
+
+Genera catálogos sintéticos de varios tamaños con semilla fija, ejecuta una carga
+representativa de consultas y mide cada etapa por separado (interpretación,
+planificación, filtrado, agregación, orden/límite, construcción y serialización de la respuesta),
+con la misma instrumentación que ``query_nl`` expone en ``debug``. El resultado
+se escribe en JSON para poder comparar ejecuciones entre commits:
+
+    python benchmark.py --filas 1000 100000 --salida base.json
+    python benchmark.py --filas 1000 100000 --comparar base.json
+
+Con ``--aproximado`` se compara además, consulta a consulta, la latencia y el
+error del modo aproximado de ``query_nl`` frente al cálculo exacto.
+
+Con ``--formato`` se compara el tamaño y el tiempo de materializar y serializar
+páginas grandes de ``query_page`` en formato de filas y en formato columnar.
+
+En cada tamaño se mide también la latencia de ``upsert`` de una sola fila, seguida
+y justo después de una consulta, que ``--comparar`` vigila como las etapas.
+
+Con ``--carga-mixta SEGUNDOS`` se mide además la latencia de cada herramienta
+bajo una carga concurrente de ``--clientes`` agentes que mezclan llamadas baratas
+(``fields``, ``schema``), consultas sin caché y modificaciones, a través del
+protocolo MCP contra el servidor en memoria.
+"""
+
+import argparse
+import asyncio
+import random
+import datetime
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pydantic_core
+
+import server
+
+# Una consulta por cada tipo admitido, incluidos los ejemplos del README
+CONSULTAS = [
+    "beneficio total por marca en los últimos 6 meses (top 5)",
+    "pvp medio de los portátiles de marca Acme desde 2025-01-01",
+    "productos con cantidad en stock menor que 10",
+    'tablets de la marca Lumina con modelo que contenga "Pro", ordenado desc por beneficio',
+    "ventas totales por tipo este año",
+    "top 5 por beneficio",
+    "los 3 más caros",
+    "stock total por producto",
+    "pvp medio por marca",
+    "beneficio total",
+    "precio mayor que 900",
+    "pvp al menos 500 y stock menor que 50",
+    "smartphones con precio menor que 800",
+    "modelo que contenga pulse",
+    "entre 2025-03-01 y 2025-09-30 beneficio total por tipo",
+    "hasta 2025-06-30 stock total por marca",
+    "pvp medio por tipo últimos 1 meses",
+    "ordenado desc por cantidad en stock",
+    "conteo por modelo",
+]
+
+# Agregaciones que el modo aproximado estima, incluidos los percentiles
+CONSULTAS_APROXIMADAS = [
+    "beneficio total por marca",
+    "pvp medio por tipo",
+    "stock total de los portátiles",
+    "pvp medio de marca Acme últimos 3 meses",
+    "mediana de pvp por marca",
+    "percentil 90 de beneficio",
+    "modelos distintos por marca",
+]
+
+# Consultas que dejan órdenes y agregados que la escritura siguiente mantiene al día
+CONSULTAS_ESCRITURA = ["top 5 por beneficio", "beneficio total por marca", "ordenado desc por pvp"]
+
+# Escrituras de una fila medidas por tamaño
+ACTUALIZACIONES = 200
+
+# Filas por página al comparar los formatos de respuesta
+TAMANOS_PAGINA = [1_000, 10_000]
+
+ETAPAS = ["parse", "plan", "filter", "aggregate", "order_limit", "response", "serialize"]
+
+FILAS_POR_DEFECTO = [1_000, 100_000, 10_000_000]
+
+SEMILLA = 2025
+
+# Peso de cada herramienta en la carga mixta
+MEZCLA_CARGA = {"fields": 30, "schema": 10, "query_nl": 50, "explain": 5, "upsert": 5}
+
+
+def cronometrar(funcion: Callable[[], Any]) -> Tuple[Any, float]:
+    inicio = time.perf_counter()
+    resultado = funcion()
+    return resultado, time.perf_counter() - inicio
+
+
+def ejecutar_por_etapas(catalogo: server.Catalogo, pregunta: str) -> Dict[str, float]:
+    """Ejecuta una consulta sin cachés y devuelve los segundos de cada etapa."""
+    hoy = datetime.date.today()
+    contexto, segundos_parse = cronometrar(
+        lambda: server.copiar_plan(server.parsear_texto_normalizado.__wrapped__(server.normalizar_texto(pregunta), hoy))
+    )
+    traza = server.Traza()
+    respuesta = server.ejecutar_consulta(catalogo, contexto, traza)
+    _, segundos_serializacion = cronometrar(lambda: json.dumps(respuesta, ensure_ascii=False))
+    tiempos = {etapa: traza.etapas.get(etapa, 0.0) for etapa in ETAPAS}
+    tiempos["parse"] = segundos_parse
+    tiempos["serialize"] = segundos_serializacion
+    return tiempos
+
+
+def percentiles(muestras: List[float]) -> Dict[str, float]:
+    valores = np.array(muestras) * 1000.0
+    return {
+        "p50_ms": float(np.percentile(valores, 50)),
+        "p90_ms": float(np.percentile(valores, 90)),
+        "p99_ms": float(np.percentile(valores, 99)),
+        "media_ms": float(valores.mean()),
+    }
+
+
+def argumentos_carga(herramienta: str, azar: random.Random, num_filas: int) -> Dict[str, Any]:
+    if herramienta in ("query_nl", "explain"):
+        return {"pregunta": azar.choice(CONSULTAS)}
+    if herramienta == "upsert":
+        return {"registros": [{"fila": azar.randrange(num_filas), "cantidad_en_stock": azar.randrange(500)}]}
+    return {}
+
+
+async def medir_carga_mixta(catalogo: server.Catalogo, clientes: int, segundos: float) -> Dict[str, Any]:
+    """Latencias por herramienta con ``clientes`` llamadas en vuelo durante ``segundos``."""
+    from fastmcp import Client
+
+    server.DATASET = server.CargaCatalogo(lambda: catalogo)
+    # Sin caché de resultados, cada consulta recorre el catálogo
+    server.CACHE_RESULTADOS = server.CacheResultados(0, 0)
+    num_filas = len(catalogo)
+    latencias: Dict[str, List[float]] = {herramienta: [] for herramienta in MEZCLA_CARGA}
+    errores: Dict[str, int] = {}
+
+    async def agente(cliente: Any, azar: random.Random, fin: float) -> None:
+        while time.perf_counter() < fin:
+            herramienta = azar.choices(list(MEZCLA_CARGA), weights=list(MEZCLA_CARGA.values()))[0]
+            inicio = time.perf_counter()
+            resultado = await cliente.call_tool(herramienta, argumentos_carga(herramienta, azar, num_filas), raise_on_error=False)
+            if resultado.is_error:
+                errores[herramienta] = errores.get(herramienta, 0) + 1
+            else:
+                latencias[herramienta].append(time.perf_counter() - inicio)
+
+    async with Client(server.mcp) as cliente:
+        for pregunta in CONSULTAS:
+            await cliente.call_tool("query_nl", {"pregunta": pregunta})
+        inicio = time.perf_counter()
+        await asyncio.gather(*(agente(cliente, random.Random(SEMILLA + numero), inicio + segundos) for numero in range(clientes)))
+        duracion = time.perf_counter() - inicio
+    return {
+        "clientes": clientes,
+        "llamadas_por_segundo": sum(map(len, latencias.values())) / duracion,
+        "errores": errores,
+        "herramientas": {herramienta: percentiles(muestras) for herramienta, muestras in latencias.items() if muestras},
+    }
+
+
+def medir_escala(
+    num_filas: int,
+    repeticiones: int,
+    carga_mixta: float = 0.0,
+    clientes: int = 0,
+    aproximado: bool = False,
+    formato: bool = False,
+) -> Dict[str, Any]:
+    catalogo, segundos_carga = cronometrar(
+        lambda: server.catalogo_sintetico(num_filas, SEMILLA)
+    )
+    bytes_catalogo = sum(columna.nbytes for columna in catalogo.columnas.values())
+    bytes_indices = catalogo.orden_fechas.nbytes + catalogo.fechas_ordenadas.nbytes
+
+    # Una pasada de calentamiento construye los índices perezosos antes de medir
+    for pregunta in CONSULTAS:
+        ejecutar_por_etapas(catalogo, pregunta)
+
+    por_etapa: Dict[str, List[float]] = {etapa: [] for etapa in ETAPAS}
+    por_consulta: Dict[str, List[float]] = {pregunta: [] for pregunta in CONSULTAS}
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        for pregunta in CONSULTAS:
+            tiempos = ejecutar_por_etapas(catalogo, pregunta)
+            for etapa in ETAPAS:
+                por_etapa[etapa].append(tiempos[etapa])
+            por_consulta[pregunta].append(sum(tiempos.values()))
+    duracion = time.perf_counter() - inicio
+
+    tracemalloc.start()
+    for pregunta in CONSULTAS:
+        ejecutar_por_etapas(catalogo, pregunta)
+    _, pico_consultas = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    resultado = {
+        "filas": num_filas,
+        "carga_s": segundos_carga,
+        "bytes_catalogo": bytes_catalogo,
+        "bytes_por_fila": (bytes_catalogo + bytes_indices) / max(num_filas, 1),
+        "consultas_por_segundo": repeticiones * len(CONSULTAS) / duracion,
+        "memoria_pico_consultas_bytes": pico_consultas,
+        "etapas": {etapa: percentiles(muestras) for etapa, muestras in por_etapa.items()},
+        "consultas": {pregunta: percentiles(muestras) for pregunta, muestras in por_consulta.items()},
+    }
+    if aproximado:
+        resultado["aproximado"] = medir_aproximado(catalogo, repeticiones)
+    if formato:
+        resultado["formato"] = medir_formato(catalogo, repeticiones)
+    if carga_mixta:
+        resultado["carga_mixta"] = asyncio.run(medir_carga_mixta(catalogo, clientes, carga_mixta))
+    # La última: las escrituras pueden reutilizar las columnas del catálogo medido
+    resultado["actualizaciones"] = medir_actualizaciones(catalogo, repeticiones)
+    return resultado
+
+
+def medir_actualizaciones(catalogo: server.Catalogo, repeticiones: int) -> Dict[str, Any]:
+    """Latencia de ``upsert`` de una fila, seguidas y cada una justo después de una consulta.
+
+    Una escritura no debería costar más que las filas que cambia, tampoco la
+    primera tras una consulta que ha dejado órdenes o el rollup construidos.
+    """
+    server.DATASET = server.CargaCatalogo(lambda: catalogo)
+    azar = random.Random(SEMILLA)
+    num_filas = len(catalogo)
+
+    def escribir() -> float:
+        registro = {"fila": azar.randrange(num_filas), azar.choice(server.CAMPOS_ACTUALIZABLES): azar.randrange(1, 500)}
+        return cronometrar(lambda: server.modificar_registros([registro]))[1]
+
+    for pregunta in CONSULTAS_ESCRITURA:
+        server.responder_consulta(pregunta)
+        escribir()
+    seguidas = [escribir() for _ in range(ACTUALIZACIONES)]
+    tras_consulta = []
+    for numero in range(repeticiones * len(CONSULTAS_ESCRITURA)):
+        server.responder_consulta(CONSULTAS_ESCRITURA[numero % len(CONSULTAS_ESCRITURA)])
+        tras_consulta.append(escribir())
+    return {"seguidas": percentiles(seguidas), "tras_consulta": percentiles(tras_consulta)}
+
+
+def medir_aproximado(catalogo: server.Catalogo, repeticiones: int) -> Dict[str, Any]:
+    """Latencia exacta y aproximada de cada consulta y error de las métricas estimadas.
+
+    ``error_relativo`` es el mayor de las métricas; ``dentro_del_margen`` indica si
+    todos los valores exactos caen en el margen o el intervalo de su estimación.
+    """
+    hoy = datetime.date.today()
+    server.sinopsis_vigente(catalogo)
+    resultado = {}
+    for pregunta in CONSULTAS_APROXIMADAS:
+        contexto = server.copiar_plan(server.parsear_texto_normalizado.__wrapped__(server.normalizar_texto(pregunta), hoy))
+        exactas = [cronometrar(lambda: server.ejecutar_consulta(catalogo, contexto)) for _ in range(repeticiones)]
+        aproximadas = [cronometrar(lambda: server.ejecutar_aproximada(catalogo, contexto)) for _ in range(repeticiones)]
+        exacta, aproximada = exactas[0][0]["metrics"], dict(aproximadas[0][0]["metrics"])
+        aproximacion = aproximada.pop("aproximacion")
+        errores, dentro = [], True
+        for alias, valor in aproximada.items():
+            errores.append(abs(valor - exacta[alias]) / abs(exacta[alias]) if exacta[alias] else float(valor != 0))
+            if alias in aproximacion.get("intervalos", {}):
+                bajo, alto = aproximacion["intervalos"][alias]
+                dentro = dentro and bajo - 0.01 <= exacta[alias] <= alto + 0.01
+            elif alias in aproximacion.get("margenes", {}):
+                dentro = dentro and abs(valor - exacta[alias]) <= aproximacion["margenes"][alias] + 0.01
+        resultado[pregunta] = {
+            "metodo": aproximacion["metodo"],
+            "exacto": percentiles([segundos for _, segundos in exactas]),
+            "aproximado": percentiles([segundos for _, segundos in aproximadas]),
+            "error_relativo": max(errores, default=0.0),
+            "dentro_del_margen": dentro,
+        }
+    return resultado
+
+
+def medir_formato(catalogo: server.Catalogo, repeticiones: int) -> Dict[str, Any]:
+    """Bytes y tiempo de materializar y serializar una página de filas completas en cada formato.
+
+    El formato de filas se serializa con el codificador de FastMCP (``pydantic_core``)
+    y el columnar con el de ``query_page`` (``server.codificar_json``).
+    """
+    hoy = datetime.date.today()
+    contexto = server.copiar_plan(server.parsear_texto_normalizado.__wrapped__(server.normalizar_texto("pvp mayor que 0 ordenado desc por pvp"), hoy))
+    orden = server.resultado_ordenado(catalogo, contexto)
+    formatos = {
+        "filas": (catalogo.filas, lambda filas: pydantic_core.to_json(filas).decode()),
+        "columnar": (catalogo.filas_columnar, server.codificar_json),
+    }
+    resultado = {}
+    for tamano in sorted({min(tamano, len(orden)) for tamano in TAMANOS_PAGINA}):
+        pagina = orden[:tamano]
+        por_formato = {}
+        for nombre, (materializar, serializar) in formatos.items():
+            materializaciones, serializaciones = [], []
+            for _ in range(repeticiones):
+                filas, segundos = cronometrar(lambda: materializar(pagina))
+                materializaciones.append(segundos)
+                texto, segundos = cronometrar(lambda: serializar(filas))
+                serializaciones.append(segundos)
+            por_formato[nombre] = {
+                "bytes": len(texto.encode()),
+                "materializar": percentiles(materializaciones),
+                "serializar": percentiles(serializaciones),
+            }
+        resultado[str(tamano)] = por_formato
+    return resultado
+
+
+def commit_actual() -> Optional[str]:
+    try:
+        salida = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return salida.stdout.strip()
+
+
+def comparar(base: Dict[str, Any], actual: Dict[str, Any]) -> List[str]:
+    """Líneas con la razón actual/base de la mediana de cada etapa (>1 es más lento)."""
+    lineas = []
+    escalas_base = {escala["filas"]: escala for escala in base["escalas"]}
+    for escala in actual["escalas"]:
+        anterior = escalas_base.get(escala["filas"])
+        if anterior is None:
+            continue
+        for etapa in ETAPAS:
+            if etapa not in anterior["etapas"]:
+                continue
+            antes = anterior["etapas"][etapa]["p50_ms"]
+            ahora = escala["etapas"][etapa]["p50_ms"]
+            razon = ahora / antes if antes else float("inf") if ahora else 1.0
+            lineas.append(f"{escala['filas']:>10} {etapa:<12} {antes:10.3f} ms -> {ahora:10.3f} ms  x{razon:.2f}")
+        for herramienta, actual in escala.get("carga_mixta", {}).get("herramientas", {}).items():
+            previa = anterior.get("carga_mixta", {}).get("herramientas", {}).get(herramienta)
+            if previa is None:
+                continue
+            antes, ahora = previa["p99_ms"], actual["p99_ms"]
+            razon = ahora / antes if antes else float("inf") if ahora else 1.0
+            lineas.append(f"{escala['filas']:>10} {herramienta + ' p99':<12} {antes:10.3f} ms -> {ahora:10.3f} ms  x{razon:.2f}")
+        for medida, actual in escala.get("actualizaciones", {}).items():
+            previa = anterior.get("actualizaciones", {}).get(medida)
+            if previa is None:
+                continue
+            antes, ahora = previa["p99_ms"], actual["p99_ms"]
+            razon = ahora / antes if antes else float("inf") if ahora else 1.0
+            lineas.append(f"{escala['filas']:>10} {'upsert ' + medida + ' p99':<12} {antes:10.3f} ms -> {ahora:10.3f} ms  x{razon:.2f}")
+    return lineas
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filas", type=int, nargs="+", default=FILAS_POR_DEFECTO, help="tamaños de catálogo a medir")
+    parser.add_argument("--repeticiones", type=int, default=10, help="pasadas de la carga por tamaño")
+    parser.add_argument("--salida", help="fichero JSON de resultados (por defecto, salida estándar)")
+    parser.add_argument("--comparar", help="resultados JSON de una ejecución anterior")
+    parser.add_argument("--procesos", type=int, default=server.PROCESOS_CONSULTA, help="procesos de consulta (CATALOGO_PROCESOS)")
+    parser.add_argument("--carga-mixta", type=float, default=0.0, metavar="SEGUNDOS", help="duración de la carga concurrente por tamaño")
+    parser.add_argument("--clientes", type=int, default=16, help="llamadas en vuelo durante la carga mixta")
+    parser.add_argument("--aproximado", action="store_true", help="compara el modo aproximado con el exacto")
+    parser.add_argument("--formato", action="store_true", help="compara los formatos de filas y columnar en páginas grandes")
+    args = parser.parse_args()
+    server.PROCESOS_CONSULTA = args.procesos
+
+    resultado = {
+        "commit": commit_actual(),
+        "fecha": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "semilla": SEMILLA,
+        "procesos": args.procesos,
+        "escalas": [
+            medir_escala(num_filas, args.repeticiones, args.carga_mixta, args.clientes, args.aproximado, args.formato)
+            for num_filas in args.filas
+        ],
+    }
+    # ru_maxrss está en KiB en Linux y en bytes en macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    resultado["memoria_pico_proceso_bytes"] = maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    texto = json.dumps(resultado, ensure_ascii=False, indent=2)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as fichero:
+            fichero.write(texto + "\n")
+    else:
+        print(texto)
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as fichero:
+            base = json.load(fichero)
+        print("\n".join(comparar(base, resultado)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,46 @@
+import array
+import asyncio
+import base64
+import bisect
+import contextlib
+import copy
 import datetime
-import random
+import functools
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import math
+import operator
+import os
 import statistics
+import threading
+import time
 import unicodedata
 import re
-from typing import Dict, List, Optional, Tuple, Any
+import secrets
+import shutil
+import sys
+import weakref
+from collections import OrderedDict
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypedDict, Any
 
+import numpy as np
 from fastmcp import FastMCP
+from fastmcp.exceptions import ToolError
+from fastmcp.tools.tool import ToolResult
+from mcp.types import TextContent
+
+try:
+    import orjson
+except ImportError:  # sin orjson, el formato columnar se codifica con json
+    orjson = None
+
+# Solo se importan al usarlos: leer CSV o SQLite, la ejecución en paralelo y los hilos de las consultas
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from multiprocessing import shared_memory
 
 BRANDS = [
     "Acme",
@@ -135,42 +170,1227 @@ STOP_WORDS_FOR_VALUES = [
 ]
 
 
-def generar_datos() -> List[Dict[str, Any]]:
-    rng = random.Random(2025)
-    today = datetime.date.today()
-    registros: List[Dict[str, Any]] = []
-    for i in range(50):
-        template = rng.choice(PRODUCT_TEMPLATES)
-        producto = template["producto"]
-        tipo = rng.choice(template["tipos"])
-        modelo_base = rng.choice(template["modelos"])
-        modelo = f"{modelo_base} {rng.choice(['A', 'B', 'C', 'D', 'E'])}{rng.randint(1, 9)}{rng.choice(['', ' Pro', ' Plus', ' Max'])}".strip()
-        marca = rng.choice(BRANDS)
-        base_precio = template["base_precio"]
-        compra = round(rng.uniform(base_precio * 0.55, base_precio * 0.85), 2)
-        pvp = round(rng.uniform(base_precio * 0.9, base_precio * 1.2), 2)
-        if pvp < compra:
-            pvp = round(compra + rng.uniform(10, 120), 2)
-        beneficio = round(pvp - compra, 2)
-        fecha_compra = today - datetime.timedelta(days=rng.randint(0, 540))
-        cantidad_en_stock = rng.randint(0, 200)
-        registros.append(
-            {
-                "producto": producto,
-                "marca": marca,
-                "tipo": tipo,
-                "modelo": modelo,
-                "pvp": float(f"{pvp:.2f}"),
-                "compra": float(f"{compra:.2f}"),
-                "beneficio": float(f"{beneficio:.2f}"),
-                "fechacompra": fecha_compra.isoformat(),
-                "cantidad_en_stock": cantidad_en_stock,
-            }
-        )
-    return registros
+# Tamaño y semilla del catálogo sintético que se sirve sin ``CATALOGO_FUENTE``
+FILAS_SINTETICAS = 50
+
+SEMILLA_SINTETICA = 2025
+
+# Filas de cada bloque del generador sintético. Es fijo porque cada bloque tiene su
+# propia semilla: así los datos no dependen de cuántos procesos los generen
+TAMANO_BLOQUE_SINTETICO = 1 << 20
+
+LETRAS_MODELO = ["A", "B", "C", "D", "E"]
+
+SUFIJOS_MODELO = ["", " Pro", " Plus", " Max"]
+
+
+def generar_datos(num_filas: int = FILAS_SINTETICAS, semilla: int = SEMILLA_SINTETICA) -> List[Dict[str, Any]]:
+    return list(iterar_datos(num_filas, semilla))
+
+
+def iterar_datos(num_filas: int = FILAS_SINTETICAS, semilla: int = SEMILLA_SINTETICA) -> Iterator[Dict[str, Any]]:
+    """Genera los registros sintéticos por bloques y los entrega de uno en uno."""
+    categorias, _ = tablas_sinteticas()
+    for columnas in bloques_sinteticos(num_filas, semilla):
+        for desde in range(0, len(columnas["pvp"]), TAMANO_BLOQUE):
+            yield from decodificar_filas(columnas, categorias, np.arange(desde, min(desde + TAMANO_BLOQUE, len(columnas["pvp"]))))
+
+
+@functools.lru_cache(maxsize=1)
+def tablas_sinteticas() -> Tuple[Dict[str, List[str]], Dict[str, np.ndarray]]:
+    """Categorías del catálogo sintético y tablas para sortear sus códigos por plantilla.
+
+    ``tipos[p, i]`` es el código del tipo ``i`` de la plantilla ``p`` y
+    ``modelos[p, i]`` el de su modelo ``i``, numerados por base, letra, dígito y
+    sufijo. Un valor repetido en dos plantillas tiene un solo código.
+    """
+    categorias: Dict[str, List[str]] = {"producto": [], "marca": list(BRANDS), "tipo": [], "modelo": []}
+    codigos: Dict[str, Dict[str, int]] = {"tipo": {}, "modelo": {}}
+
+    def codificar(campo: str, valor: str) -> int:
+        if valor not in codigos[campo]:
+            codigos[campo][valor] = len(categorias[campo])
+            categorias[campo].append(valor)
+        return codigos[campo][valor]
+
+    tipos, modelos = [], []
+    for plantilla in PRODUCT_TEMPLATES:
+        categorias["producto"].append(plantilla["producto"])
+        tipos.append([codificar("tipo", tipo) for tipo in plantilla["tipos"]])
+        modelos.append([
+            codificar("modelo", f"{base} {letra}{digito}{sufijo}")
+            for base in plantilla["modelos"]
+            for letra in LETRAS_MODELO
+            for digito in range(1, 10)
+            for sufijo in SUFIJOS_MODELO
+        ])
+
+    def tabla(listas: List[List[int]]) -> np.ndarray:
+        resultado = np.zeros((len(listas), max(map(len, listas))), dtype=np.int32)
+        for posicion, lista in enumerate(listas):
+            resultado[posicion, :len(lista)] = lista
+        return resultado
+
+    return categorias, {
+        "tipos": tabla(tipos),
+        "num_tipos": np.array([len(lista) for lista in tipos]),
+        "modelos": tabla(modelos),
+        "num_modelos": np.array([len(lista) for lista in modelos]),
+        "base_precio": np.array([plantilla["base_precio"] for plantilla in PRODUCT_TEMPLATES], dtype=np.float64),
+    }
+
+
+def generar_bloque(semilla: int, bloque: int, num_filas: int, hoy: datetime.date) -> Dict[str, np.ndarray]:
+    """Columnas de las ``num_filas`` filas del bloque número ``bloque`` del catálogo sintético.
+
+    Cada bloque sortea con su propio generador, derivado de ``semilla`` y del
+    número de bloque: da igual en qué orden o en qué proceso se genere. Los
+    importes salen en céntimos y las fechas como ordinales, como en ``Catalogo``.
+    """
+    _, tablas = tablas_sinteticas()
+    rng = np.random.default_rng(np.random.SeedSequence(semilla, spawn_key=(bloque,)))
+    plantillas = rng.integers(0, len(PRODUCT_TEMPLATES), num_filas)
+    tipos = (rng.random(num_filas) * tablas["num_tipos"][plantillas]).astype(np.intp)
+    modelos = (rng.random(num_filas) * tablas["num_modelos"][plantillas]).astype(np.intp)
+    marcas = rng.integers(0, len(BRANDS), num_filas, dtype=np.int32)
+    base_precio = tablas["base_precio"][plantillas]
+    compra = np.rint(rng.uniform(base_precio * 0.55, base_precio * 0.85) * ESCALA_IMPORTES)
+    pvp = np.rint(rng.uniform(base_precio * 0.9, base_precio * 1.2) * ESCALA_IMPORTES)
+    baratos = pvp < compra
+    pvp[baratos] = compra[baratos] + np.rint(rng.uniform(10, 120, np.count_nonzero(baratos)) * ESCALA_IMPORTES)
+    dias = rng.integers(0, 541, num_filas)
+    stock = rng.integers(0, 201, num_filas, dtype=np.int32)
+    return {
+        "producto": plantillas.astype(np.int32),
+        "marca": marcas,
+        "tipo": tablas["tipos"][plantillas, tipos],
+        "modelo": tablas["modelos"][plantillas, modelos],
+        "pvp": pvp.astype(np.int32),
+        "compra": compra.astype(np.int32),
+        "beneficio": (pvp - compra).astype(np.int32),
+        "fechacompra": (hoy.toordinal() - dias).astype(np.int32),
+        "cantidad_en_stock": stock,
+    }
+
+
+def bloques_sinteticos(
+    num_filas: int,
+    semilla: int,
+    hoy: Optional[datetime.date] = None,
+    procesos: int = 1,
+) -> Iterator[Dict[str, np.ndarray]]:
+    """Columnas del catálogo sintético de ``TAMANO_BLOQUE_SINTETICO`` en ``TAMANO_BLOQUE_SINTETICO`` filas.
+
+    Con ``procesos`` > 1 los bloques se generan en paralelo y se entregan en
+    orden; los datos son los mismos que en un solo proceso.
+    """
+    hoy = hoy or datetime.date.today()
+    tamanos = [min(TAMANO_BLOQUE_SINTETICO, num_filas - desde) for desde in range(0, num_filas, TAMANO_BLOQUE_SINTETICO)]
+    if procesos <= 1 or len(tamanos) <= 1:
+        for bloque, tamano in enumerate(tamanos):
+            yield generar_bloque(semilla, bloque, tamano, hoy)
+        return
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    metodo = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(procesos, mp_context=multiprocessing.get_context(metodo)) as ejecutor:
+        yield from ejecutor.map(generar_bloque, itertools.repeat(semilla), range(len(tamanos)), tamanos, itertools.repeat(hoy))
+
+
+def catalogo_sintetico(
+    num_filas: int = FILAS_SINTETICAS,
+    semilla: int = SEMILLA_SINTETICA,
+    hoy: Optional[datetime.date] = None,
+    procesos: int = 1,
+) -> "Catalogo":
+    """Catálogo sintético construido directamente sobre columnas, sin pasar por registros."""
+    categorias, _ = tablas_sinteticas()
+    columnas = {campo: np.empty(num_filas, dtype=np.int32) for campo in CAMPOS}
+    desde = 0
+    for bloque in bloques_sinteticos(num_filas, semilla, hoy, procesos):
+        hasta = desde + len(bloque["pvp"])
+        for campo in CAMPOS:
+            columnas[campo][desde:hasta] = bloque[campo]
+        desde = hasta
+    return Catalogo(columnas, {campo: list(valores) for campo, valores in categorias.items()})
+
+
+def escribir_sintetico(ruta: str, num_filas: int, semilla: int = SEMILLA_SINTETICA, procesos: int = 1) -> None:
+    """Genera el catálogo sintético directamente en disco, bloque a bloque.
+
+    Un directorio recibe el formato columnar: las columnas se escriben en sus
+    ``.npy`` según se generan y después se ordena la columna de fechas para el
+    índice. Un ``.csv`` o un ``.jsonl`` se escriben registro a registro.
+    """
+    categorias, _ = tablas_sinteticas()
+    bloques = bloques_sinteticos(num_filas, semilla, procesos=procesos)
+    extension = os.path.splitext(ruta)[1].lower()
+    if extension in (".csv", ".jsonl", ".ndjson"):
+        with open(ruta, "w", newline="", encoding="utf-8") as fichero:
+            if extension == ".csv":
+                import csv
+
+                escritor = csv.DictWriter(fichero, fieldnames=CAMPOS)
+                escritor.writeheader()
+            for columnas in bloques:
+                for desde in range(0, len(columnas["pvp"]), TAMANO_BLOQUE):
+                    registros = decodificar_filas(columnas, categorias, np.arange(desde, min(desde + TAMANO_BLOQUE, len(columnas["pvp"]))))
+                    if extension == ".csv":
+                        escritor.writerows(registros)
+                    else:
+                        fichero.writelines(json.dumps(registro, ensure_ascii=False) + "\n" for registro in registros)
+        return
+    os.makedirs(ruta, exist_ok=True)
+    columnas = {
+        campo: np.lib.format.open_memmap(os.path.join(ruta, f"{campo}.npy"), mode="w+", dtype=np.int32, shape=(num_filas,))
+        for campo in CAMPOS
+    }
+    desde = 0
+    for bloque in bloques:
+        hasta = desde + len(bloque["pvp"])
+        for campo in CAMPOS:
+            columnas[campo][desde:hasta] = bloque[campo]
+        desde = hasta
+    for columna in columnas.values():
+        columna.flush()
+    orden_fechas = np.argsort(columnas["fechacompra"], kind="stable").astype(tipo_posiciones(num_filas))
+    np.save(os.path.join(ruta, "orden_fechas.npy"), orden_fechas)
+    np.save(os.path.join(ruta, "fechas_ordenadas.npy"), columnas["fechacompra"][orden_fechas])
+    escribir_meta_columnar(ruta, num_filas, categorias, {"sintetico": num_filas, "semilla": semilla, "fecha": datetime.date.today().isoformat()})
+
+
+CAMPOS = (
+    "producto",
+    "marca",
+    "tipo",
+    "modelo",
+    "pvp",
+    "compra",
+    "beneficio",
+    "fechacompra",
+    "cantidad_en_stock",
+)
+
+CAMPOS_TEXTO = ("producto", "marca", "tipo", "modelo")
+
+CAMPOS_DECIMALES = ("pvp", "compra", "beneficio")
+
+# Céntimos por euro: los importes se guardan como enteros en céntimos
+ESCALA_IMPORTES = 100
+
+FORMATO_COLUMNAR = "catalogo-columnar"
+
+VERSION_FORMATO_COLUMNAR = 2
+
+# La versión 1 guardaba los importes en float64; se sigue leyendo
+VERSIONES_COLUMNARES_LEIDAS = (1, VERSION_FORMATO_COLUMNAR)
+
+TABLA_SQLITE = "catalogo"
+
+# Máximo de filas devueltas por consulta
+LIMITE_FILAS = 50
+
+# Filas por bloque cuando el filtrado puede terminar antes de recorrer todo el catálogo
+TAMANO_BLOQUE = 65536
+
+# Filas por fragmento en la agregación; fijo para que el resultado no dependa del número de procesos
+TAMANO_FRAGMENTO = 1 << 18
+
+# Por encima de esta fracción de filas, un rango de fechas se filtra sobre la columna completa
+FRACCION_INDICE_FECHAS = 0.125
+
+
+# Cada catálogo, y cada modificación de uno, recibe una versión distinta
+VERSIONES_CATALOGO = itertools.count(1)
+
+# Campos de una fila existente que se pueden cambiar sin recargar el catálogo
+CAMPOS_ACTUALIZABLES = ("cantidad_en_stock", "pvp", "compra")
+
+# Columna booleana que marca las filas borradas; se crea con el primer borrado
+COLUMNA_BORRADA = "borrada"
+
+# Filas añadidas o modificadas que se toleran fuera de los índices antes de reconstruirlos
+MINIMO_PENDIENTES = 1024
+
+# Columnas que usaron instantáneas anteriores y se guardan para escribir en ellas (véase ``Repuesto``)
+REPUESTOS_POR_COLUMNA = 2
+
+# Campos del rollup por categorías y día (véase ``Rollup``)
+CAMPOS_ROLLUP = ("producto", "marca", "tipo")
+
+# Con más celdas que esta fracción de las filas, el rollup no ahorra recorrido y no se usa
+FRACCION_MAXIMA_ROLLUP = 0.25
+
+# Filas de la muestra estratificada del modo aproximado (véase ``Sinopsis``) y mínimo por estrato
+MUESTRA_APROXIMADA = int(os.environ.get("CATALOGO_MUESTRA_APROXIMADA", "65536") or 0)
+MINIMO_ESTRATO = 32
+
+# Bits del registro de los HyperLogLog: 2**12 registros, con un error típico del 1,6 %
+BITS_HLL = 12
+
+# Valor z de los intervalos de confianza del 95 % del modo aproximado
+Z_CONFIANZA = 1.96
+
+# Los HyperLogLog no restan las bajas: pasada esta fracción de filas borradas, la sinopsis se rehace
+FRACCION_BAJAS_SINOPSIS = 0.1
+
+
+@functools.lru_cache(maxsize=4096)
+def fecha_iso(ordinal: int) -> str:
+    return datetime.date.fromordinal(ordinal).isoformat()
+
+
+def trigramas(texto: str) -> set:
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+
+class IndiceTrigramas:
+    """Índice invertido de trigramas sobre los valores normalizados de una columna de texto.
+
+    Las posiciones del índice son los códigos de categoría de la columna, de modo
+    que una búsqueda devuelve directamente qué categorías contienen la subcadena.
+    """
+
+    def __init__(self, textos: Sequence[str]) -> None:
+        self.textos: List[str] = []
+        self._postings: Dict[str, List[int]] = {}
+        for texto in textos:
+            self.agregar(texto)
+
+    def agregar(self, texto: str) -> None:
+        codigo = len(self.textos)
+        self.textos.append(texto)
+        for trigrama in trigramas(texto):
+            self._postings.setdefault(trigrama, []).append(codigo)
+
+    def copia(self) -> "IndiceTrigramas":
+        copia = IndiceTrigramas([])
+        copia.textos = list(self.textos)
+        copia._postings = {trigrama: list(codigos) for trigrama, codigos in self._postings.items()}
+        return copia
+
+    def buscar(self, subcadena: str) -> np.ndarray:
+        """Marca las categorías cuyo texto normalizado contiene ``subcadena`` (ya normalizada)."""
+        coincidencias = np.zeros(len(self.textos), dtype=bool)
+        if len(subcadena) < 3:
+            candidatos: Any = range(len(self.textos))
+        else:
+            listas = []
+            for trigrama in trigramas(subcadena):
+                lista = self._postings.get(trigrama)
+                if lista is None:
+                    return coincidencias
+                listas.append(lista)
+            listas.sort(key=len)
+            candidatos = set(listas[0])
+            for lista in listas[1:]:
+                candidatos.intersection_update(lista)
+        for codigo in candidatos:
+            if subcadena in self.textos[codigo]:
+                coincidencias[codigo] = True
+        return coincidencias
+
+
+def decodificar_dato(campo: str, dato: Any, escala: int = 1) -> Any:
+    """Convierte un dato de una columna no categórica al valor Python original."""
+    if campo == "fechacompra":
+        return fecha_iso(int(dato))
+    if campo == "cantidad_en_stock":
+        return int(dato)
+    return float(dato) / escala
+
+
+def decodificar_filas(columnas: Dict[str, np.ndarray], categorias: Dict[str, List[str]], indices: Sequence[int]) -> List[Dict[str, Any]]:
+    """Materializa como diccionarios las filas ``indices`` de unas columnas con el formato de ``Catalogo``."""
+    indices = np.asarray(indices, dtype=np.intp)
+    valores: List[List[Any]] = []
+    for campo in CAMPOS:
+        columna = columnas[campo][indices]
+        escala = escala_columna(campo, columnas[campo])
+        if campo in categorias:
+            valores.append([categorias[campo][codigo] for codigo in columna.tolist()])
+        elif campo == "fechacompra":
+            valores.append([fecha_iso(ordinal) for ordinal in columna.tolist()])
+        elif escala != 1:
+            valores.append((columna / escala).tolist())
+        else:
+            valores.append(columna.tolist())
+    return [dict(zip(CAMPOS, fila)) for fila in zip(*valores)]
+
+
+def codificar_columnar(columnas: Dict[str, np.ndarray], categorias: Dict[str, List[str]], indices: Sequence[int]) -> Dict[str, Any]:
+    """Las filas ``indices`` en el formato columnar de las respuestas (véase ``filas_a_columnar``), sin pasar por diccionarios."""
+    indices = np.asarray(indices, dtype=np.intp)
+    resultado: Dict[str, Any] = {"columns": list(CAMPOS), "values": [], "dictionaries": {}, "scales": {}, "dates": []}
+    for campo in CAMPOS:
+        columna = columnas[campo][indices]
+        escala = escala_columna(campo, columnas[campo])
+        if campo in categorias:
+            # Diccionario local: solo las categorías que aparecen en estas filas
+            codigos, posiciones = np.unique(columna, return_inverse=True)
+            resultado["dictionaries"][campo] = [categorias[campo][codigo] for codigo in codigos.tolist()]
+            resultado["values"].append(posiciones.ravel().tolist())
+        elif campo == "fechacompra":
+            resultado["dates"].append(campo)
+            resultado["values"].append((columna.astype(np.int64) - EPOCA_ORDINAL).tolist())
+        else:
+            if escala != 1:
+                resultado["scales"][campo] = escala
+            resultado["values"].append(columna.tolist())
+    return resultado
+
+
+def filas_a_columnar(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Pasa ``rows`` al formato columnar: cada columna una vez y sus valores en listas paralelas.
+
+    Las columnas de texto van codificadas con diccionario (``dictionaries``: los
+    valores son posiciones en él), los importes exactos al céntimo como enteros
+    (``scales``: unidades por euro) y las fechas (``dates``) como días desde el
+    1970-01-01.
+    """
+    columnas = list(rows[0]) if rows else []
+    resultado: Dict[str, Any] = {"columns": columnas, "values": [], "dictionaries": {}, "scales": {}, "dates": []}
+    for campo in columnas:
+        valores = [fila.get(campo) for fila in rows]
+        if all(isinstance(valor, str) for valor in valores):
+            if campo == "fechacompra":
+                resultado["dates"].append(campo)
+                valores = [ordinal_fecha(valor) - EPOCA_ORDINAL for valor in valores]
+            else:
+                posiciones: Dict[str, int] = {}
+                valores = [posiciones.setdefault(valor, len(posiciones)) for valor in valores]
+                resultado["dictionaries"][campo] = list(posiciones)
+        elif campo in CAMPOS_DECIMALES and all(isinstance(valor, float) for valor in valores):
+            centimos = [round(valor * ESCALA_IMPORTES) for valor in valores]
+            if all(centimo / ESCALA_IMPORTES == valor for centimo, valor in zip(centimos, valores)):
+                resultado["scales"][campo] = ESCALA_IMPORTES
+                valores = centimos
+        resultado["values"].append(valores)
+    return resultado
+
+
+def escala_columna(campo: str, columna: np.ndarray) -> int:
+    """Unidades por euro de una columna: ``ESCALA_IMPORTES`` si guarda céntimos enteros, si no 1."""
+    return ESCALA_IMPORTES if campo in CAMPOS_DECIMALES and columna.dtype.kind == "i" else 1
+
+
+def columna_importes(valores: np.ndarray) -> np.ndarray:
+    """Columna de importes en céntimos enteros; si alguno no es un céntimo exacto, los euros en ``float64``."""
+    centimos = np.rint(valores * ESCALA_IMPORTES)
+    if not np.array_equal(centimos / ESCALA_IMPORTES, valores):
+        return valores
+    if len(centimos) and np.abs(centimos).max() >= np.iinfo(np.int32).max:
+        return centimos.astype(np.int64)
+    return centimos.astype(np.int32)
+
+
+def tipo_posiciones(num_filas: int) -> Any:
+    """Tipo entero más pequeño para guardar posiciones de filas de un catálogo de ``num_filas``."""
+    return np.int32 if num_filas < np.iinfo(np.int32).max else np.intp
+
+
+@functools.lru_cache(maxsize=65536)
+def ordinal_fecha(iso: str) -> int:
+    return datetime.date.fromisoformat(iso).toordinal()
+
+
+def calcular_beneficio(pvp: float, compra: float) -> float:
+    return round(pvp - compra, 2)
+
+
+def sin_lecturas(desde: int, hasta: int, leidas: Optional[frozenset]) -> bool:
+    """Si ninguna lectura en curso usa las instantáneas ``desde``-``hasta``; sin ``leidas``, no se sabe."""
+    return leidas is not None and not any(desde <= generacion <= hasta for generacion in leidas)
+
+
+class Repuesto:
+    """Columna que usaron las instantáneas ``desde``-``hasta`` y filas que le faltan respecto de la vigente."""
+
+    __slots__ = ("reserva", "vista", "pendientes", "desde", "hasta")
+
+    def __init__(self, reserva: np.ndarray, vista: np.ndarray, pendientes: set, desde: int, hasta: int) -> None:
+        self.reserva = reserva
+        self.vista = vista
+        self.pendientes = pendientes
+        self.desde = desde
+        self.hasta = hasta
+
+
+class Catalogo:
+    """Tabla columnar del catálogo.
+
+    Los importes se guardan en céntimos enteros (``float64`` en euros si alguno
+    no es un céntimo exacto), el stock en ``int32``, ``fechacompra`` como ordinal
+    de fecha y los campos de texto codificados por diccionario (códigos ``int32``
+    más la lista de categorías, compartida por todas las filas). Las filas solo
+    se convierten en diccionarios al responder (véase ``filas``).
+    """
+
+    def __init__(
+        self,
+        columnas: Dict[str, np.ndarray],
+        categorias: Dict[str, List[str]],
+        indice_fechas: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    ) -> None:
+        self.columnas = columnas
+        self.categorias = categorias
+        self.indices_texto = {
+            campo: IndiceTrigramas([normalizar_texto(valor) for valor in valores])
+            for campo, valores in categorias.items()
+        }
+        self._num_filas = len(columnas["pvp"])
+        self.version = next(VERSIONES_CATALOGO)
+        if indice_fechas is None:
+            orden_fechas = np.argsort(columnas["fechacompra"], kind="stable").astype(tipo_posiciones(self._num_filas))
+            indice_fechas = (orden_fechas, columnas["fechacompra"][orden_fechas])
+        self.orden_fechas, self.fechas_ordenadas = indice_fechas
+        self._ordenes: Dict[Tuple[str, bool], np.ndarray] = {}
+        # Versión de cada columna y de la lista de filas, para invalidar solo lo afectado
+        self.versiones = dict.fromkeys([*columnas, "filas"], self.version)
+        self.num_borradas = 0
+        # Filas añadidas que aún no están en el índice de fechas
+        self.fechas_pendientes: List[int] = []
+        # Filas cuyo valor ha cambiado desde que se calculó cada orden guardado: una lista
+        # que comparten las instantáneas y cuántas de sus filas son de esta
+        self._sucias: Dict[Tuple[str, bool], Tuple[List[int], int]] = {}
+        self._reservas: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        # Columnas de repuesto para las siguientes escrituras (véase ``_columna_propia``), la
+        # generación desde la que se usa cada columna y las que se leían al copiar el catálogo
+        self._repuestos: Dict[str, List[Repuesto]] = {}
+        self._desde: Dict[str, int] = {}
+        self._leidas: Optional[frozenset] = None
+        self._codigos_categoria: Dict[str, Dict[str, int]] = {}
+        # Rollup por categorías y día; se construye con la primera consulta que lo usa
+        self.rollup: Optional["Rollup"] = None
+        self.rollup_evaluado = False
+        # Alguna consulta podría usar el rollup; lo comparten todas las instantáneas del catálogo
+        self.rollup_pedido = threading.Event()
+        # Muestra y sketches del modo aproximado; se construyen con la primera consulta aproximada
+        self.sinopsis: Optional["Sinopsis"] = None
+        # Otra instantánea ha pasado a ser la vigente (véase ``CargaCatalogo.escritura``)
+        self.sustituida = False
+        # Instantáneas anteriores a esta; cada columna de repuesto guarda entre cuáles se usó
+        self.generacion = 0
+        # Columnas en memoria compartida para la ejecución en paralelo (véase ``columnas_compartidas``)
+        self.compartidas: Optional["ColumnasCompartidas"] = None
+        # Muestra de filas del optimizador y versión de las filas con que se tomó
+        self._muestra: Optional[Tuple[int, np.ndarray]] = None
+        # Columnas compartidas con la instantánea de la que sale esta copia y filas que tenía
+        self._compartidas: set = set()
+        self._filas_compartidas = 0
+        self._indices_propios = set(categorias)
+
+    @classmethod
+    def desde_registros(cls, registros: Iterable[Dict[str, Any]]) -> "Catalogo":
+        constructor = ConstructorCatalogo()
+        for registro in registros:
+            constructor.agregar(registro)
+        return constructor.construir()
+
+    def __len__(self) -> int:
+        return self._num_filas
+
+    def instantanea(self, leidas: Optional[Iterable[int]] = None) -> "Catalogo":
+        """Copia del catálogo que se puede modificar sin alterar este.
+
+        Las columnas no se copian: se comparten hasta que la copia escribe en una
+        fila que ya existía (``_escribible``), y las filas nuevas van a la parte
+        libre de las reservas, que este catálogo no ve. Las consultas en curso
+        siguen leyendo así una versión fija mientras otra petición la modifica.
+
+        Las columnas de repuesto pasan a la copia, que puede escribir en las que
+        no usa ninguna de las generaciones ``leidas`` (en ninguna si no se indican).
+        """
+        copia = copy.copy(self)
+        copia.columnas = dict(self.columnas)
+        copia.categorias = {campo: list(valores) for campo, valores in self.categorias.items()}
+        copia.indices_texto = dict(self.indices_texto)
+        copia.versiones = dict(self.versiones)
+        copia._ordenes = dict(self._ordenes)
+        copia._sucias = dict(self._sucias)
+        copia._reservas = dict(self._reservas)
+        copia._repuestos = self._repuestos
+        self._repuestos = {}
+        copia._desde = dict(self._desde)
+        copia._leidas = None if leidas is None else frozenset(leidas)
+        copia._codigos_categoria = {}
+        copia.generacion = self.generacion + 1
+        # Si una consulta está construyendo el rollup, la copia espera a que termine y se lo lleva
+        with CANDADO_ROLLUP:
+            copia.rollup_evaluado = self.rollup_evaluado
+            copia.rollup = None if self.rollup is None else self.rollup.copia(copia.generacion, copia._leidas)
+        with CANDADO_SINOPSIS:
+            copia.sinopsis = None if self.sinopsis is None else self.sinopsis.copia()
+        copia._compartidas = set(self.columnas)
+        copia._filas_compartidas = self._num_filas
+        copia._indices_propios = set()
+        return copia
+
+    def nueva_version(self, campos: Optional[Iterable[str]] = None) -> None:
+        """Registra una modificación de los datos; las respuestas cacheadas dejan de servirse.
+
+        Con ``campos`` solo cambian de versión esas columnas; sin ellos, todo el catálogo.
+        """
+        self.version = next(VERSIONES_CATALOGO)
+        for campo in self.versiones if campos is None else campos:
+            self.versiones[campo] = self.version
+
+    def firma(self, campos: Iterable[str]) -> List[int]:
+        """Versiones de las filas y de ``campos``: cambia cuando cambia algo de lo que dependen."""
+        return [self.versiones["filas"]] + [self.versiones.get(campo, 0) for campo in campos]
+
+    def filas_en_rango(self, inicio: Optional[int], fin: Optional[int], forzar: bool = False) -> Optional[np.ndarray]:
+        """Índices (ordenados) de las filas con ``fechacompra`` en [inicio, fin].
+
+        Los extremos son ordinales de fecha. Devuelve ``None`` si no hay rango o, salvo
+        con ``forzar``, si el rango es tan amplio que sale más barato filtrar la columna
+        completa.
+        """
+        limites = self.posiciones_rango(inicio, fin) if forzar else self.limites_rango(inicio, fin)
+        if limites is None:
+            return None
+        candidatos = self.orden_fechas[limites[0]:limites[1]]
+        if self.fechas_pendientes:
+            pendientes = np.array(self.fechas_pendientes, dtype=np.intp)
+            fechas = self.columnas["fechacompra"][pendientes]
+            dentro = np.ones(len(pendientes), dtype=bool)
+            if inicio:
+                dentro &= fechas >= inicio
+            if fin:
+                dentro &= fechas <= fin
+            candidatos = np.concatenate([candidatos, pendientes[dentro]])
+        return np.sort(candidatos)
+
+    def posiciones_rango(self, inicio: Optional[int], fin: Optional[int]) -> Optional[Tuple[int, int]]:
+        """Posiciones del rango [inicio, fin] en el índice de fechas, o ``None`` si no hay rango."""
+        if not inicio and not fin:
+            return None
+        # Con un escalar del mismo tipo que el índice, searchsorted no convierte el índice entero
+        tipo = self.fechas_ordenadas.dtype.type
+        desde = np.searchsorted(self.fechas_ordenadas, tipo(inicio), side="left") if inicio else 0
+        hasta = np.searchsorted(self.fechas_ordenadas, tipo(fin), side="right") if fin else len(self.fechas_ordenadas)
+        return int(desde), int(hasta)
+
+    def limites_rango(self, inicio: Optional[int], fin: Optional[int]) -> Optional[Tuple[int, int]]:
+        """Posiciones del rango [inicio, fin] en el índice de fechas, o ``None`` si no compensa usarlo."""
+        limites = self.posiciones_rango(inicio, fin)
+        if limites is None or limites[1] - limites[0] > self._num_filas * FRACCION_INDICE_FECHAS:
+            return None
+        return limites
+
+    def muestra(self) -> np.ndarray:
+        """Hasta ``MUESTRA_ESTADISTICAS`` filas vivas repartidas por todo el catálogo.
+
+        El optimizador estima sobre ellas la selectividad de cada predicado.
+        """
+        if self._muestra is None or self._muestra[0] != self.versiones["filas"]:
+            cantidad = min(self._num_filas, MUESTRA_ESTADISTICAS)
+            posiciones = np.unique(np.linspace(0, self._num_filas - 1, cantidad).astype(np.intp))
+            if self.num_borradas:
+                posiciones = posiciones[~self.columnas[COLUMNA_BORRADA][posiciones]]
+            self._muestra = (self.versiones["filas"], posiciones)
+        return self._muestra[1]
+
+    def rangos_categorias(self, campo: str) -> np.ndarray:
+        """Posición de cada categoría de ``campo`` en el orden alfabético de las categorías."""
+        categorias = self.categorias[campo]
+        rangos = np.empty(len(categorias), dtype=np.int64)
+        rangos[sorted(range(len(categorias)), key=categorias.__getitem__)] = np.arange(len(categorias))
+        return rangos
+
+    def claves_orden(self, campo: str, indices: Optional[np.ndarray] = None) -> np.ndarray:
+        """Claves numéricas que ordenan igual que los valores originales (de ``indices`` si se indican)."""
+        columna = self.columnas[campo] if indices is None else self.columnas[campo][indices]
+        if campo in self.categorias:
+            return self.rangos_categorias(campo)[columna]
+        return columna
+
+    def orden_columna(self, campo: str, descendente: bool) -> np.ndarray:
+        """Permutación estable de todas las filas según ``campo``; se calcula una vez y se guarda."""
+        clave = (campo, descendente)
+        # Varias consultas pueden calcularlo a la vez: cada una usa el suyo
+        orden = None if len(self.filas_sucias(clave)) else self._ordenes.get(clave)
+        if orden is None:
+            claves = self.claves_orden(campo)
+            orden = np.argsort(-claves if descendente else claves, kind="stable").astype(tipo_posiciones(self._num_filas))
+            self._sucias.pop(clave, None)
+            self._ordenes[clave] = orden
+        return orden
+
+    def mejores_filas(self, campo: str, descendente: bool, cantidad: int) -> np.ndarray:
+        """Las ``cantidad`` primeras filas del orden estable de ``campo``.
+
+        Si el orden guardado tiene filas modificadas o añadidas después de calcularlo,
+        se toman las primeras filas intactas y se recolocan con ellas las cambiadas,
+        sin volver a ordenar el catálogo mientras haya pocas.
+        """
+        clave = (campo, descendente)
+        cambiadas = self.filas_sucias(clave)
+        orden = self._ordenes.get(clave)
+        if not len(cambiadas) or orden is None or cantidad + len(cambiadas) >= self._num_filas or len(cambiadas) > self._umbral_pendientes():
+            return self.orden_columna(campo, descendente)[:cantidad]
+        intactas = orden[:cantidad + len(cambiadas)]
+        intactas = intactas[~np.isin(intactas, cambiadas)][:cantidad]
+        candidatos = np.sort(np.concatenate([intactas, cambiadas]))
+        return candidatos[top_estable(self.claves_orden(campo, candidatos), cantidad, descendente)]
+
+    def orden_guardado(self, campo: str, descendente: bool, cantidad: int) -> bool:
+        """Si ``mejores_filas`` puede responder con el orden guardado, sin ordenar el catálogo entero."""
+        clave = (campo, descendente)
+        cambiadas = len(self.filas_sucias(clave))
+        if self._ordenes.get(clave) is None:
+            return False
+        return not cambiadas or (cantidad + cambiadas < self._num_filas and cambiadas <= self._umbral_pendientes())
+
+    def _umbral_pendientes(self) -> int:
+        return max(MINIMO_PENDIENTES, self._num_filas >> 6)
+
+    def filas_sucias(self, clave: Tuple[str, bool]) -> np.ndarray:
+        """Filas cambiadas desde que se calculó el orden ``clave``, sin repetir."""
+        registro, cantidad = self._sucias.get(clave, ([], 0))
+        return np.unique(np.array(registro[:cantidad], dtype=np.intp))
+
+    def _marcar_sucias(self, campos: Iterable[str], filas: Iterable[int]) -> None:
+        campos = set(campos)
+        filas = list(filas)
+        for clave in self._ordenes:
+            if clave[0] in campos:
+                registro, cantidad = self._sucias.get(clave, ([], 0))
+                # Solo se añade a la lista compartida si nadie ha escrito detrás de estas filas
+                if cantidad != len(registro):
+                    registro = registro[:cantidad]
+                registro.extend(filas)
+                self._sucias[clave] = (registro, len(registro))
+
+    def _escribible(self, campo: str, filas: Sequence[int]) -> np.ndarray:
+        """La columna ``campo`` lista para modificar en su sitio las filas ``filas``.
+
+        Pasa a una copia propia (``_columna_propia``) si es de solo lectura o si la
+        comparte con otra instantánea y alguna de las filas ya existía en ella.
+        """
+        columna = self.columnas[campo]
+        compartida = campo in self._compartidas and len(filas) > 0 and min(filas) < self._filas_compartidas
+        if compartida or not columna.flags.writeable:
+            columna = self._columna_propia(campo)
+        for repuesto in self._repuestos.get(campo, ()):
+            repuesto.pendientes.update(filas)
+        return columna
+
+    def _columna_propia(self, campo: str) -> np.ndarray:
+        """Copia de una columna que solo usa esta instantánea.
+
+        Se escribe en una columna de repuesto, de las que usaban instantáneas
+        anteriores, si ninguna lectura en curso la usa: basta con ponerle al día
+        las filas escritas desde entonces, así que una escritura cuesta lo que
+        esas filas y no una copia de la columna entera. La columna compartida
+        pasa a ser de repuesto para las siguientes escrituras.
+        """
+        columna = self.columnas[campo]
+        reserva_actual, vista = self._reservas.get(campo, (columna, None))
+        if vista is not columna:
+            reserva_actual = columna
+        repuestos = self._repuestos.setdefault(campo, [])
+        utiles = [
+            posicion for posicion, repuesto in enumerate(repuestos)
+            if repuesto.reserva.dtype == columna.dtype and repuesto.reserva.flags.writeable
+            and len(repuesto.reserva) >= len(columna) and len(repuesto.pendientes) <= self._umbral_pendientes()
+            and sin_lecturas(repuesto.desde, repuesto.hasta, self._leidas)
+        ]
+        if utiles:
+            repuesto = repuestos.pop(utiles[-1])
+            reserva, propia = repuesto.reserva, repuesto.reserva[:len(columna)]
+            filas = np.fromiter(repuesto.pendientes, dtype=np.intp, count=len(repuesto.pendientes))
+            propia[filas] = columna[filas]
+            propia[len(repuesto.vista):] = columna[len(repuesto.vista):]
+        else:
+            # Con la capacidad de la reserva actual, para seguir añadiendo filas sin copiarla
+            reserva = np.empty(len(reserva_actual), dtype=columna.dtype)
+            propia = reserva[:len(columna)]
+            propia[:] = columna
+        repuestos.append(Repuesto(reserva_actual, columna, set(), self._desde.get(campo, 0), self.generacion - 1))
+        del repuestos[:-REPUESTOS_POR_COLUMNA]
+        self._desde[campo] = self.generacion
+        self._reservas[campo] = (reserva, propia)
+        self.columnas[campo] = propia
+        self._compartidas.discard(campo)
+        return propia
+
+    def _ampliar(self, adicionales: int) -> None:
+        """Alarga todas las columnas en ``adicionales`` filas sin inicializar.
+
+        Cada columna es una vista sobre una reserva que duplica su capacidad al
+        agotarse, así que añadir filas cuesta O(1) amortizado.
+        """
+        total = self._num_filas + adicionales
+        for campo, columna in list(self.columnas.items()):
+            reserva, vista = self._reservas.get(campo, (None, None))
+            if vista is not columna or len(reserva) < total:
+                reserva = np.empty(max(total, 2 * self._num_filas, MINIMO_PENDIENTES), dtype=columna.dtype)
+                reserva[:self._num_filas] = columna
+                self._compartidas.discard(campo)
+                self._desde[campo] = self.generacion
+            vista = reserva[:total]
+            self._reservas[campo] = (reserva, vista)
+            self.columnas[campo] = vista
+
+    def escala(self, campo: str) -> int:
+        return escala_columna(campo, self.columnas[campo])
+
+    def _escribir(self, campo: str, fila: int, valor: Any) -> None:
+        """Guarda ``valor`` (en euros si es un importe) en la columna, en sus unidades."""
+        columna = self._escribible(campo, (fila,))
+        escala = escala_columna(campo, columna)
+        if escala != 1:
+            centimos = round(valor * escala)
+            if centimos / escala == valor and abs(centimos) < np.iinfo(columna.dtype).max:
+                valor = centimos
+            else:
+                # Un importe que no es un céntimo exacto pasa la columna a euros en float64
+                columna = self.columnas[campo] = columna / escala
+                self._compartidas.discard(campo)
+                self._repuestos.pop(campo, None)
+                self._desde[campo] = self.generacion
+                self.rollup, self.rollup_evaluado = None, False
+        columna[fila] = valor
+
+    def _codigo_categoria(self, campo: str, valor: str) -> int:
+        codigos = self._codigos_categoria.get(campo)
+        if codigos is None:
+            codigos = self._codigos_categoria[campo] = {texto: codigo for codigo, texto in enumerate(self.categorias[campo])}
+        if valor not in codigos:
+            if campo not in self._indices_propios:
+                self.indices_texto[campo] = self.indices_texto[campo].copia()
+                self._indices_propios.add(campo)
+            codigos[valor] = len(self.categorias[campo])
+            self.categorias[campo].append(valor)
+            self.indices_texto[campo].agregar(normalizar_texto(valor))
+        return codigos[valor]
+
+    def agregar_registros(self, registros: Sequence[Dict[str, Any]]) -> List[int]:
+        """Añade registros completos al final del catálogo y devuelve sus posiciones.
+
+        Las filas nuevas quedan pendientes en el índice de fechas, que las incorpora
+        todas de una vez cuando se acumulan suficientes.
+        """
+        inicio = self._num_filas
+        self._ampliar(len(registros))
+        for fila, registro in enumerate(registros, start=inicio):
+            for campo in CAMPOS_TEXTO:
+                self.columnas[campo][fila] = self._codigo_categoria(campo, str(registro[campo]))
+            for campo in CAMPOS_DECIMALES:
+                self._escribir(campo, fila, float(registro[campo]))
+            self.columnas["fechacompra"][fila] = ordinal_fecha(str(registro["fechacompra"]))
+            self.columnas["cantidad_en_stock"][fila] = int(registro["cantidad_en_stock"])
+            if COLUMNA_BORRADA in self.columnas:
+                self.columnas[COLUMNA_BORRADA][fila] = False
+        self._num_filas += len(registros)
+        nuevas = list(range(inicio, self._num_filas))
+        # Sin modificar la lista, que pueden estar leyendo otras instantáneas
+        self.fechas_pendientes = self.fechas_pendientes + nuevas
+        if len(self.fechas_pendientes) > self._umbral_pendientes():
+            self._integrar_fechas_pendientes()
+        self._marcar_sucias(self.columnas, nuevas)
+        if self.rollup is not None:
+            for fila in nuevas:
+                self.rollup.sumar_fila(self, fila, 1)
+        if self.sinopsis is not None:
+            self.sinopsis.agregar_filas(self, np.array(nuevas, dtype=np.int64))
+        self.nueva_version()
+        return nuevas
+
+    def _integrar_fechas_pendientes(self) -> None:
+        pendientes = np.array(self.fechas_pendientes, dtype=np.intp)
+        fechas = self.columnas["fechacompra"][pendientes]
+        orden = np.argsort(fechas, kind="stable")
+        posiciones = np.searchsorted(self.fechas_ordenadas, fechas[orden], side="right")
+        orden_fechas = self.orden_fechas.astype(tipo_posiciones(self._num_filas), copy=False)
+        self.orden_fechas = np.insert(orden_fechas, posiciones, pendientes[orden])
+        self.fechas_ordenadas = np.insert(self.fechas_ordenadas, posiciones, fechas[orden])
+        self.fechas_pendientes = []
+
+    def actualizar_filas(self, cambios: Sequence[Tuple[int, Dict[str, Any]]]) -> None:
+        """Cambia en su sitio valores de ``CAMPOS_ACTUALIZABLES`` de filas existentes.
+
+        ``beneficio`` se recalcula solo en las filas cuyo ``pvp`` o ``compra`` cambia.
+        """
+        modificados = set()
+        for fila, valores in cambios:
+            anteriores = {campo: self.columnas[campo][fila].item() for campo in AGGREGATION_SYNONYMS}
+            for campo, valor in valores.items():
+                self._escribir(campo, fila, valor)
+                modificados.add(campo)
+            if "pvp" in valores or "compra" in valores:
+                self._escribir("beneficio", fila, calcular_beneficio(self.valor("pvp", fila), self.valor("compra", fila)))
+                modificados.add("beneficio")
+            if self.rollup is not None:
+                self.rollup.modificar_fila(self, fila, anteriores)
+        self._marcar_sucias(modificados, [fila for fila, _ in cambios])
+        self.nueva_version(modificados)
+
+    def borrar_filas(self, filas: Sequence[int]) -> int:
+        """Marca filas como borradas; sus posiciones no se reutilizan. Devuelve cuántas se borraron."""
+        if COLUMNA_BORRADA not in self.columnas:
+            self.columnas[COLUMNA_BORRADA] = np.zeros(self._num_filas, dtype=bool)
+            self.versiones[COLUMNA_BORRADA] = self.version
+        filas = np.unique(np.asarray(filas, dtype=np.intp))
+        filas = filas[~self.columnas[COLUMNA_BORRADA][filas]]
+        borrada = self._escribible(COLUMNA_BORRADA, filas.tolist())
+        borrada[filas] = True
+        self.num_borradas += len(filas)
+        if self.rollup is not None:
+            for fila in filas.tolist():
+                self.rollup.sumar_fila(self, fila, -1)
+        if self.sinopsis is not None:
+            self.sinopsis.quitar_filas(self, filas)
+        self.nueva_version()
+        return len(filas)
+
+    def filas_vivas(self) -> np.ndarray:
+        if not self.num_borradas:
+            return np.arange(self._num_filas)
+        return np.flatnonzero(~self.columnas[COLUMNA_BORRADA])
+
+    def esta_borrada(self, fila: int) -> bool:
+        return bool(self.num_borradas) and bool(self.columnas[COLUMNA_BORRADA][fila])
+
+    def compactado(self) -> "Catalogo":
+        """Copia del catálogo sin las filas borradas y con los índices al día."""
+        vivas = self.filas_vivas()
+        columnas = {campo: np.array(self.columnas[campo][vivas]) for campo in CAMPOS}
+        return Catalogo(columnas, {campo: list(valores) for campo, valores in self.categorias.items()})
+
+    def valor(self, campo: str, indice: int) -> Any:
+        """Devuelve el valor de una celda con el tipo Python original."""
+        return self.decodificar(campo, self.columnas[campo][indice])
+
+    def decodificar(self, campo: str, dato: Any) -> Any:
+        """Convierte un dato almacenado en la columna al valor Python original."""
+        if campo in self.categorias:
+            return self.categorias[campo][int(dato)]
+        return decodificar_dato(campo, dato, self.escala(campo))
+
+    def filas(self, indices: Optional[Sequence[int]] = None) -> List[Dict[str, Any]]:
+        """Materializa como diccionarios las filas indicadas (todas si no se indican)."""
+        if indices is None:
+            indices = np.arange(self._num_filas)
+        return decodificar_filas(self.columnas, self.categorias, indices)
+
+    def filas_columnar(self, indices: Sequence[int]) -> Dict[str, Any]:
+        """Las filas indicadas en el formato columnar de las respuestas."""
+        return codificar_columnar(self.columnas, self.categorias, indices)
+
+
+class ConstructorCatalogo:
+    """Acumula registros uno a uno en buffers tipados y construye un ``Catalogo``.
+
+    Permite cargar fuentes grandes sin tener en memoria un diccionario por fila.
+    """
+
+    def __init__(self) -> None:
+        self._codigos = {campo: array.array("i") for campo in CAMPOS_TEXTO}
+        self._categorias: Dict[str, Dict[str, int]] = {campo: {} for campo in CAMPOS_TEXTO}
+        self._decimales = {campo: array.array("d") for campo in CAMPOS_DECIMALES}
+        self._fechas = array.array("i")
+        self._stock = array.array("i")
+
+    def agregar(self, registro: Dict[str, Any]) -> None:
+        for campo in CAMPOS_TEXTO:
+            categorias = self._categorias[campo]
+            self._codigos[campo].append(categorias.setdefault(str(registro[campo]), len(categorias)))
+        for campo in CAMPOS_DECIMALES:
+            self._decimales[campo].append(float(registro[campo]))
+        self._fechas.append(ordinal_fecha(str(registro["fechacompra"])))
+        self._stock.append(int(registro["cantidad_en_stock"]))
+
+    def construir(self) -> Catalogo:
+        columnas: Dict[str, np.ndarray] = {}
+        for campo in CAMPOS_TEXTO:
+            columnas[campo] = np.array(self._codigos[campo], dtype=np.int32)
+        for campo in CAMPOS_DECIMALES:
+            columnas[campo] = columna_importes(np.array(self._decimales[campo], dtype=np.float64))
+        columnas["fechacompra"] = np.array(self._fechas, dtype=np.int32)
+        columnas["cantidad_en_stock"] = np.array(self._stock, dtype=np.int32)
+        categorias = {campo: list(valores) for campo, valores in self._categorias.items()}
+        return Catalogo(columnas, categorias)
+
+
+def comprobar_campos(presentes: Iterable[str], origen: str) -> None:
+    presentes = set(presentes)
+    faltan = [campo for campo in CAMPOS if campo not in presentes]
+    if faltan:
+        raise ValueError(f"{origen}: faltan los campos {', '.join(faltan)}")
+
+
+def leer_csv(ruta: str) -> Iterator[Dict[str, Any]]:
+    import csv
+
+    with open(ruta, newline="", encoding="utf-8") as fichero:
+        lector = csv.DictReader(fichero)
+        comprobar_campos(lector.fieldnames or [], ruta)
+        yield from lector
+
+
+def leer_jsonl(ruta: str) -> Iterator[Dict[str, Any]]:
+    with open(ruta, encoding="utf-8") as fichero:
+        for numero, linea in enumerate(fichero, start=1):
+            if not linea.strip():
+                continue
+            registro = json.loads(linea)
+            comprobar_campos(registro, f"{ruta}:{numero}")
+            yield registro
+
+
+def leer_sqlite(ruta: str) -> Iterator[Dict[str, Any]]:
+    """Registros de la tabla ``catalogo`` de una base SQLite con una columna por campo."""
+    import sqlite3
+
+    conexion = sqlite3.connect(f"file:{ruta}?mode=ro", uri=True)
+    try:
+        cursor = conexion.execute(f"SELECT {', '.join(CAMPOS)} FROM {TABLA_SQLITE}")
+        for fila in cursor:
+            yield dict(zip(CAMPOS, fila))
+    finally:
+        conexion.close()
+
+
+def cargar_columnar(ruta: str) -> Catalogo:
+    """Abre un catálogo en formato columnar binario proyectando sus columnas en memoria.
+
+    Las columnas no se leen al arrancar: el sistema operativo carga las páginas
+    bajo demanda y las comparte entre todos los procesos que abren el mismo fichero.
+    """
+    with open(os.path.join(ruta, "meta.json"), encoding="utf-8") as fichero:
+        meta = json.load(fichero)
+    if meta.get("formato") != FORMATO_COLUMNAR or meta.get("version") not in VERSIONES_COLUMNARES_LEIDAS:
+        raise ValueError(f"{ruta}: formato columnar no reconocido")
+    columnas = {campo: np.load(os.path.join(ruta, f"{campo}.npy"), mmap_mode="r") for campo in CAMPOS}
+    indice_fechas = (
+        np.load(os.path.join(ruta, "orden_fechas.npy"), mmap_mode="r"),
+        np.load(os.path.join(ruta, "fechas_ordenadas.npy"), mmap_mode="r"),
+    )
+    return Catalogo(columnas, meta["categorias"], indice_fechas)
+
+
+def guardar_columnar(catalogo: Catalogo, ruta: str, origen: Optional[Dict[str, Any]] = None) -> None:
+    """Escribe el catálogo en el formato que lee ``cargar_columnar``.
+
+    ``origen`` describe la fuente de la que sale el catálogo; se guarda en
+    ``meta.json`` para saber si una instantánea sigue valiendo.
+    """
+    if catalogo.num_borradas or catalogo.fechas_pendientes:
+        catalogo = catalogo.compactado()
+    os.makedirs(ruta, exist_ok=True)
+    for campo in CAMPOS:
+        np.save(os.path.join(ruta, f"{campo}.npy"), np.ascontiguousarray(catalogo.columnas[campo]))
+    np.save(os.path.join(ruta, "orden_fechas.npy"), np.ascontiguousarray(catalogo.orden_fechas))
+    np.save(os.path.join(ruta, "fechas_ordenadas.npy"), np.ascontiguousarray(catalogo.fechas_ordenadas))
+    escribir_meta_columnar(ruta, len(catalogo), catalogo.categorias, origen)
+
+
+def escribir_meta_columnar(ruta: str, num_filas: int, categorias: Dict[str, List[str]], origen: Optional[Dict[str, Any]]) -> None:
+    meta = {
+        "formato": FORMATO_COLUMNAR,
+        "version": VERSION_FORMATO_COLUMNAR,
+        "filas": num_filas,
+        "categorias": categorias,
+        "origen": origen,
+    }
+    # meta.json se escribe al final: su presencia indica que el directorio está completo
+    with open(os.path.join(ruta, "meta.json"), "w", encoding="utf-8") as fichero:
+        json.dump(meta, fichero, ensure_ascii=False)
+
+
+FUENTES = {
+    ".csv": leer_csv,
+    ".jsonl": leer_jsonl,
+    ".ndjson": leer_jsonl,
+    ".sqlite": leer_sqlite,
+    ".sqlite3": leer_sqlite,
+    ".db": leer_sqlite,
+}
+
+
+def lector_fuente(ruta: str) -> Callable[[str], Iterator[Dict[str, Any]]]:
+    extension = os.path.splitext(ruta)[1].lower()
+    if extension not in FUENTES:
+        raise ValueError(f"{ruta}: extensión no soportada (se admiten {', '.join(sorted(FUENTES))} o un directorio columnar)")
+    return FUENTES[extension]
+
+
+def cargar_catalogo(ruta: str) -> Catalogo:
+    """Carga un catálogo eligiendo el lector por la extensión; un directorio es formato columnar."""
+    if os.path.isdir(ruta):
+        return cargar_columnar(ruta)
+    return Catalogo.desde_registros(lector_fuente(ruta)(ruta))
+
+
+def origen_configurado() -> Dict[str, Any]:
+    """Describe la fuente de ``CATALOGO_FUENTE``: cambia si cambia el fichero o, en el sintético, el día."""
+    ruta = os.environ.get("CATALOGO_FUENTE")
+    if not ruta:
+        # Las fechas sintéticas se cuentan hacia atrás desde hoy
+        return {"sintetico": FILAS_SINTETICAS, "semilla": SEMILLA_SINTETICA, "fecha": datetime.date.today().isoformat()}
+    estado = os.stat(ruta)
+    return {"ruta": os.path.abspath(ruta), "bytes": estado.st_size, "modificado_ns": estado.st_mtime_ns}
+
+
+def cargar_instantanea(ruta: str, origen: Dict[str, Any]) -> Optional[Catalogo]:
+    """Instantánea columnar de ``ruta`` si existe y se guardó desde ``origen``."""
+    try:
+        with open(os.path.join(ruta, "meta.json"), encoding="utf-8") as fichero:
+            meta = json.load(fichero)
+        if meta.get("origen") != origen:
+            return None
+        return cargar_columnar(ruta)
+    except (OSError, ValueError):
+        return None
+
+
+def guardar_instantanea(catalogo: Catalogo, ruta: str, origen: Dict[str, Any]) -> None:
+    """Guarda la instantánea en un directorio aparte y la pone en ``ruta`` de golpe.
+
+    Otro servidor puede tener proyectada la instantánea anterior: sus ficheros se
+    retiran con el directorio y no se sobrescriben.
+    """
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    anterior = f"{ruta}.{os.getpid()}.old"
+    guardar_columnar(catalogo, temporal, origen)
+    with contextlib.suppress(FileNotFoundError):
+        os.rename(ruta, anterior)
+    os.rename(temporal, ruta)
+    shutil.rmtree(anterior, ignore_errors=True)
+
+
+def cargar_catalogo_configurado() -> Catalogo:
+    """Catálogo indicado en ``CATALOGO_FUENTE``; sin esa variable, el catálogo sintético.
+
+    Con ``CATALOGO_INSTANTANEA`` el catálogo se abre desde esa instantánea columnar
+    mientras la fuente no cambie y, si no vale, se carga de la fuente y se guarda en ella.
+    """
+    ruta = os.environ.get("CATALOGO_FUENTE")
+    instantanea = os.environ.get("CATALOGO_INSTANTANEA")
+    if ruta and os.path.isdir(ruta):
+        # Una fuente columnar ya se abre sin cargarla
+        instantanea = None
+    if instantanea:
+        origen = origen_configurado()
+        catalogo = cargar_instantanea(instantanea, origen)
+        if catalogo is not None:
+            return catalogo
+    catalogo = cargar_catalogo(ruta) if ruta else catalogo_sintetico()
+    if instantanea:
+        try:
+            guardar_instantanea(catalogo, instantanea, origen)
+        except OSError as error:
+            print(f"No se pudo guardar la instantánea en {instantanea}: {error}", file=sys.stderr)
+    return catalogo
+
+
+def primer_registro_configurado() -> Optional[Dict[str, Any]]:
+    """Primera fila de la fuente configurada, leída sin cargar el catálogo."""
+    ruta = os.environ.get("CATALOGO_FUENTE")
+    if not ruta:
+        registros: Iterator[Dict[str, Any]] = iterar_datos()
+    elif os.path.isdir(ruta):
+        catalogo = cargar_columnar(ruta)
+        return catalogo.filas([0])[0] if len(catalogo) else None
+    else:
+        registros = lector_fuente(ruta)(ruta)
+    with contextlib.closing(registros):
+        registro = next(registros, None)
+    # Se pasa por un catálogo de una fila para devolverla con los mismos tipos
+    return None if registro is None else Catalogo.desde_registros([registro]).filas([0])[0]
+
+
+class CargaCatalogo:
+    """Catálogo que se carga fuera del arranque del servidor.
+
+    ``iniciar`` lo carga en un hilo mientras el cliente negocia la conexión; si
+    no se ha iniciado, lo carga la primera herramienta que lo necesita. Una carga
+    fallida se repite en la siguiente petición, que recibe el error.
+
+    ``lectura`` da la instantánea vigente, que no cambia nunca: cada consulta lee
+    la suya de principio a fin. Las modificaciones se hacen sobre una copia
+    (``escritura``) que después sustituye a la vigente. Las escrituras reutilizan
+    las columnas de las instantáneas sustituidas que ya no lee nadie.
+    """
+
+    def __init__(self, cargar: Callable[[], Catalogo]) -> None:
+        self._cargar = cargar
+        self._catalogo: Optional[Catalogo] = None
+        self._candado = threading.Lock()
+        self._candado_escritura = threading.Lock()
+        self._candado_lecturas = threading.Lock()
+        # Lecturas en curso por generación de la instantánea
+        self._lecturas: Dict[int, int] = {}
+
+    def iniciar(self) -> None:
+        threading.Thread(target=self._cargar_en_segundo_plano, name="carga-catalogo", daemon=True).start()
+
+    def _cargar_en_segundo_plano(self) -> None:
+        with contextlib.suppress(Exception):
+            self.obtener()
+
+    def cargado(self) -> Optional[Catalogo]:
+        """El catálogo si ya está cargado, sin esperar."""
+        return self._catalogo
+
+    def obtener(self) -> Catalogo:
+        if self._catalogo is None:
+            with self._candado:
+                if self._catalogo is None:
+                    self._catalogo = self._cargar()
+        return self._catalogo
+
+    @contextlib.contextmanager
+    def lectura(self) -> Iterator[Catalogo]:
+        """La instantánea vigente, cuyas columnas no se reutilizan hasta que termina el bloque."""
+        self.obtener()
+        with self._candado_lecturas:
+            catalogo = self._catalogo
+            self._lecturas[catalogo.generacion] = self._lecturas.get(catalogo.generacion, 0) + 1
+        try:
+            yield catalogo
+        finally:
+            with self._candado_lecturas:
+                self._lecturas[catalogo.generacion] -= 1
+                if not self._lecturas[catalogo.generacion]:
+                    del self._lecturas[catalogo.generacion]
+
+    @contextlib.contextmanager
+    def escritura(self) -> Iterator[Catalogo]:
+        """Copia del catálogo para modificarla; si el bloque termina sin error, pasa a ser la vigente.
+
+        Las escrituras se hacen de una en una y no esperan a las consultas en
+        curso, ni las consultas a ellas. La copia escribe en las columnas de
+        repuesto que ya no lee ninguna consulta, sin copiar las columnas enteras
+        (véase ``Catalogo._columna_propia``).
+        """
+        with self._candado_escritura:
+            anterior = self.obtener()
+            with self._candado_lecturas:
+                leidas = list(self._lecturas)
+            repuestos = anterior._repuestos
+            copia = anterior.instantanea(leidas)
+            try:
+                yield copia
+            except BaseException:
+                # Los repuestos de las columnas en las que la copia no llegó a escribir siguen sirviendo
+                anterior._repuestos = {campo: lista for campo, lista in repuestos.items() if campo in copia._compartidas}
+                raise
+            if copia.rollup_pedido.is_set() and not copia.rollup_evaluado:
+                # Las consultas no lo construyen sobre instantáneas sustituidas, así que con
+                # escrituras frecuentes tal vez no llegue a construirlo ninguna
+                evaluar_rollup(copia)
+            with self._candado_lecturas:
+                self._catalogo = copia
+                anterior.sustituida = True
 
 
 def normalizar_texto(valor: str) -> str:
+    if valor.isascii():
+        return valor.lower()
     nfkd = unicodedata.normalize("NFKD", valor)
     sin_acentos = "".join([c for c in nfkd if not unicodedata.combining(c)])
     return sin_acentos.lower()
@@ -185,10 +1405,12 @@ def resolver_alias(nombre: str) -> Optional[str]:
     return None
 
 
+ALIASES_POR_LONGITUD = sorted(FIELD_ALIASES.items(), key=lambda x: len(x[0]), reverse=True)
+
+
 def reemplazar_aliases(texto: str) -> str:
-    reemplazos = sorted(FIELD_ALIASES.items(), key=lambda x: len(x[0]), reverse=True)
     resultado = texto
-    for alias, real in reemplazos:
+    for alias, real in ALIASES_POR_LONGITUD:
         resultado = resultado.replace(alias, real)
     return resultado
 
@@ -210,8 +1432,11 @@ def detectar_comparador(fragmento: str) -> Optional[str]:
     return None
 
 
+PATRON_NUMERO = re.compile(r"\d+(?:[\.,]\d+)?")
+
+
 def extraer_valor_numerico(cadena: str) -> Optional[float]:
-    numeros = re.findall(r"\d+(?:[\.,]\d+)?", cadena)
+    numeros = PATRON_NUMERO.findall(cadena)
     if not numeros:
         return None
     valor = numeros[0].replace(",", ".")
@@ -221,106 +1446,286 @@ def extraer_valor_numerico(cadena: str) -> Optional[float]:
         return None
 
 
-def parsear_filtros_y_agregaciones(pregunta: str) -> Dict[str, Any]:
-    texto = normalizar_texto(pregunta)
-    texto = reemplazar_aliases(texto)
-    resultado = {
-        "filters": [],
-        "date_range": [None, None],
-        "aggregations": {},
-        "group_by": [],
-        "order_by": None,
-        "limit": None,
-        "assumed_default": False,
-    }
-
-    # Grupo solicitado
-    for campo, frase in GROUPABLE_FIELDS.items():
-        if frase in texto:
-            resultado["group_by"].append(campo)
-
-    # Rango de fechas
-    entre = re.search(r"entre\s+(\d{4}-\d{2}-\d{2})\s+y\s+(\d{4}-\d{2}-\d{2})", texto)
-    if entre:
-        inicio, fin = entre.groups()
-        resultado["date_range"] = [inicio, fin]
-    else:
-        desde = re.search(r"desde\s+(\d{4}-\d{2}-\d{2})", texto)
-        hasta = re.search(r"hasta\s+(\d{4}-\d{2}-\d{2})", texto)
-        if desde:
-            resultado["date_range"][0] = desde.group(1)
-        if hasta:
-            resultado["date_range"][1] = hasta.group(1)
-    ultimos = re.search(r"ultimos?\s+(\d+)\s+meses", texto)
-    if ultimos:
-        meses = int(ultimos.group(1))
-        fecha_fin = datetime.date.today()
-        fecha_inicio = fecha_fin - datetime.timedelta(days=meses * 30)
-        resultado["date_range"] = [fecha_inicio.isoformat(), fecha_fin.isoformat()]
-    if "este ano" in texto:
-        hoy = datetime.date.today()
-        inicio_ano = datetime.date(hoy.year, 1, 1)
-        resultado["date_range"] = [inicio_ano.isoformat(), hoy.isoformat()]
+# Patrones del intérprete, compilados una sola vez al importar el módulo
+PATRON_ENTRE = re.compile(r"entre\s+(\d{4}-\d{2}-\d{2})\s+y\s+(\d{4}-\d{2}-\d{2})")
+PATRON_DESDE = re.compile(r"desde\s+(\d{4}-\d{2}-\d{2})")
+PATRON_HASTA = re.compile(r"hasta\s+(\d{4}-\d{2}-\d{2})")
+PATRON_ULTIMOS_MESES = re.compile(r"ultimos?\s+(\d+)\s+meses")
+PATRON_TOP = re.compile(r"top\s+(\d+)")
+PATRON_PRIMEROS = re.compile(r"primeros?\s+(\d+)")
+PATRON_ORDENADO = re.compile(r"ordenad[oa]s?\s+(ascendente|descendente|asc|desc)?\s*por\s+([a-z_\s]+)")
+PATRON_POR_FINAL = re.compile(r"por\s+([a-z_\s]+)$")
+# Se buscan tras reemplazar los alias, así que basta con los nombres de los campos
+CAMPOS_PERCENTIL = "|".join(NUMERIC_FIELD_SYNONYMS)
+PATRON_PERCENTIL = re.compile(
+    r"\b(?:percentil\s*(\d{1,2})|p(\d{1,2})|mediana)\s+del?\s+(?:la\s+|el\s+)?(" + CAMPOS_PERCENTIL + r")\b"
+)
+PATRON_MEDIANO = re.compile(r"\b(" + CAMPOS_PERCENTIL + r")\s+median[oa]\b")
+# Sumas y medias de cualquier campo numérico ("suma de pvp", "media del stock")
+PATRON_SUMA_MEDIA = re.compile(r"\b(suma|total|media|promedio)\s+del?\s+(?:la\s+|el\s+)?(" + CAMPOS_PERCENTIL + r")\b")
+PATRON_DISTINTOS = re.compile(r"\b(producto|marca|tipo|modelo)s\s+(?:distint|diferent)[oa]s\b")
 
-    # Filtros de cadenas explícitos
-    patrones_cadena = {
+PATRONES_CADENA = {
+    campo: [re.compile(patron) for patron in patrones]
+    for campo, patrones in {
         "marca": [r"marca\s+(?:es\s+|=|igual\s+a\s+|llamada\s+|llamado\s+)?['\"]?([a-z0-9\s\-]+)", r"de\s+marca\s+['\"]?([a-z0-9\s\-]+)"],
         "producto": [r"producto\s+(?:es\s+|=|igual\s+a\s+)?['\"]?([a-z0-9\s\-]+)", r"de\s+producto\s+['\"]?([a-z0-9\s\-]+)"],
         "tipo": [r"tipo\s+(?:es\s+|=|igual\s+a\s+)?['\"]?([a-z0-9\s\-]+)", r"de\s+tipo\s+['\"]?([a-z0-9\s\-]+)"],
         "modelo": [r"modelo\s+(?:es\s+|=|igual\s+a\s+|llamado\s+)?['\"]?([a-z0-9\s\-]+)", r"modelo\s+que\s+contenga\s+['\"]?([a-z0-9\s\-]+)"]
-    }
-    for campo, patrones in patrones_cadena.items():
-        for patron in patrones:
-            for coincidencia in re.finditer(patron, texto):
-                valor = truncar_valor(coincidencia.group(1))
-                if valor:
-                    resultado["filters"].append({"field": campo, "type": "contains", "value": valor})
+    }.items()
+}
 
-    # Reconocer palabras clave de tipos
-    for tipo_base, sinonimos in TIPO_SYNONYMS.items():
-        for sinonimo in sinonimos:
-            if re.search(rf"\b{re.escape(sinonimo)}\b", texto):
-                resultado["filters"].append({"field": "producto", "type": "contains", "value": tipo_base})
-                break
+# Una alternativa por tipo: basta con que aparezca cualquiera de sus sinónimos
+PATRONES_TIPO = {
+    tipo_base: re.compile(r"\b(?:" + "|".join(re.escape(sinonimo) for sinonimo in sinonimos) + r")\b")
+    for tipo_base, sinonimos in TIPO_SYNONYMS.items()
+}
+
+# Un patrón por sinónimo: las coincidencias de sinónimos distintos pueden solaparse
+PATRONES_NUMERICOS = [
+    (campo, re.compile(rf"{re.escape(sinonimo)}\s+([a-z\s]+)?(\d+(?:[\.,]\d+)?)"))
+    for campo, sinonimos in NUMERIC_FIELD_SYNONYMS.items()
+    for sinonimo in sinonimos
+]
+PATRONES_NUMERICOS_AL_MENOS = [
+    (campo, re.compile(rf"{re.escape(sinonimo)}\s+(al menos|como minimo|minimo)\s+(\d+(?:[\.,]\d+)?)"))
+    for campo, sinonimos in NUMERIC_FIELD_SYNONYMS.items()
+    for sinonimo in sinonimos
+]
+
+TAMANO_CACHE_PLANES = 2048
+
+TAMANO_CACHE_RESULTADOS = 512
+
+TTL_CACHE_RESULTADOS = 300.0
+
+TAMANO_CACHE_PAGINAS = 16
+
+TAMANO_MAXIMO_PAGINA = 1000
+
+# Clave con la que se firman los cursores de paginación; sin CATALOGO_CLAVE_CURSORES se genera
+# al arrancar, así que los cursores no sobreviven a un reinicio
+CLAVE_CURSORES = os.environ.get("CATALOGO_CLAVE_CURSORES", "").encode() or secrets.token_bytes(32)
+
+# Formatos de ``rows`` en las respuestas: lista de diccionarios o columnas paralelas
+FORMATOS_RESPUESTA = ("filas", "columnar")
+
+# En formato columnar las páginas pueden ser mayores: no repiten los nombres de las columnas
+TAMANO_MAXIMO_PAGINA_COLUMNAR = 10000
+
+# Las fechas del formato columnar son días desde el 1970-01-01, como las de Arrow
+EPOCA_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# Con CATALOGO_INSTRUMENTACION=0 solo se mide cuando una llamada pide ``debug``
+INSTRUMENTACION_ACTIVA = os.environ.get("CATALOGO_INSTRUMENTACION", "1") != "0"
+
+# Con CATALOGO_PROCESOS=N (N > 1) las consultas sobre catálogos grandes se reparten entre N procesos
+PROCESOS_CONSULTA = int(os.environ.get("CATALOGO_PROCESOS", "0") or 0)
+
+# Por debajo de este tamaño repartir la consulta cuesta más de lo que ahorra
+MINIMO_FILAS_PARALELO = 4 * TAMANO_FRAGMENTO
+
+# Herramientas que leen el catálogo ejecutándose a la vez (CATALOGO_CONSULTAS_SIMULTANEAS)
+# y llamadas que pueden esperar turno (CATALOGO_CONSULTAS_EN_ESPERA); las demás se rechazan
+CONSULTAS_SIMULTANEAS = int(os.environ.get("CATALOGO_CONSULTAS_SIMULTANEAS", "0") or 0) or min(8, os.cpu_count() or 1)
+CONSULTAS_EN_ESPERA = int(os.environ.get("CATALOGO_CONSULTAS_EN_ESPERA", "64") or 0)
+
+# Control de admisión de query_nl: las consultas cuyo coste estimado supera CATALOGO_PRESUPUESTO_MS
+# (0 lo desactiva) se encolan, se degradan a aproximadas o se rechazan según CATALOGO_ADMISION
+# (encolar, degradar o rechazar)
+PRESUPUESTO_CONSULTA_MS = float(os.environ.get("CATALOGO_PRESUPUESTO_MS", "1000") or 0)
+POLITICA_ADMISION = os.environ.get("CATALOGO_ADMISION", "encolar")
+# Consultas por encima del presupuesto ejecutándose a la vez; las demás esperan, las más baratas primero
+CONSULTAS_PESADAS = int(os.environ.get("CATALOGO_CONSULTAS_PESADAS", "1") or 0) or 1
+
+# Límites de cada ejecución de query_nl, comprobados entre fragmentos (0 los desactiva)
+TIEMPO_MAXIMO_CONSULTA_MS = float(os.environ.get("CATALOGO_TIEMPO_MAXIMO_MS", "30000") or 0)
+MEMORIA_MAXIMA_CONSULTA = int(os.environ.get("CATALOGO_MEMORIA_MAXIMA_MB", "1024") or 0) * 2 ** 20
+
+# Modelo de coste del optimizador, en nanosegundos aproximados por fila
+COSTES_PREDICADO = {"comparar": 0.5, "tabla": 3.5, "valores": 70.0}
+# Sobrecoste de leer filas sueltas por posición en lugar de la columna seguida
+COSTE_LECTURA_DISPERSA = 3.0
+# Tomar una fila del índice de fechas y ordenar las posiciones del rango
+COSTE_INDICE_FECHAS = 6.0
+# Agregar una fila filtrada: asignarle su grupo y sumar cada campo agregado
+COSTE_AGRUPAR = 150.0
+COSTE_AGREGAR = 16.0
+# Ordenar el valor de una fila filtrada para un percentil o un conteo de distintos
+COSTE_ORDENAR = 150.0
+# Comparar la clave de orden de una fila filtrada al elegir las primeras, por cada nivel (log2) del límite
+COSTE_SELECCIONAR = 1.5
+# Agregar una celda del rollup que cumple los filtros
+COSTE_CELDA_ROLLUP = 60.0
+# Estimar las agregaciones con una fila de la muestra del modo aproximado
+COSTE_FILA_MUESTRA = 200.0
+# Repartir una consulta entre los procesos y combinar sus parciales
+COSTE_ARRANQUE_PARALELO = 2e6
+
+# Cuando pasan menos filas que esta fracción del bloque, los predicados siguientes solo leen esas filas
+FRACCION_EVALUACION_DISPERSA = 0.125
+
+# Filas de la muestra con la que el optimizador estima selectividades
+MUESTRA_ESTADISTICAS = 4096
+
+
+class Filtro(TypedDict):
+    field: str
+    type: str
+    value: Any
+
+
+class PlanLogico(TypedDict):
+    """Plan lógico de una pregunta: qué se pide, sin decidir aún cómo calcularlo."""
+
+    filters: List[Filtro]
+    date_range: List[Optional[str]]
+    aggregations: Dict[str, Dict[str, Any]]
+    group_by: List[str]
+    order_by: Optional[Dict[str, str]]
+    limit: Optional[int]
+    assumed_default: bool
+
+
+def copiar_plan(plan: PlanLogico) -> PlanLogico:
+    """Copia un plan lo bastante en profundidad como para que el llamador pueda modificarlo."""
+    copia = dict(plan)
+    copia["filters"] = [dict(filtro) for filtro in plan["filters"]]
+    copia["date_range"] = list(plan["date_range"])
+    copia["aggregations"] = {campo: dict(info) for campo, info in plan["aggregations"].items()}
+    copia["group_by"] = list(plan["group_by"])
+    copia["order_by"] = dict(plan["order_by"]) if plan["order_by"] else None
+    return copia
+
+
+def parsear_filtros_y_agregaciones(pregunta: str) -> PlanLogico:
+    """Interpreta la pregunta reutilizando el plan si ya se vio hoy el mismo texto normalizado."""
+    plan = parsear_texto_normalizado(normalizar_texto(pregunta), datetime.date.today())
+    return copiar_plan(plan)
+
+
+def anadir_agregacion(plan: PlanLogico, campo: str, agregacion: Dict[str, Any]) -> None:
+    """Añade la agregación de un campo al plan, que admite una sola por campo."""
+    anterior = plan["aggregations"].get(campo)
+    if anterior is not None and anterior != agregacion:
+        raise ToolError(f"Solo se puede pedir una agregación de {campo} por consulta: {anterior['alias']} o {agregacion['alias']}")
+    plan["aggregations"][campo] = agregacion
+
+
+@functools.lru_cache(maxsize=TAMANO_CACHE_PLANES)
+def parsear_texto_normalizado(texto: str, hoy: datetime.date) -> PlanLogico:
+    """Construye el plan de una pregunta ya normalizada.
+
+    ``hoy`` forma parte de la clave de la caché para que las fechas relativas
+    ("últimos N meses", "este año") no queden obsoletas al cambiar de día.
+    """
+    texto = reemplazar_aliases(texto)
+    resultado: PlanLogico = {
+        "filters": [],
+        "date_range": [None, None],
+        "aggregations": {},
+        "group_by": [],
+        "order_by": None,
+        "limit": None,
+        "assumed_default": False,
+    }
+
+    # Grupo solicitado
+    for campo, frase in GROUPABLE_FIELDS.items():
+        if frase in texto:
+            resultado["group_by"].append(campo)
+
+    # Rango de fechas
+    entre = PATRON_ENTRE.search(texto)
+    if entre:
+        inicio, fin = entre.groups()
+        resultado["date_range"] = [inicio, fin]
+    else:
+        desde = PATRON_DESDE.search(texto)
+        hasta = PATRON_HASTA.search(texto)
+        if desde:
+            resultado["date_range"][0] = desde.group(1)
+        if hasta:
+            resultado["date_range"][1] = hasta.group(1)
+    ultimos = PATRON_ULTIMOS_MESES.search(texto)
+    if ultimos:
+        meses = int(ultimos.group(1))
+        fecha_fin = hoy
+        fecha_inicio = fecha_fin - datetime.timedelta(days=meses * 30)
+        resultado["date_range"] = [fecha_inicio.isoformat(), fecha_fin.isoformat()]
+    if "este ano" in texto:
+        inicio_ano = datetime.date(hoy.year, 1, 1)
+        resultado["date_range"] = [inicio_ano.isoformat(), hoy.isoformat()]
+
+    # Filtros de cadenas explícitos
+    for campo, patrones in PATRONES_CADENA.items():
+        for patron in patrones:
+            for coincidencia in patron.finditer(texto):
+                valor = truncar_valor(coincidencia.group(1))
+                if valor:
+                    resultado["filters"].append({"field": campo, "type": "contains", "value": valor})
+
+    # Reconocer palabras clave de tipos
+    for tipo_base, patron in PATRONES_TIPO.items():
+        if patron.search(texto):
+            resultado["filters"].append({"field": "producto", "type": "contains", "value": tipo_base})
 
     # Filtros numéricos
-    for campo, sinonimos in NUMERIC_FIELD_SYNONYMS.items():
-        for sinonimo in sinonimos:
-            for coincidencia in re.finditer(rf"{re.escape(sinonimo)}\s+([a-z\s]+)?(\d+(?:[\.,]\d+)?)", texto):
-                fragmento = coincidencia.group(0)
-                comparador = detectar_comparador(fragmento)
-                if not comparador:
-                    continue
-                valor = extraer_valor_numerico(fragmento)
-                if valor is None:
-                    continue
-                resultado["filters"].append({"field": resolver_alias(campo) or campo, "type": comparador, "value": valor})
+    for campo, patron in PATRONES_NUMERICOS:
+        for coincidencia in patron.finditer(texto):
+            fragmento = coincidencia.group(0)
+            comparador = detectar_comparador(fragmento)
+            if not comparador:
+                continue
+            valor = extraer_valor_numerico(fragmento)
+            if valor is None:
+                continue
+            resultado["filters"].append({"field": resolver_alias(campo) or campo, "type": comparador, "value": valor})
     # Filtros numéricos con expresiones "al menos X" sin repetir campo
-    for campo, sinonimos in NUMERIC_FIELD_SYNONYMS.items():
-        for sinonimo in sinonimos:
-            for coincidencia in re.finditer(rf"{re.escape(sinonimo)}\s+(al menos|como minimo|minimo)\s+(\d+(?:[\.,]\d+)?)", texto):
-                valor = float(coincidencia.group(2).replace(",", "."))
-                resultado["filters"].append({"field": resolver_alias(campo) or campo, "type": ">=", "value": valor})
+    for campo, patron in PATRONES_NUMERICOS_AL_MENOS:
+        for coincidencia in patron.finditer(texto):
+            valor = float(coincidencia.group(2).replace(",", "."))
+            resultado["filters"].append({"field": resolver_alias(campo) or campo, "type": ">=", "value": valor})
 
     # Agregaciones
     for campo, datos in AGGREGATION_SYNONYMS.items():
         for keyword in datos["keywords"]:
             if keyword in texto:
-                resultado["aggregations"][campo] = {"type": datos["type"], "alias": datos["alias"]}
+                anadir_agregacion(resultado, campo, {"type": datos["type"], "alias": datos["alias"]})
                 break
+    for coincidencia in PATRON_SUMA_MEDIA.finditer(texto):
+        campo = resolver_alias(coincidencia.group(2)) or coincidencia.group(2)
+        tipo = "sum" if coincidencia.group(1) in ("suma", "total") else "mean"
+        # Con el alias de la frase equivalente de AGGREGATION_SYNONYMS, si la hay: "suma de beneficio" es "beneficio total"
+        sinonimo = AGGREGATION_SYNONYMS.get(campo, {})
+        alias = sinonimo["alias"] if sinonimo.get("type") == tipo else f"{campo}_total" if tipo == "sum" else f"{campo}_media"
+        anadir_agregacion(resultado, campo, {"type": tipo, "alias": alias})
+    for coincidencia in PATRON_PERCENTIL.finditer(texto):
+        numero = coincidencia.group(1) or coincidencia.group(2)
+        if numero is None:
+            anadir_agregacion(resultado, coincidencia.group(3), {"type": "percentile", "alias": f"{coincidencia.group(3)}_mediana", "fraction": 0.5})
+        elif 0 < int(numero) < 100:
+            anadir_agregacion(
+                resultado, coincidencia.group(3), {"type": "percentile", "alias": f"{coincidencia.group(3)}_p{int(numero)}", "fraction": int(numero) / 100}
+            )
+    for coincidencia in PATRON_MEDIANO.finditer(texto):
+        anadir_agregacion(resultado, coincidencia.group(1), {"type": "percentile", "alias": f"{coincidencia.group(1)}_mediana", "fraction": 0.5})
+    for coincidencia in PATRON_DISTINTOS.finditer(texto):
+        campo = coincidencia.group(1)
+        anadir_agregacion(resultado, campo, {"type": "count_distinct", "alias": "marcas_distintas" if campo == "marca" else f"{campo}s_distintos"})
 
     if resultado["group_by"] and "count" not in resultado["aggregations"]:
         resultado["aggregations"]["count"] = {"type": "count", "alias": "conteo"}
 
     # Orden y limite
-    limite = re.search(r"top\s+(\d+)", texto)
+    limite = PATRON_TOP.search(texto)
     if limite:
         resultado["limit"] = int(limite.group(1))
     else:
-        primeros = re.search(r"primeros?\s+(\d+)", texto)
+        primeros = PATRON_PRIMEROS.search(texto)
         if primeros:
             resultado["limit"] = int(primeros.group(1))
-    orden = re.search(r"ordenad[oa]s?\s+(ascendente|descendente|asc|desc)?\s*por\s+([a-z_\s]+)", texto)
+    orden = PATRON_ORDENADO.search(texto)
     if orden:
         direccion_texto = orden.group(1) or "asc"
         direccion = "desc" if direccion_texto.startswith("desc") else "asc"
@@ -328,160 +1733,1657 @@ def parsear_filtros_y_agregaciones(pregunta: str) -> Dict[str, Any]:
         canonico = resolver_alias(campo_orden) or campo_orden
         resultado["order_by"] = {"field": canonico, "direction": direccion}
     elif resultado["limit"] and "por" in texto:
-        match = re.search(r"por\s+([a-z_\s]+)$", texto)
+        match = PATRON_POR_FINAL.search(texto)
         if match:
             campo_orden = truncar_valor(match.group(1)).replace(" ", "_")
             canonico = resolver_alias(campo_orden) or campo_orden
             resultado["order_by"] = {"field": canonico, "direction": "desc"}
 
-    if resultado["order_by"] and resultado["aggregations"]:
-        campo = resultado["order_by"]["field"]
-        if campo in resultado["aggregations"]:
-            resultado["order_by"]["field"] = resultado["aggregations"][campo]["alias"]
+    if resultado["order_by"] and resultado["aggregations"]:
+        campo = resultado["order_by"]["field"]
+        if campo in resultado["aggregations"]:
+            resultado["order_by"]["field"] = resultado["aggregations"][campo]["alias"]
+
+    if resultado["group_by"] and resultado["limit"] and not resultado["order_by"]:
+        for prioridad in ["beneficio", "pvp", "cantidad_en_stock", "count"]:
+            if prioridad in resultado["aggregations"]:
+                alias = resultado["aggregations"][prioridad]["alias"] if prioridad != "count" else resultado["aggregations"]["count"]["alias"]
+                resultado["order_by"] = {"field": alias, "direction": "desc"}
+                break
+
+    if not resultado["filters"] and not resultado["aggregations"] and not resultado["group_by"]:
+        resultado["order_by"] = {"field": "beneficio", "direction": "desc"}
+        resultado["limit"] = 10
+        resultado["assumed_default"] = True
+
+    return resultado
+
+
+class Traza:
+    """Tiempos por etapa y contadores de una ejecución de ``query_nl``."""
+
+    activa = True
+
+    def __init__(self) -> None:
+        self.etapas: Dict[str, float] = {}
+        self.contadores: Dict[str, int] = {}
+
+    @contextlib.contextmanager
+    def etapa(self, nombre: str) -> Iterator[None]:
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.etapas[nombre] = self.etapas.get(nombre, 0.0) + time.perf_counter() - inicio
+
+    def contar(self, nombre: str, cantidad: int) -> None:
+        self.contadores[nombre] = self.contadores.get(nombre, 0) + int(cantidad)
+
+    def resumen(self) -> Dict[str, Any]:
+        return {
+            "etapas_ms": {etapa: round(segundos * 1000, 3) for etapa, segundos in self.etapas.items()},
+            "contadores": dict(self.contadores),
+        }
+
+
+class TrazaNula(Traza):
+    """Traza que no mide nada, para cuando la instrumentación está desactivada."""
+
+    activa = False
+
+    def etapa(self, nombre: str) -> Any:
+        return contextlib.nullcontext()
+
+    def contar(self, nombre: str, cantidad: int) -> None:
+        pass
+
+
+TRAZA_NULA = TrazaNula()
+
+
+class ConsultaCancelada(Exception):
+    """Una ejecución ha superado su límite de tiempo o de memoria (véase ``LimitesConsulta``)."""
+
+
+class LimitesConsulta:
+    """Tiempo y memoria intermedia que puede gastar una ejecución.
+
+    Los recorridos llaman a ``comprobar`` entre fragmentos con los bytes que
+    retienen; al pasar de un límite lanza ``ConsultaCancelada`` y la consulta se
+    abandona sin terminar el recorrido. Con 0 el límite no se aplica.
+    """
+
+    def __init__(self, milisegundos: float = 0.0, memoria: int = 0) -> None:
+        self.milisegundos = milisegundos
+        self.fin = time.perf_counter() + milisegundos / 1000 if milisegundos else math.inf
+        self.memoria = memoria
+        self.retenidos = 0
+
+    @property
+    def activos(self) -> bool:
+        return self.fin < math.inf or self.memoria > 0
+
+    def comprobar(self, retenidos: int = 0) -> None:
+        if not self.activos:
+            return
+        self.retenidos += retenidos
+        if time.perf_counter() > self.fin:
+            raise ConsultaCancelada(f"la consulta superó el límite de tiempo de {self.milisegundos:.0f} ms")
+        if self.memoria and self.retenidos > self.memoria:
+            raise ConsultaCancelada(f"la consulta superó el límite de memoria de {self.memoria // 2 ** 20} MB")
+
+
+SIN_LIMITES = LimitesConsulta()
+
+
+def bytes_retenidos(datos: Any) -> int:
+    """Bytes de los arrays de un resultado parcial (diccionarios, listas y tuplas anidados)."""
+    if isinstance(datos, np.ndarray):
+        return datos.nbytes
+    if isinstance(datos, dict):
+        return sum(bytes_retenidos(valor) for valor in datos.values())
+    if isinstance(datos, (list, tuple)):
+        return sum(bytes_retenidos(valor) for valor in datos)
+    return 0
+
+
+class HistogramaLatencias:
+    """Histograma de latencias con cubetas fijas en escala logarítmica."""
+
+    LIMITES_MS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self) -> None:
+        self.cubetas = [0] * (len(self.LIMITES_MS) + 1)
+        self.cuenta = 0
+        self.total_ms = 0.0
+        self.maximo_ms = 0.0
+
+    def registrar(self, milisegundos: float) -> None:
+        self.cubetas[bisect.bisect_left(self.LIMITES_MS, milisegundos)] += 1
+        self.cuenta += 1
+        self.total_ms += milisegundos
+        self.maximo_ms = max(self.maximo_ms, milisegundos)
+
+    def percentil(self, fraccion: float) -> float:
+        """Estimación por arriba: el límite superior de la cubeta que alcanza la fracción."""
+        objetivo = fraccion * self.cuenta
+        acumulado = 0
+        for posicion, cantidad in enumerate(self.cubetas):
+            acumulado += cantidad
+            if acumulado >= objetivo and cantidad:
+                return self.LIMITES_MS[posicion] if posicion < len(self.LIMITES_MS) else self.maximo_ms
+        return 0.0
+
+    def resumen(self) -> Dict[str, Any]:
+        etiquetas = [f"<={limite}ms" for limite in self.LIMITES_MS] + [f">{self.LIMITES_MS[-1]}ms"]
+        return {
+            "cuenta": self.cuenta,
+            "media_ms": round(self.total_ms / self.cuenta, 3) if self.cuenta else 0.0,
+            "max_ms": round(self.maximo_ms, 3),
+            "p50_ms": self.percentil(0.5),
+            "p90_ms": self.percentil(0.9),
+            "p99_ms": self.percentil(0.99),
+            "cubetas": {etiqueta: cantidad for etiqueta, cantidad in zip(etiquetas, self.cubetas) if cantidad},
+        }
+
+
+class EstadisticasConsultas:
+    """Acumula las trazas de todas las consultas para la herramienta ``stats``."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reiniciar()
+
+    def reiniciar(self) -> None:
+        with self._lock:
+            self.consultas = 0
+            self.aciertos_cache = 0
+            self.histogramas: Dict[str, HistogramaLatencias] = {}
+            self.contadores: Dict[str, int] = {}
+            self.herramientas: Dict[str, HistogramaLatencias] = {}
+            self.rechazadas = 0
+            self.admision: Dict[str, int] = {}
+
+    def registrar(self, traza: Traza, acierto_cache: bool) -> None:
+        with self._lock:
+            self.consultas += 1
+            self.aciertos_cache += int(acierto_cache)
+            for etapa, segundos in traza.etapas.items():
+                self.histogramas.setdefault(etapa, HistogramaLatencias()).registrar(segundos * 1000)
+            for nombre, cantidad in traza.contadores.items():
+                self.contadores[nombre] = self.contadores.get(nombre, 0) + cantidad
+
+    def registrar_llamada(self, herramienta: str, milisegundos: float) -> None:
+        """Latencia de una llamada a ``herramienta``, incluida la espera de turno."""
+        with self._lock:
+            self.herramientas.setdefault(herramienta, HistogramaLatencias()).registrar(milisegundos)
+
+    def registrar_rechazo(self) -> None:
+        with self._lock:
+            self.rechazadas += 1
+
+    def registrar_admision(self, decision: str) -> None:
+        with self._lock:
+            self.admision[decision] = self.admision.get(decision, 0) + 1
+
+    def resumen(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "consultas": self.consultas,
+                "aciertos_cache": self.aciertos_cache,
+                "etapas": {etapa: histograma.resumen() for etapa, histograma in self.histogramas.items()},
+                "contadores": dict(self.contadores),
+                "herramientas": {nombre: histograma.resumen() for nombre, histograma in self.herramientas.items()},
+                "rechazadas": self.rechazadas,
+                "admision": dict(self.admision),
+            }
+
+
+COMPARADORES = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "=": operator.eq,
+}
+
+TIPOS_AGREGACION = ("count", "sum", "mean", "min", "max", "count_distinct", "percentile")
+
+
+def evaluar_filtro(filtro: Dict[str, Any], valor_fila: Any) -> bool:
+    """Evalúa un filtro sobre un único valor, con la semántica fila a fila."""
+    tipo_filtro = filtro["type"]
+    if tipo_filtro == "contains":
+        return normalizar_texto(str(filtro["value"])) in normalizar_texto(str(valor_fila))
+    if tipo_filtro in COMPARADORES:
+        try:
+            valor_num = float(valor_fila)
+        except (TypeError, ValueError):
+            return False
+        return COMPARADORES[tipo_filtro](valor_num, filtro["value"])
+    return True
+
+
+def comparacion_escalada(tipo: str, valor: float, escala: int) -> Tuple[str, float]:
+    """Comparación sobre enteros en unidades de ``1 / escala`` equivalente a comparar con ``valor``.
+
+    El dato ``c`` vale ``c / escala``: se compara ``c`` con el menor entero que
+    cumple la comparación, buscado junto a ``valor * escala`` porque ese producto
+    puede no ser exacto (0.29 * 100 = 28.999999999999996).
+    """
+    producto = valor * escala
+    if not abs(producto) < 2 ** 52:
+        return tipo, producto
+
+    def primero(cumple: Callable[[int], bool]) -> int:
+        entero = math.floor(producto) - 1
+        while not cumple(entero):
+            entero += 1
+        return entero
+
+    if tipo in (">", "<="):
+        limite = primero(lambda entero: entero / escala > valor)
+        return (">=" if tipo == ">" else "<"), limite
+    limite = primero(lambda entero: entero / escala >= valor)
+    if tipo == "=" and limite / escala != valor:
+        # Ningún entero vale exactamente ``valor``
+        return tipo, limite - 0.5
+    return tipo, limite
+
+
+def compilar_filtro(catalogo: Catalogo, filtro: Dict[str, Any]) -> Tuple[str, str, Any]:
+    """Reduce un filtro a una operación sobre los datos almacenados en su columna.
+
+    ``("comparar", campo, (tipo, valor))`` compara la columna numérica directamente,
+    ``("tabla", campo, coincidencias)`` proyecta por código una máscara calculada
+    sobre las categorías y ``("valores", campo, filtro)`` evalúa cada valor distinto.
+    El resultado no depende del catálogo y puede enviarse a otro proceso.
+    """
+    campo = filtro["field"]
+    if filtro["type"] in COMPARADORES and campo not in catalogo.categorias and campo != "fechacompra":
+        escala = catalogo.escala(campo)
+        if escala != 1:
+            return ("comparar", campo, comparacion_escalada(filtro["type"], filtro["value"], escala))
+        return ("comparar", campo, (filtro["type"], filtro["value"]))
+    if campo in catalogo.categorias:
+        if filtro["type"] == "contains":
+            coincidencias = catalogo.indices_texto[campo].buscar(normalizar_texto(str(filtro["value"])))
+        else:
+            distintos = catalogo.categorias[campo]
+            coincidencias = np.fromiter((evaluar_filtro(filtro, valor) for valor in distintos), dtype=bool, count=len(distintos))
+        return ("tabla", campo, coincidencias)
+    return ("valores", campo, filtro)
+
+
+def compilar_filtros(catalogo: Catalogo, filtros: List[Dict[str, Any]]) -> List[Tuple[str, str, Any]]:
+    """Compila los filtros aplicables al catálogo, más la exclusión de las filas borradas."""
+    compilados = [compilar_filtro(catalogo, filtro) for filtro in filtros if filtro["field"] in catalogo.columnas]
+    if catalogo.num_borradas:
+        compilados.insert(0, ("comparar", COLUMNA_BORRADA, ("=", False)))
+    return compilados
+
+
+def evaluar_compilado(compilado: Tuple[str, str, Any], columna: np.ndarray) -> np.ndarray:
+    """Máscara de un filtro compilado sobre los datos de su columna."""
+    tipo, campo, argumento = compilado
+    if tipo == "comparar":
+        return COMPARADORES[argumento[0]](columna, argumento[1])
+    if tipo == "tabla":
+        return argumento[columna]
+    # Se evalúa una vez por valor distinto y se proyecta a las filas
+    unicos, codigos = np.unique(columna, return_inverse=True)
+    distintos = [decodificar_dato(campo, dato, escala_columna(campo, columna)) for dato in unicos.tolist()]
+    coincidencias = np.fromiter((evaluar_filtro(argumento, valor) for valor in distintos), dtype=bool, count=len(distintos))
+    return coincidencias[codigos.ravel()]
+
+
+def mascara_filtro(catalogo: Catalogo, filtro: Dict[str, Any], filas: Optional[np.ndarray] = None) -> np.ndarray:
+    """Evalúa un filtro sobre una columna y devuelve una máscara booleana.
+
+    Si se indican ``filas`` la máscara se calcula solo sobre esas filas candidatas.
+    """
+    columna = catalogo.columnas[filtro["field"]]
+    if filas is not None:
+        columna = columna[filas]
+    return evaluar_compilado(compilar_filtro(catalogo, filtro), columna)
+
+
+def mascara_bloque(
+    columnas: Dict[str, np.ndarray],
+    compilados: List[Tuple[str, str, Any]],
+    inicio: Optional[int],
+    fin: Optional[int],
+    filas: Any,
+) -> np.ndarray:
+    """Máscara de filtros compilados y rango de fechas sobre un bloque de filas (slice o índices).
+
+    Los filtros se evalúan en el orden dado. Cuando pasan menos filas que
+    ``FRACCION_EVALUACION_DISPERSA``, los siguientes solo leen las que quedan.
+    """
+    if isinstance(filas, slice):
+        filas = slice(*filas.indices(len(columnas["fechacompra"]))[:2])
+        num_filas = filas.stop - filas.start
+    else:
+        num_filas = len(filas)
+    mascara = np.ones(num_filas, dtype=bool)
+    if inicio or fin:
+        fechas = columnas["fechacompra"][filas]
+        if inicio:
+            mascara &= fechas >= inicio
+        if fin:
+            mascara &= fechas <= fin
+    for posicion, compilado in enumerate(compilados):
+        pasan = np.count_nonzero(mascara)
+        if not pasan:
+            break
+        if pasan < num_filas * FRACCION_EVALUACION_DISPERSA:
+            vivas = np.flatnonzero(mascara)
+            posiciones = vivas + filas.start if isinstance(filas, slice) else filas[vivas]
+            for siguiente in compilados[posicion:]:
+                cumple = evaluar_compilado(siguiente, columnas[siguiente[1]][posiciones])
+                vivas, posiciones = vivas[cumple], posiciones[cumple]
+                if not len(vivas):
+                    break
+            mascara = np.zeros(num_filas, dtype=bool)
+            mascara[vivas] = True
+            break
+        mascara &= evaluar_compilado(compilado, columnas[compilado[1]][filas])
+    return mascara
+
+
+def ordinales_rango(rango_fechas: List[Optional[str]]) -> Tuple[Optional[int], Optional[int]]:
+    inicio = datetime.date.fromisoformat(rango_fechas[0]).toordinal() if rango_fechas[0] else None
+    fin = datetime.date.fromisoformat(rango_fechas[1]).toordinal() if rango_fechas[1] else None
+    return inicio, fin
+
+
+def aplicar_filtros(
+    catalogo: Catalogo, plan: "PlanFisico", traza: Traza = TRAZA_NULA, limites: LimitesConsulta = SIN_LIMITES
+) -> np.ndarray:
+    """Devuelve, en orden, los índices de las filas que cumplen los predicados de un plan.
+
+    Con el índice de fechas los predicados solo se evalúan sobre las filas del
+    rango. Si no, se recorren las columnas (en serie también cuando el plan es
+    paralelo) y, con ``plan.limite`` o con ``limites``, por bloques: hasta reunir
+    esas filas o comprobando los límites entre bloque y bloque.
+    """
+    limite = plan.limite
+    if plan.acceso == "indice_fechas":
+        candidatos = catalogo.filas_en_rango(*plan.rango, forzar=True)
+        traza.contar("filas_escaneadas", len(candidatos))
+        limites.comprobar(candidatos.nbytes)
+        for compilado in plan.compilados:
+            if not len(candidatos):
+                break
+            candidatos = candidatos[evaluar_compilado(compilado, catalogo.columnas[compilado[1]][candidatos])]
+            limites.comprobar()
+        return candidatos if limite is None else candidatos[:limite]
+    if limite is None:
+        traza.contar("filas_escaneadas", len(catalogo))
+        if not limites.activos:
+            return np.flatnonzero(mascara_bloque(catalogo.columnas, plan.compilados, None, None, slice(None)))
+        mascara = np.empty(len(catalogo), dtype=bool)
+        for desde in range(0, len(catalogo), TAMANO_FRAGMENTO):
+            limites.comprobar()
+            trozo = slice(desde, desde + TAMANO_FRAGMENTO)
+            mascara[trozo] = mascara_bloque(catalogo.columnas, plan.compilados, None, None, trozo)
+        indices = np.flatnonzero(mascara)
+        limites.comprobar(indices.nbytes)
+        return indices
+    encontrados = []
+    total = 0
+    for desde in range(0, len(catalogo), TAMANO_BLOQUE):
+        if total >= limite:
+            break
+        limites.comprobar()
+        mascara = mascara_bloque(catalogo.columnas, plan.compilados, None, None, slice(desde, desde + TAMANO_BLOQUE))
+        traza.contar("filas_escaneadas", len(mascara))
+        encontrados.append(np.flatnonzero(mascara) + desde)
+        total += len(encontrados[-1])
+        limites.comprobar(encontrados[-1].nbytes)
+    if not encontrados:
+        return np.zeros(0, dtype=np.intp)
+    return np.concatenate(encontrados)[:limite]
+
+
+def redondear_importe(valor: float) -> float:
+    return float(f"{round(valor, 2):.2f}")
+
+
+def numerar_claves(claves: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Numera las claves por orden de primera aparición.
+
+    ``claves`` es un vector o una matriz con una fila por elemento. Devuelve la
+    posición de la primera aparición de cada grupo y el grupo de cada elemento;
+    una matriz sin columnas forma un único grupo (ninguno si está vacía).
+    """
+    if claves.ndim == 2 and claves.shape[1] == 0:
+        return np.zeros(min(len(claves), 1), dtype=np.intp), np.zeros(len(claves), dtype=np.intp)
+    if claves.ndim == 2 and claves.shape[1] == 1:
+        claves = claves[:, 0]
+    _, primeras, inversa = np.unique(claves, return_index=True, return_inverse=True, axis=0 if claves.ndim == 2 else None)
+    orden = np.argsort(primeras)
+    rango = np.empty(len(orden), dtype=np.intp)
+    rango[orden] = np.arange(len(orden))
+    return primeras[orden], rango[inversa.ravel()]
+
+
+def agregar_fragmento(
+    columnas: Dict[str, np.ndarray],
+    filas: np.ndarray,
+    group_by: List[str],
+    cardinalidades: List[Optional[int]],
+    agregaciones: Dict[str, Dict[str, Any]],
+) -> Dict[str, Any]:
+    """Agregados parciales de las filas de un fragmento (índices globales y ordenados).
+
+    Las claves de grupo se devuelven con los datos almacenados (códigos en los campos
+    de texto) y ``primeras`` guarda la fila donde aparece cada grupo por primera vez.
+    ``cardinalidades`` indica el número de categorías de cada campo de agrupación
+    (``None`` si no es categórico) para combinar los códigos en un único entero.
+    """
+    if group_by and None not in cardinalidades and np.prod([float(c) for c in cardinalidades]) < 2 ** 62:
+        claves_filas = np.zeros(len(filas), dtype=np.int64)
+        for campo, cardinalidad in zip(group_by, cardinalidades):
+            claves_filas = claves_filas * cardinalidad + columnas[campo][filas]
+    else:
+        claves_filas = np.zeros((len(filas), len(group_by)))
+        for posicion, campo in enumerate(group_by):
+            claves_filas[:, posicion] = columnas[campo][filas]
+    primeras, grupos = numerar_claves(claves_filas)
+    representantes = filas[primeras]
+    num_grupos = len(primeras)
+    claves = np.zeros((num_grupos, len(group_by)))
+    for posicion, campo in enumerate(group_by):
+        claves[:, posicion] = columnas[campo][representantes]
+    parcial: Dict[str, Any] = {
+        "claves": claves,
+        "primeras": representantes,
+        "conteos": np.bincount(grupos, minlength=num_grupos),
+        "valores": {},
+        "pares": {},
+    }
+    for campo, info in agregaciones.items():
+        if campo == "count":
+            continue
+        valores = columnas[campo][filas]
+        escala = escala_columna(campo, columnas[campo])
+        if escala != 1 and info["type"] != "count_distinct":
+            # Se agregan los importes en euros, igual que si se guardaran así
+            valores = valores / escala
+        if info["type"] in ("sum", "mean"):
+            parcial["valores"][campo] = np.bincount(grupos, weights=valores, minlength=num_grupos)
+        elif info["type"] == "min":
+            minimos = np.full(num_grupos, np.inf)
+            np.minimum.at(minimos, grupos, valores)
+            parcial["valores"][campo] = minimos
+        elif info["type"] == "max":
+            maximos = np.full(num_grupos, -np.inf)
+            np.maximum.at(maximos, grupos, valores)
+            parcial["valores"][campo] = maximos
+        elif info["type"] == "count_distinct":
+            unicos, codigos = np.unique(valores, return_inverse=True)
+            pares = np.unique(grupos.astype(np.int64) * len(unicos) + codigos.ravel())
+            parcial["pares"][campo] = (pares // max(len(unicos), 1), unicos[pares % max(len(unicos), 1)])
+        elif info["type"] == "percentile":
+            # El percentil necesita todos los valores: se ordenan al combinar
+            parcial["pares"][campo] = (grupos, valores)
+    return parcial
+
+
+def orden_por_grupo(grupos: np.ndarray, valores: np.ndarray) -> np.ndarray:
+    """Posiciones que ordenan por grupo y, dentro de cada grupo, por valor.
+
+    Ordenar los valores y después los grupos con una ordenación estable es
+    bastante más rápido que ``np.lexsort``; el orden de los empates no importa.
+    """
+    orden = np.argsort(valores)
+    if len(grupos) and grupos.max() > 0:
+        orden = orden[np.argsort(grupos[orden], kind="stable")]
+    return orden
+
+
+def percentiles_por_grupo(grupos: np.ndarray, valores: np.ndarray, num_grupos: int, fraccion: float) -> np.ndarray:
+    """Percentil de cada grupo: el menor valor con al menos ``fraccion`` de los del grupo a su altura o por debajo.
+
+    Los grupos sin valores quedan en NaN.
+    """
+    orden = orden_por_grupo(grupos, valores)
+    conteos = np.bincount(grupos, minlength=num_grupos)
+    inicios = np.cumsum(conteos) - conteos
+    # El margen evita que 0.9 * 10 = 9.000000000000002 suba al siguiente rango
+    rangos = np.maximum(np.ceil(fraccion * conteos - 1e-9).astype(np.int64) - 1, 0)
+    resultado = np.full(num_grupos, np.nan)
+    con_valores = conteos > 0
+    resultado[con_valores] = valores[orden[inicios[con_valores] + rangos[con_valores]]]
+    return resultado
+
+
+def combinar_parciales(parciales: List[Dict[str, Any]], agregaciones: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Une los agregados parciales de fragmentos consecutivos, dados en el orden de las filas.
+
+    ``np.add.at`` acumula las entradas en orden, así que cada suma se obtiene
+    fragmento a fragmento siempre de la misma manera, con o sin procesos.
+    """
+    claves = np.concatenate([parcial["claves"] for parcial in parciales])
+    primeras, grupos = numerar_claves(claves)
+    num_grupos = len(primeras)
+    conteos = np.zeros(num_grupos, dtype=np.int64)
+    np.add.at(conteos, grupos, np.concatenate([parcial["conteos"] for parcial in parciales]))
+    resultado: Dict[str, Any] = {"claves": claves[primeras], "conteos": conteos, "valores": {}, "totales": {}}
+    desplazamientos = np.cumsum([0] + [len(parcial["conteos"]) for parcial in parciales])
+    for campo, info in agregaciones.items():
+        if campo == "count":
+            continue
+        if info["type"] == "count_distinct":
+            grupos_pares = np.concatenate([
+                grupos[desplazamiento + parcial["pares"][campo][0]]
+                for desplazamiento, parcial in zip(desplazamientos, parciales)
+            ])
+            unicos, codigos = np.unique(np.concatenate([parcial["pares"][campo][1] for parcial in parciales]), return_inverse=True)
+            pares = np.unique(grupos_pares.astype(np.int64) * len(unicos) + codigos.ravel())
+            resultado["valores"][campo] = np.bincount(pares // max(len(unicos), 1), minlength=num_grupos)
+            resultado["totales"][campo] = len(unicos)
+            continue
+        if info["type"] == "percentile":
+            grupos_valores = np.concatenate([
+                grupos[desplazamiento + parcial["pares"][campo][0]]
+                for desplazamiento, parcial in zip(desplazamientos, parciales)
+            ])
+            valores = np.concatenate([parcial["pares"][campo][1] for parcial in parciales])
+            resultado["valores"][campo] = percentiles_por_grupo(grupos_valores, valores, num_grupos, info["fraction"])
+            resultado["totales"][campo] = percentiles_por_grupo(np.zeros(len(valores), dtype=np.int64), valores, 1, info["fraction"])[0]
+            continue
+        parciales_campo = np.concatenate([parcial["valores"][campo] for parcial in parciales])
+        if info["type"] == "min":
+            acumulado = np.full(num_grupos, np.inf)
+            np.minimum.at(acumulado, grupos, parciales_campo)
+        elif info["type"] == "max":
+            acumulado = np.full(num_grupos, -np.inf)
+            np.maximum.at(acumulado, grupos, parciales_campo)
+        else:
+            acumulado = np.zeros(num_grupos)
+            np.add.at(acumulado, grupos, parciales_campo)
+        resultado["valores"][campo] = acumulado
+    return resultado
+
+
+def especificacion_grupos(catalogo: Catalogo, group_by: List[str]) -> List[Optional[int]]:
+    return [len(catalogo.categorias[campo]) if campo in catalogo.categorias else None for campo in group_by]
+
+
+def decodificar_claves(catalogo: Catalogo, group_by: List[str], agregados: Dict[str, Any]) -> Dict[str, Any]:
+    """Sustituye la matriz de claves de ``combinar_parciales`` por tuplas de valores originales."""
+    columnas_clave = [
+        [catalogo.decodificar(campo, dato) for dato in agregados["claves"][:, posicion].tolist()]
+        for posicion, campo in enumerate(group_by)
+    ]
+    agregados["claves"] = list(zip(*columnas_clave)) if group_by else [()] * len(agregados["conteos"])
+    return agregados
+
+
+def calcular_agregados(
+    catalogo: Catalogo,
+    indices: np.ndarray,
+    group_by: List[str],
+    agregaciones: Dict[str, Dict[str, Any]],
+    limites: LimitesConsulta = SIN_LIMITES,
+) -> Dict[str, Any]:
+    """Calcula conteos y agregados por grupo con una pasada vectorizada por campo.
+
+    Las filas se agregan por fragmentos de ``TAMANO_FRAGMENTO`` filas del catálogo,
+    los mismos que reparte la ejecución en paralelo, y los parciales se combinan en
+    orden; con un único fragmento las sumas coinciden con el bucle fila a fila.
+    Entre fragmento y fragmento se comprueban ``limites``.
+    """
+    cortes = np.searchsorted(indices, np.arange(TAMANO_FRAGMENTO, len(catalogo), TAMANO_FRAGMENTO))
+    cardinalidades = especificacion_grupos(catalogo, group_by)
+    parciales = []
+    for trozo in np.split(indices, cortes):
+        parciales.append(agregar_fragmento(catalogo.columnas, trozo, group_by, cardinalidades, agregaciones))
+        limites.comprobar(bytes_retenidos(parciales[-1]))
+    return decodificar_claves(catalogo, group_by, combinar_parciales(parciales, agregaciones))
+
+
+class Rollup:
+    """Conteos y sumas precalculados por combinación de ``CAMPOS_ROLLUP`` y día de compra.
+
+    Cada celda reúne las filas vivas con las mismas categorías y la misma
+    ``fechacompra``. Guarda cuántas son, la primera de ellas (para devolver los
+    grupos en su orden de aparición) y la suma exacta de cada campo de
+    ``AGGREGATION_SYNONYMS``, en céntimos (o unidades, el stock). Los cambios en
+    el catálogo se aplican celda a celda.
+    """
+
+    def __init__(self, catalogo: Catalogo) -> None:
+        self.campos = tuple(campo for campo in CAMPOS_ROLLUP if campo in catalogo.categorias)
+        filas = catalogo.filas_vivas()
+        # Solo se precalculan los campos cuyos valores son céntimos exactos
+        self.escalas: Dict[str, int] = {}
+        for campo in AGGREGATION_SYNONYMS:
+            valores = catalogo.columnas[campo][filas]
+            escala = 1 if valores.dtype.kind in "iu" else ESCALA_IMPORTES
+            if escala == 1 or np.array_equal(np.rint(valores * escala) / escala, valores):
+                self.escalas[campo] = escala
+        fechas = catalogo.columnas["fechacompra"][filas].astype(np.int64)
+        primer_dia = int(fechas.min()) if len(fechas) else 0
+        dias = int(fechas.max()) - primer_dia + 1 if len(fechas) else 1
+        combinado = np.zeros(len(filas), dtype=np.int64)
+        for campo in self.campos:
+            combinado = combinado * len(catalogo.categorias[campo]) + catalogo.columnas[campo][filas]
+        _, primeras, celdas = np.unique(combinado * dias + (fechas - primer_dia), return_index=True, return_inverse=True)
+        celdas = celdas.ravel()
+        representantes = filas[primeras]
+        self.num_celdas = len(primeras)
+        self.codigos = np.zeros((self.num_celdas, len(self.campos)), dtype=np.int64)
+        for posicion, campo in enumerate(self.campos):
+            self.codigos[:, posicion] = catalogo.columnas[campo][representantes]
+        self.dias = catalogo.columnas["fechacompra"][representantes].astype(np.int64)
+        self.primeras = representantes.astype(np.int64)
+        self.conteos = np.bincount(celdas, minlength=self.num_celdas).astype(np.int64)
+        self.sumas = {
+            campo: np.rint(np.bincount(celdas, weights=catalogo.columnas[campo][filas] * escala, minlength=self.num_celdas)).astype(np.int64)
+            for campo, escala in self.escalas.items()
+        }
+        # Celda de cada combinación de códigos y día; la comparten todas las copias
+        self._indice: Optional[Dict[bytes, int]] = None
+        # Los arrays son solo de esta copia y los de repuesto con las celdas que les faltan (véase ``_propios``)
+        self._arrays_propios = True
+        self._repuesto: Optional[Tuple[Dict[str, np.ndarray], set, int, int]] = None
+        self._generacion = self._desde = 0
+        self._leidas: Optional[frozenset] = None
+
+    def copia(self, generacion: int, leidas: Optional[frozenset] = None) -> "Rollup":
+        """Copia para la instantánea ``generacion`` del catálogo, que copia los arrays al modificarlos.
+
+        Los arrays de repuesto pasan a la copia, que solo escribe en ellos si no
+        los usa ninguna de las generaciones ``leidas`` (véase ``Catalogo.instantanea``).
+        """
+        copia = copy.copy(self)
+        copia.sumas = dict(self.sumas)
+        copia.escalas = dict(self.escalas)
+        copia._arrays_propios = False
+        copia._generacion = generacion
+        copia._leidas = leidas
+        self._repuesto = None
+        return copia
+
+    def _arrays(self) -> Dict[str, np.ndarray]:
+        return {"codigos": self.codigos, "dias": self.dias, "primeras": self.primeras, "conteos": self.conteos, **self.sumas}
+
+    def _propios(self, celda: int) -> None:
+        """Deja los arrays listos para modificar ``celda`` sin alterar los de otras instantáneas.
+
+        Como las columnas del catálogo (``Catalogo._columna_propia``), la primera
+        modificación de una copia escribe en los arrays de repuesto, si los hay, y
+        solo les pone al día las celdas que cambiaron desde que se usaron.
+        """
+        if not self._arrays_propios:
+            actuales = self._arrays()
+            repuestos, pendientes, desde, hasta = self._repuesto or ({}, set(), 0, -1)
+            if not sin_lecturas(desde, hasta, self._leidas):
+                repuestos = {}
+            celdas = np.fromiter(pendientes, dtype=np.intp, count=len(pendientes))
+            propios = {}
+            for nombre, valores in actuales.items():
+                repuesto = repuestos.get(nombre)
+                if repuesto is not None and repuesto.shape == valores.shape and repuesto.dtype == valores.dtype:
+                    repuesto[celdas] = valores[celdas]
+                    propios[nombre] = repuesto
+                else:
+                    propios[nombre] = valores.copy()
+            self.codigos, self.dias, self.primeras, self.conteos = (propios.pop(nombre) for nombre in ("codigos", "dias", "primeras", "conteos"))
+            self.sumas = propios
+            self._repuesto = (actuales, set(), self._desde, self._generacion - 1)
+            self._desde = self._generacion
+            self._arrays_propios = True
+        if self._repuesto is not None:
+            self._repuesto[1].add(celda)
+
+    def _celda(self, catalogo: Catalogo, fila: int, crear: bool) -> int:
+        """Celda de una fila; con ``crear``, se añade si aún no existe."""
+        num_celdas = self.num_celdas
+        if self._indice is None:
+            claves = np.column_stack([self.codigos[:num_celdas], self.dias[:num_celdas]]).astype(np.int64)
+            self._indice = dict(zip(claves.view(np.dtype((np.void, claves.shape[1] * 8))).ravel().tolist(), range(num_celdas)))
+        clave = np.array([*(catalogo.columnas[campo][fila] for campo in self.campos), catalogo.columnas["fechacompra"][fila]], dtype=np.int64)
+        celda = self._indice.get(clave.tobytes())
+        # Una copia descartada pudo añadir al índice compartido celdas que esta no tiene
+        if celda is not None and (celda >= num_celdas or self.dias[celda] != clave[-1] or (self.codigos[celda] != clave[:-1]).any()):
+            celda = None
+        if celda is None and crear:
+            if num_celdas == len(self.dias):
+                capacidad = 2 * num_celdas + 1
+                self.codigos = np.resize(self.codigos, (capacidad, len(self.campos)))
+                self.dias, self.primeras, self.conteos = (np.resize(array, capacidad) for array in (self.dias, self.primeras, self.conteos))
+                self.sumas = {campo: np.resize(sumas, capacidad) for campo, sumas in self.sumas.items()}
+                self._arrays_propios, self._repuesto, self._desde = True, None, self._generacion
+            self._propios(num_celdas)
+            celda = self._indice[clave.tobytes()] = num_celdas
+            self.num_celdas += 1
+            self.codigos[celda] = clave[:-1]
+            self.dias[celda] = clave[-1]
+            self.primeras[celda] = fila
+            self.conteos[celda] = 0
+            for sumas in self.sumas.values():
+                sumas[celda] = 0
+        return celda
+
+    def _sumar(self, celda: int, campo: str, valor: float, signo: int) -> None:
+        escala = self.escalas[campo]
+        unidades = round(valor * escala)
+        if unidades / escala != valor:
+            # Un valor que no es un céntimo exacto deja el campo fuera del rollup
+            del self.escalas[campo], self.sumas[campo]
+            return
+        self.sumas[campo][celda] += signo * unidades
+
+    def sumar_fila(self, catalogo: Catalogo, fila: int, signo: int) -> None:
+        """Suma (``signo`` 1) una fila añadida o resta (``signo`` -1) una fila borrada."""
+        celda = self._celda(catalogo, fila, crear=signo > 0)
+        self._propios(celda)
+        self.conteos[celda] += signo
+        for campo in list(self.escalas):
+            self._sumar(celda, campo, catalogo.columnas[campo][fila].item(), signo)
+        if signo < 0 and self.primeras[celda] == fila:
+            self._recalcular_primera(catalogo, celda)
+
+    def modificar_fila(self, catalogo: Catalogo, fila: int, anteriores: Dict[str, Any]) -> None:
+        """Aplica a la celda de ``fila`` el cambio de sus valores respecto a ``anteriores``."""
+        celda = self._celda(catalogo, fila, crear=False)
+        self._propios(celda)
+        for campo in list(self.escalas):
+            self._sumar(celda, campo, anteriores[campo], -1)
+            if campo in self.escalas:
+                self._sumar(celda, campo, catalogo.columnas[campo][fila].item(), 1)
+
+    def _recalcular_primera(self, catalogo: Catalogo, celda: int) -> None:
+        dia = int(self.dias[celda])
+        candidatos = catalogo.filas_en_rango(dia, dia)
+        if candidatos is None:
+            candidatos = np.flatnonzero(catalogo.columnas["fechacompra"] == dia)
+        mascara = np.ones(len(candidatos), dtype=bool)
+        for posicion, campo in enumerate(self.campos):
+            mascara &= catalogo.columnas[campo][candidatos] == self.codigos[celda, posicion]
+        if catalogo.num_borradas:
+            mascara &= ~catalogo.columnas[COLUMNA_BORRADA][candidatos]
+        restantes = candidatos[mascara]
+        self.primeras[celda] = restantes[0] if len(restantes) else np.iinfo(np.int64).max
+
+    def cubre(self, catalogo: Catalogo, contexto: Dict[str, Any]) -> bool:
+        """Indica si el plan se puede responder solo con las celdas."""
+        campos = set(contexto["group_by"])
+        campos.update(filtro["field"] for filtro in contexto["filters"] if filtro["field"] in catalogo.columnas)
+        if not contexto["group_by"] or not campos <= set(self.campos):
+            return False
+        return all(
+            campo == "count" or (campo in self.escalas and info["type"] in ("sum", "mean"))
+            for campo, info in contexto["aggregations"].items()
+        )
+
+    def _numerar_grupos(
+        self, catalogo: Catalogo, group_by: List[str], claves: np.ndarray, primeras: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Numera los grupos de unas celdas por orden de la primera fila de cada grupo.
+
+        Devuelve el grupo de cada celda y una celda de cada grupo. Si las
+        combinaciones posibles de códigos no son muchas, se indexa por el código
+        combinado sin ordenar las celdas.
+        """
+        tamanos = [len(catalogo.categorias[campo]) for campo in group_by]
+        espacio = math.prod(tamanos)
+        if espacio <= max(4 * len(claves), 1 << 16):
+            combinados = np.zeros(len(claves), dtype=np.int64)
+            for posicion, tamano in enumerate(tamanos):
+                combinados = combinados * tamano + claves[:, posicion]
+        else:
+            _, combinados = np.unique(claves, axis=0, return_inverse=True)
+            combinados = combinados.ravel()
+            espacio = int(combinados.max()) + 1 if len(combinados) else 0
+        sin_filas = np.iinfo(np.int64).max
+        primera = np.full(espacio, sin_filas, dtype=np.int64)
+        np.minimum.at(primera, combinados, primeras)
+        presentes = np.flatnonzero(primera != sin_filas)
+        presentes = presentes[np.argsort(primera[presentes])]
+        numeros = np.empty(espacio, dtype=np.intp)
+        numeros[presentes] = np.arange(len(presentes))
+        grupos = numeros[combinados]
+        representantes = np.empty(len(presentes), dtype=np.intp)
+        representantes[grupos] = np.arange(len(grupos))
+        return grupos, representantes
+
+    def agregar(self, catalogo: Catalogo, contexto: Dict[str, Any], traza: Traza = TRAZA_NULA) -> Dict[str, Any]:
+        """Agregados de un plan cubierto, con el formato de ``calcular_agregados``."""
+        num_celdas = self.num_celdas
+        codigos = self.codigos[:num_celdas]
+        seleccion = self.conteos[:num_celdas] > 0
+        inicio, fin = ordinales_rango(contexto["date_range"])
+        if inicio:
+            seleccion &= self.dias[:num_celdas] >= inicio
+        if fin:
+            seleccion &= self.dias[:num_celdas] <= fin
+        for filtro in contexto["filters"]:
+            if filtro["field"] in catalogo.columnas:
+                _, campo, coincidencias = compilar_filtro(catalogo, filtro)
+                seleccion &= coincidencias[codigos[:, self.campos.index(campo)]]
+        celdas = np.flatnonzero(seleccion)
+        traza.contar("celdas_rollup", len(celdas))
+        claves = np.column_stack([codigos[celdas, self.campos.index(campo)] for campo in contexto["group_by"]])
+        grupos, representantes = self._numerar_grupos(catalogo, contexto["group_by"], claves, self.primeras[celdas])
+        num_grupos = len(representantes)
+        agregados: Dict[str, Any] = {
+            "claves": claves[representantes].astype(np.float64),
+            "conteos": np.bincount(grupos, weights=self.conteos[celdas], minlength=num_grupos).astype(np.int64),
+            "valores": {},
+            "totales": {},
+        }
+        for campo in contexto["aggregations"]:
+            if campo != "count":
+                sumas = np.bincount(grupos, weights=self.sumas[campo][celdas], minlength=num_grupos)
+                agregados["valores"][campo] = sumas / (self.escalas[campo] * catalogo.escala(campo))
+        return decodificar_claves(catalogo, contexto["group_by"], agregados)
+
+
+CANDADO_ROLLUP = threading.Lock()
+
+
+def evaluar_rollup(catalogo: Catalogo) -> None:
+    rollup = Rollup(catalogo)
+    if rollup.num_celdas <= FRACCION_MAXIMA_ROLLUP * (len(catalogo) - catalogo.num_borradas):
+        catalogo.rollup = rollup
+    catalogo.rollup_evaluado = True
+
+
+def rollup_para_plan(catalogo: Catalogo, contexto: Dict[str, Any]) -> Optional[Rollup]:
+    """Planificador: el rollup que responde el plan, o ``None`` si hay que recorrer filas.
+
+    El rollup se construye la primera vez que llega un plan agrupado que podría
+    usarlo y se descarta si tiene tantas celdas que no ahorraría trabajo.
+    """
+    if not contexto["group_by"] or not set(contexto["group_by"]) <= set(CAMPOS_ROLLUP):
+        return None
+    catalogo.rollup_pedido.set()
+    # Lo construye una sola consulta, sobre la instantánea vigente; las demás recorren filas
+    if not catalogo.rollup_evaluado and not catalogo.sustituida and CANDADO_ROLLUP.acquire(blocking=False):
+        try:
+            if not catalogo.rollup_evaluado:
+                evaluar_rollup(catalogo)
+        finally:
+            CANDADO_ROLLUP.release()
+    if catalogo.rollup is None or not catalogo.rollup.cubre(catalogo, contexto):
+        return None
+    return catalogo.rollup
+
+
+def hash_codigos(codigos: np.ndarray) -> np.ndarray:
+    """Mezcla splitmix64 de enteros: reparte los códigos uniformemente en 64 bits."""
+    x = codigos.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def posiciones_hll(codigos: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Registro del HyperLogLog de cada código y rango (posición de su primer bit a 1)."""
+    hashes = hash_codigos(codigos)
+    registros = (hashes >> np.uint64(64 - BITS_HLL)).astype(np.intp)
+    resto = hashes & np.uint64((1 << (64 - BITS_HLL)) - 1)
+    # ``frexp`` devuelve la longitud en bits del resto (0 si es 0)
+    _, bits = np.frexp(resto.astype(np.float64))
+    return registros, (64 - BITS_HLL - bits + 1).astype(np.uint8)
+
+
+def estimar_hll(registros: np.ndarray) -> np.ndarray:
+    """Cardinalidad estimada de cada fila de una matriz de registros HyperLogLog."""
+    m = registros.shape[-1]
+    bruta = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -registros.astype(np.int64)), axis=-1)
+    vacios = np.count_nonzero(registros == 0, axis=-1)
+    # Con pocos valores es más precisa la cuenta de registros vacíos
+    lineal = m * np.log(m / np.maximum(vacios, 1))
+    return np.where((bruta <= 2.5 * m) & (vacios > 0), lineal, bruta)
+
+
+def percentiles_ponderados(
+    grupos: np.ndarray, valores: np.ndarray, pesos: np.ndarray, num_grupos: int, fracciones: List[np.ndarray]
+) -> List[np.ndarray]:
+    """Versión de ``percentiles_por_grupo`` en la que cada valor cuenta según su peso.
+
+    Calcula de una vez los percentiles de cada vector de ``fracciones`` (una por
+    grupo). Con todos los pesos iguales coincide con ``percentiles_por_grupo``.
+    """
+    orden = orden_por_grupo(grupos, valores)
+    ordenados = valores[orden]
+    acumulado = np.concatenate([[0.0], np.cumsum(pesos[orden])])
+    conteos = np.bincount(grupos, minlength=num_grupos)
+    finales = np.cumsum(conteos)
+    iniciales = finales - conteos
+    base = acumulado[iniciales]
+    total = acumulado[finales] - base
+    con_valores = conteos > 0
+    resultados = []
+    for fraccion in fracciones:
+        # El primer valor cuyo peso acumulado alcanza la fracción; el margen evita
+        # que 0.9 * 10 = 9.000000000000002 suba al siguiente
+        posiciones = np.searchsorted(acumulado, base + fraccion * total - 1e-9 * total) - 1
+        posiciones = np.clip(posiciones, iniciales, np.maximum(finales - 1, iniciales))
+        resultado = np.full(num_grupos, np.nan)
+        resultado[con_valores] = ordenados[posiciones[con_valores]]
+        resultados.append(resultado)
+    return resultados
+
+
+class Sinopsis:
+    """Muestra estratificada y sketches del catálogo para el modo aproximado de ``query_nl``.
+
+    Los estratos son las combinaciones de ``CAMPOS_ROLLUP``. De cada uno se guarda
+    cuántas filas vivas tiene, una muestra uniforme de ellas y un HyperLogLog de
+    cada campo de texto. La muestra de un estrato son las filas con los menores
+    números aleatorios, de modo que se mantiene al añadir y borrar filas, y su
+    tamaño es proporcional al del estrato, con al menos ``MINIMO_ESTRATO`` filas.
+    Se guardan posiciones, ordenadas: los valores se leen de las columnas y los
+    cambios de valores no necesitan mantenimiento.
+    """
+
+    def __init__(self, catalogo: Catalogo) -> None:
+        self.campos = tuple(campo for campo in CAMPOS_ROLLUP if campo in catalogo.categorias)
+        filas = catalogo.filas_vivas()
+        self.filas_iniciales = len(filas)
+        self.bajas = 0
+        tamanos = [len(catalogo.categorias[campo]) for campo in self.campos]
+        combinados = np.zeros(len(filas), dtype=np.int64)
+        for campo, tamano in zip(self.campos, tamanos):
+            combinados = combinados * tamano + catalogo.columnas[campo][filas]
+        espacio = math.prod(tamanos)
+        if espacio <= max(4 * len(filas), 1 << 16):
+            presentes = np.flatnonzero(np.bincount(combinados, minlength=espacio))
+            mapa = np.zeros(espacio, dtype=np.int64)
+            mapa[presentes] = np.arange(len(presentes))
+            estratos = mapa[combinados]
+        else:
+            presentes, estratos = np.unique(combinados, return_inverse=True)
+            estratos = estratos.ravel()
+        self.codigos = np.zeros((len(presentes), len(self.campos)), dtype=np.int64)
+        resto = presentes.copy()
+        for posicion in reversed(range(len(self.campos))):
+            resto, self.codigos[:, posicion] = np.divmod(resto, tamanos[posicion])
+        self._estratos = {tuple(clave): estrato for estrato, clave in enumerate(self.codigos.tolist())}
+        num_estratos = len(presentes)
+        self.poblacion = np.bincount(estratos, minlength=num_estratos).astype(np.int64)
+        proporcional = np.ceil(MUESTRA_APROXIMADA * self.poblacion / max(len(filas), 1))
+        self.objetivo = np.minimum(self.poblacion, np.maximum(proporcional, MINIMO_ESTRATO)).astype(np.int64)
+
+        self._azar = np.random.default_rng(SEMILLA_SINTETICA)
+        azar = self._azar.random(len(filas))
+        # Se ordenan solo las candidatas con un número bajo; si algún estrato no reúne
+        # las suficientes, se toman todas sus filas
+        umbral = np.minimum(1.0, 2.0 * self.objetivo / np.maximum(self.poblacion, 1) + 1e-3)
+        while True:
+            candidatas = np.flatnonzero(azar < umbral[estratos])
+            conteos = np.bincount(estratos[candidatas], minlength=num_estratos)
+            cortos = conteos < self.objetivo
+            if not cortos.any():
+                break
+            umbral[cortos] = 1.0
+        candidatas = candidatas[np.lexsort((azar[candidatas], estratos[candidatas]))]
+        estratos_candidatas = estratos[candidatas]
+        rangos = np.arange(len(candidatas)) - (np.cumsum(conteos) - conteos)[estratos_candidatas]
+        elegidas = np.sort(candidatas[rangos < self.objetivo[estratos_candidatas]])
+        self.filas = filas[elegidas].astype(np.int64)
+        self.estratos = estratos[elegidas].astype(np.int64)
+        self.azar = azar[elegidas]
+
+        self.registros = np.zeros((len(CAMPOS_TEXTO), num_estratos, 1 << BITS_HLL), dtype=np.uint8)
+        self._registros_propios = True
+        for posicion, campo in enumerate(CAMPOS_TEXTO):
+            categorias = max(len(catalogo.categorias[campo]), 1)
+            pares = estratos * categorias + catalogo.columnas[campo][filas]
+            if num_estratos * categorias <= max(4 * len(filas), 1 << 16):
+                pares = np.flatnonzero(np.bincount(pares, minlength=num_estratos * categorias))
+            else:
+                pares = np.unique(pares)
+            self._anotar(posicion, pares // categorias, pares % categorias)
+
+    def copia(self) -> "Sinopsis":
+        """Copia para otra instantánea; los registros HyperLogLog se copian al modificarlos."""
+        copia = copy.copy(self)
+        copia.poblacion = self.poblacion.copy()
+        copia._estratos = dict(self._estratos)
+        copia._azar = copy.deepcopy(self._azar)
+        copia._registros_propios = False
+        return copia
+
+    def _anotar(self, posicion: int, estratos: np.ndarray, codigos: np.ndarray) -> None:
+        if not self._registros_propios:
+            self.registros = self.registros.copy()
+            self._registros_propios = True
+        registros, rangos = posiciones_hll(codigos)
+        np.maximum.at(self.registros[posicion], (estratos, registros), rangos)
+
+    def _estratos_filas(self, catalogo: Catalogo, filas: np.ndarray) -> np.ndarray:
+        """Estrato de cada fila; las combinaciones nuevas crean estratos vacíos."""
+        claves = [tuple(clave) for clave in np.stack([catalogo.columnas[campo][filas] for campo in self.campos], axis=1).tolist()]
+        nuevas = list(dict.fromkeys(clave for clave in claves if clave not in self._estratos))
+        if nuevas:
+            for estrato, clave in enumerate(nuevas, start=len(self.poblacion)):
+                self._estratos[clave] = estrato
+            self.codigos = np.vstack([self.codigos, np.array(nuevas, dtype=np.int64)])
+            self.poblacion = np.append(self.poblacion, np.zeros(len(nuevas), dtype=np.int64))
+            self.objetivo = np.append(self.objetivo, np.full(len(nuevas), MINIMO_ESTRATO, dtype=np.int64))
+            vacios = np.zeros((len(CAMPOS_TEXTO), len(nuevas), 1 << BITS_HLL), dtype=np.uint8)
+            self.registros = np.concatenate([self.registros, vacios], axis=1)
+            self._registros_propios = True
+        return np.array([self._estratos[clave] for clave in claves], dtype=np.int64)
+
+    def agregar_filas(self, catalogo: Catalogo, filas: np.ndarray) -> None:
+        """Incorpora filas añadidas al final del catálogo.
+
+        En cada estrato afectado la muestra pasa a ser las filas con los menores
+        números aleatorios entre las que ya tenía y las nuevas, lo mismo que
+        incorporándolas de una en una.
+        """
+        estratos = self._estratos_filas(catalogo, filas)
+        np.add.at(self.poblacion, estratos, 1)
+        for posicion, campo in enumerate(CAMPOS_TEXTO):
+            self._anotar(posicion, estratos, catalogo.columnas[campo][filas])
+        azar = self._azar.random(len(filas))
+        afectados = np.zeros(len(self.poblacion), dtype=bool)
+        afectados[estratos] = True
+        previas = np.flatnonzero(afectados[self.estratos])
+        estratos_candidatas = np.concatenate([self.estratos[previas], estratos])
+        orden = np.lexsort((np.concatenate([self.azar[previas], azar]), estratos_candidatas))
+        ordenados = estratos_candidatas[orden]
+        rangos = np.arange(len(orden)) - np.searchsorted(ordenados, ordenados)
+        elegidas = np.zeros(len(orden), dtype=bool)
+        elegidas[orden] = rangos < self.objetivo[ordenados]
+        conservar = ~afectados[self.estratos]
+        conservar[previas[elegidas[: len(previas)]]] = True
+        nuevas = elegidas[len(previas):]
+        # Las filas nuevas tienen las posiciones más altas: la muestra sigue ordenada
+        self.filas = np.concatenate([self.filas[conservar], filas[nuevas].astype(np.int64)])
+        self.estratos = np.concatenate([self.estratos[conservar], estratos[nuevas]])
+        self.azar = np.concatenate([self.azar[conservar], azar[nuevas]])
+
+    def quitar_filas(self, catalogo: Catalogo, filas: np.ndarray) -> None:
+        """Descuenta filas borradas y las saca de la muestra."""
+        np.add.at(self.poblacion, self._estratos_filas(catalogo, filas), -1)
+        self.bajas += len(filas)
+        conservar = ~np.isin(self.filas, filas)
+        if not conservar.all():
+            self.filas, self.estratos, self.azar = self.filas[conservar], self.estratos[conservar], self.azar[conservar]
+
+    def vigente(self) -> bool:
+        """Falso si hay tantas bajas que los HyperLogLog o la muestra de algún estrato ya no sirven."""
+        if self.bajas > FRACCION_BAJAS_SINOPSIS * self.filas_iniciales:
+            return False
+        tamanos = np.bincount(self.estratos, minlength=len(self.poblacion))
+        return not np.any((2 * tamanos < self.objetivo) & (tamanos < self.poblacion))
+
+    def motivo_exacto(self, catalogo: Catalogo, contexto: Dict[str, Any]) -> Optional[str]:
+        """Por qué el plan no se puede estimar con la sinopsis, o ``None`` si se puede."""
+        tipos = {info["type"] for info in contexto["aggregations"].values()}
+        if not tipos:
+            return "la consulta no agrega"
+        if not tipos <= {"count", "sum", "mean", "percentile", "count_distinct"}:
+            return "agregación sin estimador"
+        if "count_distinct" in tipos:
+            # Los HyperLogLog solo se combinan por estratos completos
+            campos = set(contexto["group_by"])
+            campos.update(filtro["field"] for filtro in contexto["filters"] if filtro["field"] in catalogo.columnas)
+            if any(contexto["date_range"]) or not campos <= set(self.campos):
+                return "valores distintos con filtros o grupos que no son estratos completos"
+        return None
+
+    def estimar(self, catalogo: Catalogo, contexto: Dict[str, Any], traza: Traza = TRAZA_NULA) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Filas agrupadas y métricas estimadas de un plan, con sus márgenes de error.
+
+        Los conteos y las sumas se estiman ponderando cada fila de la muestra por
+        la población de su estrato entre su tamaño en la muestra, y las medias
+        como cociente de ambas estimaciones; los márgenes son la mitad del
+        intervalo de confianza del 95 % (varianza del muestreo estratificado sin
+        reposición). Los percentiles se toman de la distribución ponderada y su
+        intervalo sale de desplazar la fracción según el error de su rango. Los
+        valores distintos se estiman uniendo los HyperLogLog de los estratos.
+        """
+        num_estratos = len(self.poblacion)
+        en_muestra = np.bincount(self.estratos, minlength=num_estratos).astype(np.float64)
+        tamanos = np.maximum(en_muestra, 1)
+        pesos_estrato = self.poblacion / tamanos
+        # Varianza por unidad de la suma de cuadrados centrada de cada estrato
+        factores = np.where(
+            en_muestra > 1, self.poblacion ** 2 * (1 - en_muestra / np.maximum(self.poblacion, 1)) / (tamanos * np.maximum(en_muestra - 1, 1)), 0.0
+        )
+        inicio, fin = ordinales_rango(contexto["date_range"])
+        compilados = compilar_filtros(catalogo, contexto["filters"])
+        mascara = mascara_bloque(catalogo.columnas, compilados, inicio, fin, self.filas)
+        filas, estratos = self.filas[mascara], self.estratos[mascara]
+        pesos = pesos_estrato[estratos]
+        traza.contar("filas_muestra", len(filas))
+
+        group_by = contexto["group_by"]
+        if all(campo in catalogo.categorias for campo in group_by):
+            claves_filas = np.zeros(len(filas), dtype=np.int64)
+            for campo in group_by:
+                claves_filas = claves_filas * len(catalogo.categorias[campo]) + catalogo.columnas[campo][filas]
+        else:
+            claves_filas = np.stack([catalogo.columnas[campo][filas] for campo in group_by], axis=1).astype(np.float64)
+        primeras, grupos = numerar_claves(claves_filas)
+        if not group_by:
+            # Sin agrupación hay un único grupo, aunque no quede ninguna fila
+            primeras, grupos = np.zeros(1, dtype=np.intp), np.zeros(len(filas), dtype=np.intp)
+        num_grupos = len(primeras)
+
+        celdas_grupo: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+        def total(z: np.ndarray, grupos: np.ndarray, num_grupos: int) -> Tuple[np.ndarray, np.ndarray]:
+            """Total estimado de ``z`` por grupo y su margen de error."""
+            estimado = np.bincount(grupos, weights=z * pesos, minlength=num_grupos)
+            # Cada fila cae en la celda de su estrato y su grupo. Se numeran una vez por
+            # agrupación: la del plan y la de un solo grupo, iguales si el plan tiene uno
+            if num_grupos not in celdas_grupo:
+                pares, celdas = np.unique(estratos * num_grupos + grupos, return_inverse=True)
+                celdas_grupo[num_grupos] = (celdas.ravel(), pares // num_grupos, pares % num_grupos)
+            celdas, estrato_celda, grupo_celda = celdas_grupo[num_grupos]
+            sumas = np.bincount(celdas, weights=z, minlength=len(estrato_celda))
+            cuadrados = np.bincount(celdas, weights=z * z, minlength=len(estrato_celda))
+            varianza = np.bincount(
+                grupo_celda, weights=factores[estrato_celda] * (cuadrados - sumas ** 2 / tamanos[estrato_celda]), minlength=num_grupos
+            )
+            return estimado, Z_CONFIANZA * np.sqrt(np.maximum(varianza, 0))
+
+        def media(valores: np.ndarray, grupos: np.ndarray, num_grupos: int, conteos: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            sumas, _ = total(valores, grupos, num_grupos)
+            medias = sumas / np.maximum(conteos, 1e-12)
+            _, margenes = total(valores - medias[grupos], grupos, num_grupos)
+            return medias, margenes / np.maximum(conteos, 1e-12)
+
+        def percentil(valores: np.ndarray, grupos: np.ndarray, num_grupos: int, fraccion: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            muestra = np.bincount(grupos, minlength=num_grupos)
+            poblacion = np.bincount(grupos, weights=pesos, minlength=num_grupos)
+            desviacion = Z_CONFIANZA * np.sqrt(fraccion * (1 - fraccion) / np.maximum(muestra, 1) * np.maximum(1 - muestra / np.maximum(poblacion, 1), 0))
+            fracciones = [np.full(num_grupos, fraccion), np.maximum(fraccion - desviacion, 0), np.minimum(fraccion + desviacion, 1)]
+            estimados, bajos, altos = percentiles_ponderados(grupos, valores, pesos, num_grupos, fracciones)
+            return estimados, bajos, altos
+
+        def distintos(campo: str, grupos: np.ndarray, num_grupos: int) -> Tuple[np.ndarray, np.ndarray]:
+            # Pares (grupo, estrato) ordenados por grupo: cada grupo une los registros de sus estratos
+            pares = np.unique(grupos.astype(np.int64) * num_estratos + estratos)
+            unidos = np.zeros((num_grupos, 1 << BITS_HLL), dtype=np.uint8)
+            if len(pares):
+                grupo_par = pares // num_estratos
+                inicios = np.flatnonzero(np.r_[True, grupo_par[1:] != grupo_par[:-1]])
+                registros = self.registros[CAMPOS_TEXTO.index(campo)][pares % num_estratos]
+                unidos[grupo_par[inicios]] = np.maximum.reduceat(registros, inicios, axis=0)
+            estimados = np.where(np.bincount(grupos, minlength=num_grupos) > 0, np.rint(estimar_hll(unidos)), 0)
+            return estimados, Z_CONFIANZA * 1.04 / math.sqrt(1 << BITS_HLL) * estimados
+
+        unico = np.zeros(len(filas), dtype=np.intp)
+        conteos, margenes_conteo = total(np.ones(len(filas)), grupos, num_grupos)
+        conteo_total, margen_conteo_total = total(np.ones(len(filas)), unico, 1) if group_by else (conteos, margenes_conteo)
+        columnas_rows: Dict[str, Any] = {}
+        metrics: Dict[str, Any] = {}
+        margenes: Dict[str, Any] = {}
+        intervalos: Dict[str, Any] = {}
+        for campo, info in contexto["aggregations"].items():
+            alias = info["alias"]
+            if campo == "count":
+                columnas_rows[alias] = (np.rint(conteos).astype(np.int64).tolist(), np.rint(margenes_conteo).astype(np.int64).tolist())
+                metrics[alias] = int(round(conteo_total[0]))
+                margenes[alias] = int(round(margen_conteo_total[0]))
+                continue
+            if info["type"] == "count_distinct":
+                estimados, margenes_grupos = distintos(campo, grupos, num_grupos)
+                estimado_total, margen_total = distintos(campo, unico, 1) if group_by else (estimados, margenes_grupos)
+                columnas_rows[alias] = (estimados.astype(np.int64).tolist(), np.rint(margenes_grupos).astype(np.int64).tolist())
+                metrics[alias] = int(estimado_total[0])
+                margenes[alias] = int(round(margen_total[0]))
+                continue
+            valores = catalogo.columnas[campo][filas] / catalogo.escala(campo)
+            if info["type"] == "sum":
+                sumas, margenes_grupos = total(valores, grupos, num_grupos)
+                suma_total, margen_total = total(valores, unico, 1) if group_by else (sumas, margenes_grupos)
+                columnas_rows[alias] = (sumas.tolist(), margenes_grupos.tolist())
+                metrics[alias] = redondear_importe(suma_total[0])
+                margenes[alias] = redondear_importe(margen_total[0])
+            elif info["type"] == "mean":
+                medias, margenes_grupos = media(valores, grupos, num_grupos, conteos)
+                columnas_rows[alias] = (medias.tolist(), margenes_grupos.tolist())
+                if group_by and num_grupos:
+                    # Como en el cálculo exacto, la métrica es la media de las medias de los grupos
+                    metrics[alias] = redondear_importe(float(np.mean(medias)))
+                    margenes[alias] = redondear_importe(float(np.sqrt(np.sum(margenes_grupos ** 2))) / num_grupos)
+                elif not group_by and len(filas):
+                    metrics[alias] = redondear_importe(medias[0])
+                    margenes[alias] = redondear_importe(margenes_grupos[0])
+            elif info["type"] == "percentile":
+                estimados, bajos, altos = percentil(valores, grupos, num_grupos, info["fraction"])
+                columnas_rows[alias] = (estimados.tolist(), list(zip(bajos.tolist(), altos.tolist())))
+                if len(filas):
+                    estimado_total, bajo_total, alto_total = percentil(valores, unico, 1, info["fraction"]) if group_by else (estimados, bajos, altos)
+                    metrics[alias] = redondear_importe(estimado_total[0])
+                    intervalos[alias] = [redondear_importe(bajo_total[0]), redondear_importe(alto_total[0])]
+
+        rows: List[Dict[str, Any]] = []
+        if group_by and len(filas):
+            representantes = filas[primeras]
+            claves = [[catalogo.decodificar(campo, dato) for dato in catalogo.columnas[campo][representantes].tolist()] for campo in group_by]
+            for posicion, clave in enumerate(zip(*claves)):
+                registro: Dict[str, Any] = dict(zip(group_by, clave))
+                for campo, info in contexto["aggregations"].items():
+                    estimados, errores = columnas_rows[info["alias"]]
+                    if info["type"] in ("count", "count_distinct") or campo == "count":
+                        registro[info["alias"]] = estimados[posicion]
+                        registro[info["alias"] + "_margen"] = errores[posicion]
+                    elif info["type"] == "percentile":
+                        registro[info["alias"]] = redondear_importe(estimados[posicion])
+                        registro[info["alias"] + "_intervalo"] = [redondear_importe(extremo) for extremo in errores[posicion]]
+                    else:
+                        registro[info["alias"]] = redondear_importe(estimados[posicion])
+                        registro[info["alias"] + "_margen"] = redondear_importe(errores[posicion])
+                rows.append(registro)
+        metrics["aproximacion"] = {
+            "metodo": "muestra_estratificada" + ("+hyperloglog" if any(info["type"] == "count_distinct" for info in contexto["aggregations"].values()) else ""),
+            "confianza": 0.95,
+            "filas_muestra": len(filas),
+            "tamano_muestra": len(self.filas),
+            "margenes": margenes,
+        }
+        if intervalos:
+            metrics["aproximacion"]["intervalos"] = intervalos
+        return rows, metrics
+
+
+CANDADO_SINOPSIS = threading.Lock()
+
+
+def sinopsis_vigente(catalogo: Catalogo) -> Sinopsis:
+    """La sinopsis del catálogo; la construye (o la rehace, si ya no sirve) la primera consulta que la pide."""
+    sinopsis = catalogo.sinopsis
+    if sinopsis is None or not sinopsis.vigente():
+        with CANDADO_SINOPSIS:
+            if catalogo.sinopsis is None or not catalogo.sinopsis.vigente():
+                catalogo.sinopsis = Sinopsis(catalogo)
+            sinopsis = catalogo.sinopsis
+    return sinopsis
+
+
+def implica(filtro: Filtro, otro: Filtro) -> bool:
+    """Indica si toda fila que cumple ``filtro`` cumple también ``otro``."""
+    if filtro["field"] != otro["field"]:
+        return False
+    if filtro["type"] == "contains" or otro["type"] == "contains":
+        if filtro["type"] != otro["type"]:
+            return False
+        return normalizar_texto(str(otro["value"])) in normalizar_texto(str(filtro["value"]))
+    valor, limite = filtro["value"], otro["value"]
+    if not isinstance(valor, (int, float)) or not isinstance(limite, (int, float)):
+        return filtro == otro
+    if filtro["type"] == "=":
+        return COMPARADORES[otro["type"]](valor, limite)
+    for estricto, amplio in ((">", ">="), ("<", "<=")):
+        if filtro["type"] in (estricto, amplio) and otro["type"] in (estricto, amplio):
+            if COMPARADORES[estricto](valor, limite):
+                return True
+            return valor == limite and (filtro["type"] == estricto or otro["type"] == amplio)
+    return False
+
+
+def depurar_filtros(filtros: List[Filtro]) -> Tuple[List[Filtro], List[Filtro]]:
+    """Separa los filtros necesarios de los repetidos o implicados por otro.
+
+    De dos filtros equivalentes se queda el primero. Devuelve los necesarios, en
+    su orden, y los descartados.
+    """
+    necesarios, descartados = [], []
+    for posicion, filtro in enumerate(filtros):
+        sobra = any(
+            implica(otro, filtro) and (otra < posicion or not implica(filtro, otro))
+            for otra, otro in enumerate(filtros)
+            if otra != posicion
+        )
+        (descartados if sobra else necesarios).append(filtro)
+    return necesarios, descartados
+
+
+def estimar_selectividad(catalogo: Catalogo, compilado: Tuple[str, str, Any], muestra: np.ndarray) -> float:
+    """Fracción estimada de las filas que cumplen un predicado compilado, medida en la muestra."""
+    if compilado[0] == "valores" or not len(muestra):
+        return 0.5
+    cumplen = np.count_nonzero(evaluar_compilado(compilado, catalogo.columnas[compilado[1]][muestra]))
+    # Que ninguna fila de la muestra lo cumpla no quiere decir que no lo cumpla ninguna
+    return max(cumplen, 0.5) / len(muestra)
+
+
+def describir_predicado(compilado: Tuple[str, str, Any], filtro: Dict[str, Any], selectividad: float) -> Dict[str, Any]:
+    return {**filtro, "operacion": compilado[0], "selectividad": round(selectividad, 4)}
+
+
+class PlanFisico:
+    """Cómo se ejecuta un plan lógico: vía de acceso, predicados en orden y coste estimado.
+
+    ``acceso`` es ``rollup`` (celdas precalculadas), ``indice_fechas`` (filas del
+    rango tomadas del índice ordenado), ``escaneo`` (las columnas enteras, o por
+    bloques hasta ``limite`` filas) o ``paralelo`` (el escaneo repartido entre
+    procesos). ``compilados`` son los predicados en orden de evaluación; con el
+    índice de fechas no incluyen el rango, que ya resuelve el índice.
+    """
+
+    def __init__(self) -> None:
+        self.acceso = "escaneo"
+        self.rango: Tuple[Optional[int], Optional[int]] = (None, None)
+        self.limite: Optional[int] = None
+        self.compilados: List[Tuple[str, str, Any]] = []
+        self.predicados: List[Dict[str, Any]] = []
+        self.descartados: List[Filtro] = []
+        self.filas_leidas = 0
+        self.filas_estimadas = 0
+        # Grupos, filas que se ordenan (percentiles, distintos, top) y memoria intermedia estimados
+        self.grupos_estimados = 0
+        self.filas_ordenadas = 0
+        self.memoria_estimada = 0
+        # Coste estimado (ns) de cada vía de acceso posible
+        self.costes: Dict[str, float] = {}
+        self.rollup: Optional[Rollup] = None
+
+    def describir(self) -> Dict[str, Any]:
+        """Resumen legible del plan para ``explain``."""
+        return {
+            "acceso": self.acceso,
+            "predicados": self.predicados,
+            "filtros_descartados": self.descartados,
+            "limite_filas": self.limite,
+            "filas_leidas_estimadas": self.filas_leidas,
+            "filas_resultado_estimadas": self.filas_estimadas,
+            "grupos_estimados": self.grupos_estimados,
+            "filas_ordenadas_estimadas": self.filas_ordenadas,
+            "memoria_estimada_bytes": self.memoria_estimada,
+            "coste_estimado_ms": round(self.costes[self.acceso] / 1e6, 3),
+            "alternativas_ms": {acceso: round(coste / 1e6, 3) for acceso, coste in self.costes.items()},
+        }
+
+
+def limite_filtrado(contexto: PlanLogico) -> Optional[int]:
+    """Filas filtradas que bastan para responder un plan, o ``None`` si hacen falta todas."""
+    if contexto["group_by"] or contexto["aggregations"] or contexto["order_by"]:
+        return None
+    # Solo se devolverán las primeras filas: no hace falta filtrar el catálogo entero
+    # Una fila de más basta para saber si hace falta un cursor a la página siguiente
+    return LIMITE_FILAS + 1 if contexto["limit"] is None else min(contexto["limit"], LIMITE_FILAS + 1)
+
+
+def planificar(catalogo: Catalogo, contexto: PlanLogico, limite: Optional[int] = None) -> PlanFisico:
+    """Optimizador: decide cómo ejecutar un plan lógico sobre el catálogo.
 
-    if resultado["group_by"] and resultado["limit"] and not resultado["order_by"]:
-        for prioridad in ["beneficio", "pvp", "cantidad_en_stock", "count"]:
-            if prioridad in resultado["aggregations"]:
-                alias = resultado["aggregations"][prioridad]["alias"] if prioridad != "count" else resultado["aggregations"]["count"]["alias"]
-                resultado["order_by"] = {"field": alias, "direction": "desc"}
-                break
+    Quita los filtros repetidos o implicados por otro, estima la selectividad de
+    cada predicado sobre la muestra del catálogo (la del rango de fechas, exacta
+    con el índice) y los ordena para que los baratos y selectivos descarten filas
+    antes. Después compara el coste del rollup, del índice de fechas, del escaneo
+    y del escaneo en paralelo y elige el menor. ``limite`` son las filas filtradas
+    que bastan (véase ``limite_filtrado``).
+    """
+    plan = PlanFisico()
+    plan.limite = limite
+    num_filas = len(catalogo)
+    filtros, plan.descartados = depurar_filtros([filtro for filtro in contexto["filters"] if filtro["field"] in catalogo.columnas])
+    muestra = catalogo.muestra()
+    predicados = []
+    for filtro in filtros:
+        compilado = compilar_filtro(catalogo, filtro)
+        predicados.append((compilado, dict(filtro), estimar_selectividad(catalogo, compilado, muestra)))
+    if catalogo.num_borradas:
+        predicados.append((
+            ("comparar", COLUMNA_BORRADA, ("=", False)),
+            {"field": COLUMNA_BORRADA, "type": "=", "value": False},
+            1 - catalogo.num_borradas / num_filas,
+        ))
+    inicio, fin = plan.rango = ordinales_rango(contexto["date_range"])
+    posiciones = catalogo.posiciones_rango(inicio, fin)
+    de_fechas = []
+    en_rango = num_filas
+    if posiciones is not None:
+        indexadas = max(len(catalogo.fechas_ordenadas), 1)
+        en_rango = posiciones[1] - posiciones[0] + len(catalogo.fechas_pendientes)
+        if inicio:
+            de_fechas.append((("comparar", "fechacompra", (">=", inicio)), {"field": "fechacompra", "type": ">=", "value": fecha_iso(inicio)}, 1 - posiciones[0] / indexadas))
+        if fin:
+            de_fechas.append((("comparar", "fechacompra", ("<=", fin)), {"field": "fechacompra", "type": "<=", "value": fecha_iso(fin)}, posiciones[1] / indexadas))
 
-    if not resultado["filters"] and not resultado["aggregations"] and not resultado["group_by"]:
-        resultado["order_by"] = {"field": "beneficio", "direction": "desc"}
-        resultado["limit"] = 10
-        resultado["assumed_default"] = True
+    def ordenar(lista: List[Tuple[Tuple[str, str, Any], Dict[str, Any], float]]) -> List[Tuple[Tuple[str, str, Any], Dict[str, Any], float]]:
+        # Primero lo que más filas descarta por cada nanosegundo gastado
+        return sorted(lista, key=lambda predicado: COSTES_PREDICADO[predicado[0][0]] / max(1 - predicado[2], 1e-9))
 
-    return resultado
+    def coste_predicados(lista: List[Tuple[Tuple[str, str, Any], Dict[str, Any], float]], filas: float, disperso: bool) -> Tuple[float, float]:
+        coste, fraccion = 0.0, 1.0
+        for compilado, _, selectividad in lista:
+            if disperso or fraccion < FRACCION_EVALUACION_DISPERSA:
+                coste += filas * fraccion * (COSTES_PREDICADO[compilado[0]] + COSTE_LECTURA_DISPERSA)
+            else:
+                coste += filas * COSTES_PREDICADO[compilado[0]]
+            fraccion *= selectividad
+        return coste, fraccion
 
+    por_coste = 0.0
+    if contexto["group_by"]:
+        por_coste += COSTE_AGRUPAR
+    por_coste += COSTE_AGREGAR * sum(campo != "count" for campo in contexto["aggregations"])
+    por_coste += COSTE_ORDENAR * sum(info["type"] in ("percentile", "count_distinct") for info in contexto["aggregations"].values())
 
-def aplicar_filtros(filas: List[Dict[str, Any]], filtros: List[Dict[str, Any]], rango_fechas: List[Optional[str]]) -> List[Dict[str, Any]]:
-    resultado = []
-    inicio = datetime.date.fromisoformat(rango_fechas[0]) if rango_fechas[0] else None
-    fin = datetime.date.fromisoformat(rango_fechas[1]) if rango_fechas[1] else None
+    escaneo = ordenar(de_fechas + predicados)
+    coste, fraccion = coste_predicados(escaneo, num_filas, False)
+    coincidentes = fraccion * num_filas
+    fraccion_total = fraccion
+    leidas = num_filas
+    if limite is not None and coincidentes > limite:
+        # Por bloques: se para al reunir ``limite`` filas
+        leidas = min(num_filas, math.ceil(limite / fraccion / TAMANO_BLOQUE) * TAMANO_BLOQUE)
+        coste *= leidas / num_filas
+    alternativas = {"escaneo": (coste + min(coincidentes, limite or coincidentes) * por_coste, escaneo, leidas)}
+    if limite is None and paralelo_disponible(catalogo):
+        alternativas["paralelo"] = (alternativas["escaneo"][0] / PROCESOS_CONSULTA + COSTE_ARRANQUE_PARALELO, escaneo, num_filas)
+    if posiciones is not None:
+        resto = ordenar(predicados)
+        coste, fraccion = coste_predicados(resto, en_rango, True)
+        coste += en_rango * COSTE_INDICE_FECHAS + min(fraccion * en_rango, limite or num_filas) * por_coste
+        alternativas["indice_fechas"] = (coste, resto, en_rango)
+    plan.rollup = rollup_para_plan(catalogo, contexto)
+    if plan.rollup is not None:
+        # Todas las celdas se comparan con los filtros; solo las que pasan se agregan
+        por_celda = COSTES_PREDICADO["tabla"] * (len(filtros) + 1) + COSTE_CELDA_ROLLUP * fraccion_total
+        alternativas["rollup"] = (plan.rollup.num_celdas * por_celda, [], 0)
 
-    for fila in filas:
-        coincide = True
-        for filtro in filtros:
-            campo = filtro["field"]
-            if campo not in fila:
-                continue
-            valor_fila = fila[campo]
-            tipo_filtro = filtro["type"]
-            valor = filtro["value"]
-            if tipo_filtro == "contains":
-                valor_norm = normalizar_texto(str(valor))
-                fila_norm = normalizar_texto(str(valor_fila))
-                if valor_norm not in fila_norm:
-                    coincide = False
-                    break
-            elif tipo_filtro in {">", ">=", "<", "<=", "="}:
-                try:
-                    valor_num = float(valor_fila)
-                except (TypeError, ValueError):
-                    coincide = False
-                    break
-                if tipo_filtro == ">" and not (valor_num > valor):
-                    coincide = False
-                    break
-                if tipo_filtro == ">=" and not (valor_num >= valor):
-                    coincide = False
-                    break
-                if tipo_filtro == "<" and not (valor_num < valor):
-                    coincide = False
-                    break
-                if tipo_filtro == "<=" and not (valor_num <= valor):
-                    coincide = False
-                    break
-                if tipo_filtro == "=" and not (valor_num == valor):
-                    coincide = False
-                    break
-        if not coincide:
-            continue
-        fecha_compra = datetime.date.fromisoformat(fila["fechacompra"])
-        if inicio and fecha_compra < inicio:
-            continue
-        if fin and fecha_compra > fin:
-            continue
-        resultado.append(fila)
-    return resultado
+    # Orden y límite de las filas sin agrupar (``seleccionar_filas``): si coinciden todas,
+    # salen del orden guardado o se ordena el catálogo; si no, se eligen entre las coincidentes
+    coste_orden = 0.0
+    orden = contexto["order_by"]
+    if orden and not contexto["group_by"] and not contexto["aggregations"] and orden["field"] in catalogo.columnas:
+        cantidad = min(contexto["limit"] or LIMITE_FILAS, LIMITE_FILAS)
+        if coincidentes < num_filas:
+            coste_orden = coincidentes * COSTE_SELECCIONAR * math.log2(max(cantidad, 2))
+        elif not catalogo.orden_guardado(orden["field"], orden["direction"] == "desc", cantidad):
+            coste_orden = num_filas * COSTE_ORDENAR
 
+    plan.costes = {acceso: float(alternativa[0] + coste_orden) for acceso, alternativa in alternativas.items()}
+    plan.acceso = min(plan.costes, key=plan.costes.__getitem__)
+    _, elegidos, plan.filas_leidas = alternativas[plan.acceso]
+    plan.compilados = [compilado for compilado, _, _ in elegidos]
+    plan.predicados = [describir_predicado(*predicado) for predicado in elegidos]
+    plan.filas_estimadas = int(round(coincidentes if limite is None else min(coincidentes, limite)))
+    estimar_recursos(catalogo, contexto, plan)
+    return plan
+
+
+def estimar_recursos(catalogo: Catalogo, contexto: PlanLogico, plan: PlanFisico) -> None:
+    """Completa en ``plan`` los grupos, las filas ordenadas y la memoria intermedia estimados.
+
+    La memoria cuenta los índices filtrados, las claves de grupo de cada fila, los
+    valores que copian los percentiles y los distintos y los acumuladores por grupo.
+    Con el rollup solo cuentan sus celdas.
+    """
+    agregaciones = contexto["aggregations"].values()
+    ordenadas = sum(info["type"] in ("percentile", "count_distinct") for info in agregaciones)
+    filas = plan.filas_estimadas
+    if plan.acceso == "rollup":
+        grupos = min(plan.rollup.num_celdas, math.prod(len(catalogo.categorias[campo]) for campo in contexto["group_by"]))
+        filas = 0
+    elif contexto["group_by"]:
+        cardinalidades = [len(catalogo.categorias.get(campo, ())) or filas for campo in contexto["group_by"]]
+        grupos = min(filas, math.prod(cardinalidades))
+    else:
+        grupos = 1 if contexto["aggregations"] else 0
+    plan.grupos_estimados = int(grupos)
+    if contexto["group_by"]:
+        plan.filas_ordenadas = int(filas * ordenadas + (grupos if contexto["order_by"] else 0))
+    else:
+        plan.filas_ordenadas = int(filas * ordenadas + (filas if contexto["order_by"] else 0))
+    por_fila = 8 + (8 if contexto["group_by"] else 0) + 16 * ordenadas
+    plan.memoria_estimada = int(filas * por_fila + grupos * 8 * (len(contexto["aggregations"]) + len(contexto["group_by"]) + 2))
+
+
+def agrupar_y_agregar(
+    catalogo: Catalogo,
+    indices: np.ndarray,
+    group_by: List[str],
+    agregaciones: Dict[str, Dict[str, Any]],
+    agregados: Optional[Dict[str, Any]] = None,
+    limites: LimitesConsulta = SIN_LIMITES,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    if agregados is None:
+        agregados = calcular_agregados(catalogo, indices, group_by, agregaciones, limites)
+    conteos = agregados["conteos"].tolist()
+    valores = {campo: columna.tolist() for campo, columna in agregados["valores"].items()}
 
-def agrupar_y_agregar(filas: List[Dict[str, Any]], group_by: List[str], agregaciones: Dict[str, Dict[str, str]]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
-    agrupados: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
-    for fila in filas:
-        clave = tuple(fila[campo] for campo in group_by)
-        if clave not in agrupados:
-            agrupados[clave] = {
-                "conteo": 0,
-                "sumas": {},
-            }
-        agrupados[clave]["conteo"] += 1
-        for campo, info in agregaciones.items():
-            if campo == "count":
-                continue
-            if info["type"] == "sum" or info["type"] == "mean":
-                agrupados[clave]["sumas"].setdefault(campo, 0.0)
-                agrupados[clave]["sumas"][campo] += float(fila[campo])
     resultados: List[Dict[str, Any]] = []
-    for clave, datos in agrupados.items():
+    for posicion, clave in enumerate(agregados["claves"]):
         registro = {campo: valor for campo, valor in zip(group_by, clave)}
         if "count" in agregaciones:
-            registro[agregaciones["count"]["alias"]] = datos["conteo"]
+            registro[agregaciones["count"]["alias"]] = conteos[posicion]
         for campo, info in agregaciones.items():
             if campo == "count":
                 continue
             alias = info["alias"]
-            if info["type"] == "sum":
-                valor = round(datos["sumas"].get(campo, 0.0), 2)
-                registro[alias] = float(f"{valor:.2f}")
+            if info["type"] in ("sum", "min", "max"):
+                registro[alias] = redondear_importe(valores[campo][posicion])
             elif info["type"] == "mean":
-                count = datos["conteo"]
-                valor = round(datos["sumas"].get(campo, 0.0) / count, 2) if count else 0.0
-                registro[alias] = float(f"{valor:.2f}")
+                registro[alias] = redondear_importe(valores[campo][posicion] / conteos[posicion])
+            elif info["type"] == "count_distinct":
+                registro[alias] = valores[campo][posicion]
+            elif info["type"] == "percentile":
+                registro[alias] = redondear_importe(valores[campo][posicion])
         resultados.append(registro)
 
     metrics: Dict[str, Any] = {}
     if "count" in agregaciones:
-        metrics[agregaciones["count"]["alias"]] = sum(datos["conteo"] for datos in agrupados.values())
+        metrics[agregaciones["count"]["alias"]] = sum(conteos)
     for campo, info in agregaciones.items():
         if campo == "count":
             continue
         alias = info["alias"]
         if info["type"] == "sum":
-            total = sum(datos["sumas"].get(campo, 0.0) for datos in agrupados.values())
-            metrics[alias] = float(f"{round(total, 2):.2f}")
+            metrics[alias] = redondear_importe(sum(valores[campo]))
         elif info["type"] == "mean":
-            valores = []
-            for datos in agrupados.values():
-                count = datos["conteo"]
-                if count:
-                    valores.append(datos["sumas"].get(campo, 0.0) / count)
-            if valores:
-                metrics[alias] = float(f"{round(statistics.mean(valores), 2):.2f}")
+            medias = [suma / conteo for suma, conteo in zip(valores[campo], conteos)]
+            if medias:
+                metrics[alias] = redondear_importe(statistics.mean(medias))
+        elif info["type"] == "min" and valores[campo]:
+            metrics[alias] = redondear_importe(min(valores[campo]))
+        elif info["type"] == "max" and valores[campo]:
+            metrics[alias] = redondear_importe(max(valores[campo]))
+        elif info["type"] == "count_distinct":
+            metrics[alias] = agregados["totales"][campo]
+        elif info["type"] == "percentile" and conteos:
+            metrics[alias] = redondear_importe(agregados["totales"][campo])
     return resultados, metrics
 
 
-def aplicar_orden_y_limite(rows: List[Dict[str, Any]], orden: Optional[Dict[str, str]], limite: Optional[int]) -> List[Dict[str, Any]]:
-    resultado = rows
-    if orden and rows:
-        campo = orden["field"]
-        direccion = orden["direction"]
-        if campo not in rows[0]:
-            campo_alias = None
-            for value in rows[0].keys():
-                if normalizar_texto(value) == campo:
-                    campo_alias = value
-                    break
-            if campo_alias:
-                campo = campo_alias
-        resultado = sorted(
-            resultado,
-            key=lambda r: r.get(campo, 0),
-            reverse=direccion == "desc",
-        )
-    if limite is not None:
-        resultado = resultado[:limite]
-    return resultado[:50]
+def agregar_sin_grupos(
+    catalogo: Catalogo,
+    indices: np.ndarray,
+    agregaciones: Dict[str, Dict[str, Any]],
+    agregados: Optional[Dict[str, Any]] = None,
+    limites: LimitesConsulta = SIN_LIMITES,
+) -> Dict[str, Any]:
+    """Métricas de una consulta sin ``group_by``: todas las filas filtradas forman un grupo."""
+    if agregados is None:
+        agregados = calcular_agregados(catalogo, indices, [], agregaciones, limites)
+    total_filas = len(indices)
+    metrics: Dict[str, Any] = {}
+    for campo, info in agregaciones.items():
+        valores = agregados["valores"].get(campo)
+        if campo == "count":
+            metrics[info["alias"]] = total_filas
+        elif info["type"] == "sum":
+            metrics[info["alias"]] = redondear_importe(float(valores[0]) if total_filas else 0.0)
+        elif info["type"] == "mean":
+            metrics[info["alias"]] = redondear_importe(float(valores[0]) / total_filas) if total_filas else 0.0
+        elif info["type"] in ("min", "max") and total_filas:
+            metrics[info["alias"]] = redondear_importe(float(valores[0]))
+        elif info["type"] == "count_distinct":
+            metrics[info["alias"]] = agregados["totales"].get(campo, 0)
+        elif info["type"] == "percentile" and total_filas:
+            metrics[info["alias"]] = redondear_importe(float(agregados["totales"][campo]))
+    return metrics
+
+
+def aplicar_orden_y_limite(
+    rows: List[Dict[str, Any]],
+    orden: Optional[Dict[str, str]],
+    limite: Optional[int],
+    maximo: Optional[int] = LIMITE_FILAS,
+) -> List[Dict[str, Any]]:
+    cantidad = limite if maximo is None else maximo if limite is None else min(limite, maximo)
+    if not orden or not rows:
+        return rows[:cantidad]
+    campo = orden["field"]
+    if campo not in rows[0]:
+        campo_alias = None
+        for value in rows[0].keys():
+            if normalizar_texto(value) == campo:
+                campo_alias = value
+                break
+        if campo_alias:
+            campo = campo_alias
+    if cantidad is None:
+        return sorted(rows, key=lambda r: r.get(campo, 0), reverse=orden["direction"] == "desc")
+    # nlargest/nsmallest equivalen a sorted(...)[:n], incluido el orden de los empates
+    seleccionar = heapq.nlargest if orden["direction"] == "desc" else heapq.nsmallest
+    return seleccionar(cantidad, rows, key=lambda r: r.get(campo, 0))
+
+
+def top_estable(claves: np.ndarray, cantidad: int, descendente: bool) -> np.ndarray:
+    """Posiciones de las ``cantidad`` mejores claves, con los empates en su orden original.
+
+    Selecciona con ``np.partition`` en O(n) y solo ordena las posiciones elegidas.
+    """
+    if descendente:
+        claves = -claves
+    if cantidad < len(claves):
+        umbral = np.partition(claves, cantidad - 1)[cantidad - 1]
+        mejores = np.flatnonzero(claves < umbral)
+        empatadas = np.flatnonzero(claves == umbral)[:cantidad - len(mejores)]
+        posiciones = np.union1d(mejores, empatadas)
+    else:
+        posiciones = np.arange(len(claves))
+    return posiciones[np.argsort(claves[posiciones], kind="stable")]
+
+
+def seleccionar_filas(
+    catalogo: Catalogo,
+    indices: np.ndarray,
+    orden: Optional[Dict[str, str]],
+    limite: Optional[int],
+    maximo: Optional[int] = LIMITE_FILAS,
+) -> np.ndarray:
+    """Versión sobre índices de ``aplicar_orden_y_limite`` para filas sin agrupar."""
+    cantidad = limite if maximo is None else maximo if limite is None else min(limite, maximo)
+    if cantidad is None:
+        cantidad = len(indices)
+    if not orden or not len(indices) or orden["field"] not in catalogo.columnas or cantidad <= 0:
+        return indices[:cantidad]
+    campo = orden["field"]
+    descendente = orden["direction"] == "desc"
+    if len(indices) == len(catalogo):
+        return catalogo.mejores_filas(campo, descendente, cantidad)
+    claves = catalogo.claves_orden(campo, indices)
+    return indices[top_estable(claves, cantidad, descendente)]
 
 
 def construir_summary(contexto: Dict[str, Any], filtros: List[Dict[str, Any]], total_filas: int) -> str:
@@ -495,6 +3397,14 @@ def construir_summary(contexto: Dict[str, Any], filtros: List[Dict[str, Any]], t
                 descripciones.append(f"suma de {campo}")
             elif info["type"] == "mean":
                 descripciones.append(f"promedio de {campo}")
+            elif info["type"] == "min":
+                descripciones.append(f"mínimo de {campo}")
+            elif info["type"] == "max":
+                descripciones.append(f"máximo de {campo}")
+            elif info["type"] == "count_distinct":
+                descripciones.append(f"valores distintos de {campo}")
+            elif info["type"] == "percentile":
+                descripciones.append(f"mediana de {campo}" if info["fraction"] == 0.5 else f"percentil {round(info['fraction'] * 100)} de {campo}")
         if descripciones:
             partes.append("Se calcularon " + ", ".join(descripciones))
     if contexto["group_by"]:
@@ -516,17 +3426,724 @@ def construir_summary(contexto: Dict[str, Any], filtros: List[Dict[str, Any]], t
     return ". ".join(partes)
 
 
-DATASET = generar_datos()
+def liberar_segmentos(segmentos: List["shared_memory.SharedMemory"]) -> None:
+    # Solo se retira el nombre: la memoria se libera al cerrarse la última proyección
+    for segmento in segmentos:
+        with contextlib.suppress(FileNotFoundError):
+            segmento.unlink()
+
+
+class ColumnasCompartidas:
+    """Columnas de un catálogo accesibles desde los procesos de consulta.
+
+    Las columnas en memoria se copian a segmentos de memoria compartida y el
+    catálogo pasa a usar esas copias, así que no quedan duplicadas. Las columnas
+    abiertas con ``mmap`` de un catálogo columnar se comparten por su fichero.
+    ``descriptor`` solo contiene nombres, tipos y formas y se envía con cada tarea.
+    """
+
+    def __init__(self, catalogo: Catalogo) -> None:
+        from multiprocessing import shared_memory
+
+        self.segmentos: List[shared_memory.SharedMemory] = []
+        self.descriptor: Dict[str, Tuple[Any, ...]] = {}
+        for campo, columna in list(catalogo.columnas.items()):
+            if isinstance(columna, np.memmap) and columna.filename:
+                self.descriptor[campo] = ("fichero", columna.filename, columna.offset, columna.dtype.str, columna.shape)
+                continue
+            segmento = shared_memory.SharedMemory(create=True, size=max(columna.nbytes, 1))
+            compartida = np.ndarray(columna.shape, dtype=columna.dtype, buffer=segmento.buf)
+            compartida[:] = columna
+            catalogo.columnas[campo] = compartida
+            self.segmentos.append(segmento)
+            self.descriptor[campo] = ("memoria", segmento.name, 0, columna.dtype.str, columna.shape)
+        self.columnas = dict(catalogo.columnas)
+        weakref.finalize(self, liberar_segmentos, self.segmentos)
+
+    def vigente(self, catalogo: Catalogo) -> bool:
+        """Indica si el catálogo sigue usando exactamente estas columnas."""
+        return all(catalogo.columnas[campo] is columna for campo, columna in self.columnas.items())
+
+
+# Columnas abiertas en cada proceso de consulta, por su entrada en el descriptor
+COLUMNAS_PROCESO: Dict[Tuple[Any, ...], Tuple[Optional["shared_memory.SharedMemory"], np.ndarray]] = {}
+
+
+def abrir_columnas(descriptor: Dict[str, Tuple[Any, ...]]) -> Dict[str, np.ndarray]:
+    """Abre en el proceso actual las columnas de un descriptor, una sola vez por segmento."""
+    from multiprocessing import shared_memory
+
+    vigentes = set(descriptor.values())
+    for origen in [origen for origen in COLUMNAS_PROCESO if origen not in vigentes]:
+        segmento = COLUMNAS_PROCESO.pop(origen)[0]
+        if segmento is not None:
+            with contextlib.suppress(BufferError):
+                segmento.close()
+    columnas = {}
+    for campo, origen in descriptor.items():
+        if origen not in COLUMNAS_PROCESO:
+            tipo, nombre, desplazamiento, dtype, forma = origen
+            if tipo == "fichero":
+                COLUMNAS_PROCESO[origen] = (None, np.memmap(nombre, dtype=dtype, mode="r", offset=desplazamiento, shape=forma))
+            else:
+                segmento = shared_memory.SharedMemory(name=nombre)
+                COLUMNAS_PROCESO[origen] = (segmento, np.ndarray(forma, dtype=dtype, buffer=segmento.buf))
+        columnas[campo] = COLUMNAS_PROCESO[origen][1]
+    return columnas
+
+
+def procesar_fragmentos(
+    descriptor: Dict[str, Tuple[Any, ...]],
+    fragmentos: List[Tuple[int, int]],
+    compilados: List[Tuple[str, str, Any]],
+    rango: Tuple[Optional[int], Optional[int]],
+    agrupacion: Optional[Tuple[List[str], List[Optional[int]], Dict[str, Dict[str, Any]]]],
+    orden: Optional[Tuple[int, str, bool, Optional[np.ndarray]]],
+) -> List[Dict[str, Any]]:
+    """Tarea de un proceso de consulta: filtra sus fragmentos y calcula los parciales.
+
+    Por fragmento devuelve la máscara de filas empaquetada en bits, los agregados
+    parciales si la consulta agrega y, si ordena filas sin agrupar, sus mejores
+    ``cantidad`` filas con los empates en el orden del catálogo.
+    """
+    columnas = abrir_columnas(descriptor)
+    resultados = []
+    for desde, hasta in fragmentos:
+        mascara = mascara_bloque(columnas, compilados, rango[0], rango[1], slice(desde, hasta))
+        filas = np.flatnonzero(mascara) + desde
+        parcial: Dict[str, Any] = {"mascara": np.packbits(mascara)}
+        if agrupacion is not None:
+            parcial["agregados"] = agregar_fragmento(columnas, filas, *agrupacion)
+        if orden is not None:
+            cantidad, campo, descendente, rangos = orden
+            claves = columnas[campo][filas] if rangos is None else rangos[columnas[campo][filas]]
+            parcial["top"] = filas[top_estable(claves, cantidad, descendente)]
+        resultados.append(parcial)
+    return resultados
+
+
+EJECUTOR_PARALELO: Optional["ProcessPoolExecutor"] = None
+
+CANDADO_PARALELO = threading.Lock()
+
+
+def ejecutor_paralelo() -> "ProcessPoolExecutor":
+    """Grupo de procesos de consulta, creado en el primer uso.
+
+    Se usa ``fork`` porque los procesos tienen que heredar este módulo tal como se
+    cargó (``fastmcp run`` lo importa desde la ruta del fichero, con otro nombre).
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    global EJECUTOR_PARALELO
+    with CANDADO_PARALELO:
+        if EJECUTOR_PARALELO is None:
+            EJECUTOR_PARALELO = ProcessPoolExecutor(PROCESOS_CONSULTA, mp_context=multiprocessing.get_context("fork"))
+        return EJECUTOR_PARALELO
+
+
+def columnas_compartidas(catalogo: Catalogo) -> ColumnasCompartidas:
+    with CANDADO_PARALELO:
+        if catalogo.compartidas is None or not catalogo.compartidas.vigente(catalogo):
+            catalogo.compartidas = ColumnasCompartidas(catalogo)
+        return catalogo.compartidas
+
+
+def paralelo_disponible(catalogo: Catalogo) -> bool:
+    if PROCESOS_CONSULTA <= 1 or len(catalogo) < MINIMO_FILAS_PARALELO:
+        return False
+    import multiprocessing
+
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def ejecutar_en_paralelo(
+    catalogo: Catalogo,
+    contexto: PlanLogico,
+    plan: PlanFisico,
+    traza: Traza = TRAZA_NULA,
+    limites: LimitesConsulta = SIN_LIMITES,
+) -> Tuple[np.ndarray, Optional[Dict[str, Any]], Optional[np.ndarray]]:
+    """Filtra y agrega el catálogo por fragmentos de filas en el grupo de procesos.
+
+    Devuelve los índices filtrados, los agregados y, si se ordenan filas sin agrupar,
+    las filas seleccionadas. Los parciales se combinan en el orden de los fragmentos
+    igual que en ``calcular_agregados``, así que el resultado es el mismo que en
+    serie. Los predicados (el rango de fechas incluido) son los del plan. Los
+    ``limites`` se comprueban al recibir cada tarea; si se superan, las tareas que
+    aún no han empezado se cancelan.
+    """
+    group_by = contexto["group_by"]
+    agrupacion = None
+    if group_by or contexto["aggregations"]:
+        agrupacion = (group_by, especificacion_grupos(catalogo, group_by), contexto["aggregations"])
+    orden = None
+    if not group_by and contexto["order_by"] and contexto["order_by"]["field"] in catalogo.columnas:
+        campo = contexto["order_by"]["field"]
+        cantidad = LIMITE_FILAS if contexto["limit"] is None else min(contexto["limit"], LIMITE_FILAS)
+        if cantidad > 0:
+            rangos = catalogo.rangos_categorias(campo) if campo in catalogo.categorias else None
+            orden = (cantidad, campo, contexto["order_by"]["direction"] == "desc", rangos)
+
+    num_filas = len(catalogo)
+    fragmentos = [(desde, min(desde + TAMANO_FRAGMENTO, num_filas)) for desde in range(0, num_filas, TAMANO_FRAGMENTO)]
+    # Unas cuantas tareas por proceso para que ninguno se quede esperando al final
+    por_tarea = -(-len(fragmentos) // (2 * PROCESOS_CONSULTA))
+    tareas = [fragmentos[posicion:posicion + por_tarea] for posicion in range(0, len(fragmentos), por_tarea)]
+    descriptor = columnas_compartidas(catalogo).descriptor
+    resultados = ejecutor_paralelo().map(
+        procesar_fragmentos,
+        itertools.repeat(descriptor),
+        tareas,
+        itertools.repeat(plan.compilados),
+        itertools.repeat((None, None)),
+        itertools.repeat(agrupacion),
+        itertools.repeat(orden),
+    )
+    parciales = []
+    try:
+        for lista in resultados:
+            parciales.extend(lista)
+            limites.comprobar(bytes_retenidos(lista))
+    finally:
+        # Cerrar el iterador de ``map`` cancela las tareas pendientes
+        resultados.close()
+    traza.contar("filas_escaneadas", num_filas)
+    traza.contar("fragmentos", len(fragmentos))
+
+    indices = np.concatenate([
+        np.flatnonzero(np.unpackbits(parcial["mascara"], count=hasta - desde)) + desde
+        for parcial, (desde, hasta) in zip(parciales, fragmentos)
+    ])
+    agregados = None
+    if agrupacion is not None:
+        agregados = combinar_parciales([parcial["agregados"] for parcial in parciales], contexto["aggregations"])
+        agregados = decodificar_claves(catalogo, group_by, agregados)
+    seleccion = None
+    if orden is not None:
+        candidatos = np.sort(np.concatenate([parcial["top"] for parcial in parciales]))
+        seleccion = candidatos[top_estable(catalogo.claves_orden(orden[1], candidatos), orden[0], orden[2])]
+    return indices, agregados, seleccion
+
+
+def ejecutar_consulta(
+    catalogo: Catalogo,
+    contexto: PlanLogico,
+    traza: Traza = TRAZA_NULA,
+    indices_filtrados: Optional[np.ndarray] = None,
+    agregados: Optional[Dict[str, Any]] = None,
+    limites: LimitesConsulta = SIN_LIMITES,
+) -> Dict[str, Any]:
+    """Ejecuta un plan ya interpretado sobre el catálogo y construye la respuesta.
+
+    ``indices_filtrados`` y ``agregados`` permiten reutilizar un filtrado o una
+    agregación ya calculados para otra consulta (véase ``ejecutar_lote``). Si no,
+    ``planificar`` elige entre el rollup, el índice de fechas, el escaneo y, con
+    ``CATALOGO_PROCESOS``, el escaneo en paralelo. Si la ejecución supera
+    ``limites`` lanza ``ConsultaCancelada``.
+    """
+    seleccion = None
+    if indices_filtrados is None and agregados is None:
+        with traza.etapa("plan"):
+            plan = planificar(catalogo, contexto, limite_filtrado(contexto))
+        traza.contar(f"plan_{plan.acceso}", 1)
+        if plan.acceso == "rollup":
+            with traza.etapa("aggregate"):
+                agregados = plan.rollup.agregar(catalogo, contexto, traza)
+        else:
+            with traza.etapa("filter"):
+                if plan.acceso == "paralelo":
+                    indices_filtrados, agregados, seleccion = ejecutar_en_paralelo(catalogo, contexto, plan, traza, limites)
+                else:
+                    indices_filtrados = aplicar_filtros(catalogo, plan, traza, limites)
+    if indices_filtrados is None:
+        traza.contar("filas_coincidentes", int(agregados["conteos"].sum()))
+    else:
+        traza.contar("filas_coincidentes", len(indices_filtrados))
+
+    metrics: Dict[str, Any] = {}
+    rows: List[Dict[str, Any]]
+
+    if contexto["group_by"]:
+        with traza.etapa("aggregate"):
+            filas_agrupadas, metrics = agrupar_y_agregar(
+                catalogo, indices_filtrados, contexto["group_by"], contexto["aggregations"], agregados, limites
+            )
+        traza.contar("grupos", len(filas_agrupadas))
+        total_resultado = len(filas_agrupadas)
+        with traza.etapa("order_limit"):
+            rows = aplicar_orden_y_limite(filas_agrupadas, contexto["order_by"], contexto["limit"])
+    else:
+        if contexto["aggregations"]:
+            with traza.etapa("aggregate"):
+                metrics = agregar_sin_grupos(catalogo, indices_filtrados, contexto["aggregations"], agregados, limites)
+        with traza.etapa("order_limit"):
+            if seleccion is None:
+                seleccion = seleccionar_filas(catalogo, indices_filtrados, contexto["order_by"], contexto["limit"])
+            rows = catalogo.filas(seleccion)
+        total_resultado = len(indices_filtrados)
+
+    with traza.etapa("response"):
+        summary = construir_summary(contexto, contexto["filters"], len(rows))
+
+        respuesta = {
+            "summary": summary,
+            "rows": rows[:LIMITE_FILAS],
+            "metrics": metrics,
+            "applied_filters": filtros_aplicados(contexto),
+        }
+        if contexto["limit"] is not None:
+            total_resultado = min(total_resultado, contexto["limit"])
+        if total_resultado > LIMITE_FILAS:
+            respuesta["next_cursor"] = codificar_cursor(firma_plan(catalogo, contexto), contexto, LIMITE_FILAS, LIMITE_FILAS)
+    traza.contar("filas_devueltas", len(respuesta["rows"]))
+    return respuesta
+
+
+def filtros_aplicados(contexto: Dict[str, Any]) -> Dict[str, List[Any]]:
+    applied_filters: Dict[str, List[Any]] = {}
+    for filtro in contexto["filters"]:
+        campo = filtro["field"]
+        descripcion = filtro["value"] if filtro["type"] == "contains" else f"{filtro['type']} {filtro['value']}"
+        applied_filters.setdefault(campo, []).append(descripcion)
+    return applied_filters
+
+
+def ejecutar_aproximada(
+    catalogo: Catalogo,
+    contexto: PlanLogico,
+    traza: Traza = TRAZA_NULA,
+    limites: LimitesConsulta = SIN_LIMITES,
+    exacto_si_barato: bool = True,
+) -> Dict[str, Any]:
+    """Responde un plan con estimaciones de la sinopsis del catálogo, en tiempo que no depende de su tamaño.
+
+    Las filas son solo las agrupadas (sin ``next_cursor``) y cada agregación lleva su
+    margen de error (``<alias>_margen``, o ``<alias>_intervalo`` en los percentiles).
+    Los planes que la sinopsis no puede estimar, o cuyo cálculo exacto estima el
+    optimizador más barato (salvo sin ``exacto_si_barato``, en las consultas
+    degradadas por el control de admisión), se calculan de forma exacta;
+    ``metrics["aproximacion"]`` indica el método y, en su caso, el motivo.
+    """
+    motivo = "la consulta no agrega" if not contexto["aggregations"] else None
+    if motivo is None:
+        with traza.etapa("plan"):
+            sinopsis = sinopsis_vigente(catalogo)
+            motivo = sinopsis.motivo_exacto(catalogo, contexto)
+            # Con el rollup o pocas filas, el cálculo exacto puede costar menos que la estimación
+            plan = planificar(catalogo, contexto, limite_filtrado(contexto))
+            if motivo is None and exacto_si_barato and plan.costes[plan.acceso] <= len(sinopsis.filas) * COSTE_FILA_MUESTRA:
+                motivo = "el cálculo exacto es más barato que la estimación"
+    if motivo is not None:
+        traza.contar("plan_exacto", 1)
+        respuesta = ejecutar_consulta(catalogo, contexto, traza, limites=limites)
+        return dict(respuesta, metrics={**respuesta["metrics"], "aproximacion": {"metodo": "exacto", "motivo": motivo}})
+    traza.contar("plan_aproximado", 1)
+    with traza.etapa("aggregate"):
+        filas_agrupadas, metrics = sinopsis.estimar(catalogo, contexto, traza)
+    traza.contar("grupos", len(filas_agrupadas))
+    with traza.etapa("order_limit"):
+        rows = aplicar_orden_y_limite(filas_agrupadas, contexto["order_by"], contexto["limit"])
+    with traza.etapa("response"):
+        summary = construir_summary(contexto, contexto["filters"], len(rows))
+        respuesta = {
+            "summary": f"{summary}. Estimación con una muestra de {metrics['aproximacion']['tamano_muestra']} filas (intervalos del 95 %)",
+            "rows": rows,
+            "metrics": metrics,
+            "applied_filters": filtros_aplicados(contexto),
+        }
+    traza.contar("filas_devueltas", len(rows))
+    return respuesta
+
+
+def firma_plan(catalogo: Catalogo, contexto: Dict[str, Any]) -> List[int]:
+    """Versiones de los datos de los que depende la respuesta de un plan.
+
+    Sin agrupación la respuesta incluye filas completas y depende de todas las
+    columnas; con agrupación, solo de las que filtra, agrupa o agrega. Así, por
+    ejemplo, cambiar el stock no invalida "beneficio total por marca".
+    """
+    if not contexto["group_by"]:
+        return catalogo.firma(CAMPOS)
+    campos = {filtro["field"] for filtro in contexto["filters"]} | set(contexto["group_by"])
+    campos.update(campo for campo in contexto["aggregations"] if campo != "count")
+    if any(contexto["date_range"]):
+        campos.add("fechacompra")
+    return catalogo.firma(sorted(campos))
+
+
+def codificar_cursor(firma: List[int], contexto: Dict[str, Any], desplazamiento: int, tamano: int) -> str:
+    """Cursor opaco con todo lo necesario para recalcular la página: no guarda estado.
+
+    ``firma`` son las versiones de los datos de los que depende el plan (``firma_plan``).
+    El cursor va firmado con ``CLAVE_CURSORES``, así que el cliente no puede cambiar
+    el plan entre páginas.
+    """
+    datos = {"v": firma, "p": contexto, "o": desplazamiento, "t": tamano}
+    carga = base64.urlsafe_b64encode(json.dumps(datos, ensure_ascii=False, separators=(",", ":")).encode())
+    return f"{carga.decode()}.{firmar_cursor(carga)}"
+
+
+def firmar_cursor(carga: bytes) -> str:
+    return base64.urlsafe_b64encode(hmac.new(CLAVE_CURSORES, carga, hashlib.sha256).digest()[:16]).decode()
+
+
+def decodificar_cursor(cursor: str) -> Tuple[List[int], Dict[str, Any], int, int]:
+    try:
+        carga, firma_cursor = cursor.split(".")
+        if not hmac.compare_digest(firma_cursor, firmar_cursor(carga.encode())):
+            raise ValueError("firma incorrecta")
+        datos = json.loads(base64.urlsafe_b64decode(carga.encode()))
+        firma, contexto, desplazamiento, tamano = [int(version) for version in datos["v"]], datos["p"], datos["o"], datos["t"]
+    except (ValueError, KeyError, TypeError, AttributeError) as error:
+        raise ToolError("Cursor no válido") from error
+    if not plan_valido(contexto) or not es_entero(desplazamiento) or not es_entero(tamano) or desplazamiento < 0 or tamano < 0:
+        raise ToolError("Cursor no válido")
+    return firma, contexto, desplazamiento, tamano
+
+
+def es_entero(valor: Any) -> bool:
+    return isinstance(valor, int) and not isinstance(valor, bool)
 
-mcp = FastMCP("catalogo")
+
+def plan_valido(plan: Any) -> bool:
+    """Comprueba que ``plan`` tiene la forma de un ``PlanLogico``: las claves, los tipos y los campos conocidos."""
+    if not isinstance(plan, dict) or set(plan) != set(PlanLogico.__annotations__):
+        return False
+    filtros, rango, agregaciones = plan["filters"], plan["date_range"], plan["aggregations"]
+    if not isinstance(filtros, list) or not all(
+        isinstance(filtro, dict) and set(filtro) == {"field", "type", "value"} and filtro["field"] in CAMPOS
+        and (filtro["type"] in COMPARADORES or filtro["type"] == "contains")
+        for filtro in filtros
+    ):
+        return False
+    if not isinstance(rango, list) or len(rango) != 2 or not all(fecha is None or isinstance(fecha, str) for fecha in rango):
+        return False
+    try:
+        ordinales_rango(rango)
+    except ValueError:
+        return False
+    if not isinstance(agregaciones, dict) or not all(
+        (campo in CAMPOS or campo == "count") and isinstance(info, dict)
+        and info.get("type") in TIPOS_AGREGACION and isinstance(info.get("alias"), str)
+        and (info["type"] != "percentile" or isinstance(info.get("fraction"), (int, float)) and 0 <= info["fraction"] <= 1)
+        for campo, info in agregaciones.items()
+    ):
+        return False
+    if not isinstance(plan["group_by"], list) or not all(campo in CAMPOS for campo in plan["group_by"]):
+        return False
+    orden = plan["order_by"]
+    if orden is not None and not (
+        isinstance(orden, dict) and set(orden) == {"field", "direction"}
+        and isinstance(orden["field"], str) and orden["direction"] in ("asc", "desc")
+    ):
+        return False
+    limite = plan["limit"]
+    return (limite is None or es_entero(limite) and limite >= 0) and isinstance(plan["assumed_default"], bool)
+
+
+def resultado_ordenado(catalogo: Catalogo, contexto: PlanLogico) -> Any:
+    """Resultado completo y ordenado de un plan, sin el tope de ``LIMITE_FILAS``.
+
+    Sin agrupación son índices de filas, que se materializan página a página;
+    con agrupación, la lista de filas agregadas.
+    """
+    plan = planificar(catalogo, contexto)
+    if plan.acceso == "rollup":
+        filas, _ = agrupar_y_agregar(catalogo, None, contexto["group_by"], contexto["aggregations"], plan.rollup.agregar(catalogo, contexto))
+        return aplicar_orden_y_limite(filas, contexto["order_by"], contexto["limit"], maximo=None)
+    indices = aplicar_filtros(catalogo, plan)
+    if contexto["group_by"]:
+        filas, _ = agrupar_y_agregar(catalogo, indices, contexto["group_by"], contexto["aggregations"])
+        return aplicar_orden_y_limite(filas, contexto["order_by"], contexto["limit"], maximo=None)
+    return seleccionar_filas(catalogo, indices, contexto["order_by"], contexto["limit"], maximo=None)
+
+
+class FiltradoCompartido:
+    """Filtra varias consultas sobre un mismo catálogo reutilizando el trabajo común.
+
+    Memoriza los candidatos de cada rango de fechas, la máscara de cada filtro
+    sobre esos candidatos y el resultado de cada combinación completa de filtros.
+    """
+
+    def __init__(self, catalogo: Catalogo) -> None:
+        self.catalogo = catalogo
+        self._rangos: Dict[Tuple[Optional[int], Optional[int]], Tuple[Optional[np.ndarray], Optional[np.ndarray]]] = {}
+        self._mascaras: Dict[Tuple[Optional[int], Optional[int], str], np.ndarray] = {}
+        self._resultados: Dict[str, np.ndarray] = {}
+
+    def filtrar(self, filtros: List[Dict[str, Any]], rango_fechas: List[Optional[str]]) -> Tuple[str, np.ndarray]:
+        """Devuelve la clave del filtrado y los índices de las filas que lo cumplen."""
+        inicio, fin = ordinales_rango(rango_fechas)
+        filtros, _ = depurar_filtros([filtro for filtro in filtros if filtro["field"] in self.catalogo.columnas])
+        clave = json.dumps([inicio, fin, filtros], ensure_ascii=False)
+        if clave in self._resultados:
+            return clave, self._resultados[clave]
+        if (inicio, fin) not in self._rangos:
+            candidatos = self.catalogo.filas_en_rango(inicio, fin)
+            base = compilar_filtros(self.catalogo, [])
+            if candidatos is None:
+                mascara_rango = mascara_bloque(self.catalogo.columnas, base, inicio, fin, slice(None))
+            else:
+                candidatos = candidatos[mascara_bloque(self.catalogo.columnas, base, None, None, candidatos)]
+                mascara_rango = None
+            self._rangos[(inicio, fin)] = (candidatos, mascara_rango)
+        candidatos, mascara_rango = self._rangos[(inicio, fin)]
+        mascara = mascara_rango.copy() if candidatos is None else np.ones(len(candidatos), dtype=bool)
+        for filtro in filtros:
+            clave_filtro = (inicio, fin, json.dumps(filtro, ensure_ascii=False))
+            if clave_filtro not in self._mascaras:
+                self._mascaras[clave_filtro] = mascara_filtro(self.catalogo, filtro, candidatos)
+            mascara &= self._mascaras[clave_filtro]
+        indices = np.flatnonzero(mascara) if candidatos is None else candidatos[mascara]
+        self._resultados[clave] = indices
+        return clave, indices
+
+
+def ejecutar_lote(catalogo: Catalogo, contextos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Ejecuta varios planes compartiendo filtrados y agregaciones.
+
+    Los planes con el mismo filtrado y la misma agrupación se agregan en una sola
+    pasada con la unión de sus agregaciones. Las sumas y las medias comparten los
+    mismos acumulados; si dos planes piden agregaciones incompatibles sobre un
+    campo (otro tipo u otro percentil), el que llega después se agrega por
+    separado. Los planes que cubre el rollup no necesitan filtrado y se
+    responden directamente.
+    """
+    con_rollup = [planificar(catalogo, contexto, limite_filtrado(contexto)).acceso == "rollup" for contexto in contextos]
+    filtrado = FiltradoCompartido(catalogo)
+    filtrados = [
+        ("", None) if rollup else filtrado.filtrar(contexto["filters"], contexto["date_range"])
+        for contexto, rollup in zip(contextos, con_rollup)
+    ]
+
+    uniones: Dict[Tuple[str, Tuple[str, ...]], Dict[str, Dict[str, Any]]] = {}
+    compartidos: List[Optional[Tuple[str, Tuple[str, ...]]]] = []
+    for contexto, (clave_filtro, indices) in zip(contextos, filtrados):
+        if indices is None:
+            compartidos.append(None)
+            continue
+        clave = (clave_filtro, tuple(contexto["group_by"]))
+        union = uniones.setdefault(clave, {})
+        compatible = True
+        for campo, info in contexto["aggregations"].items():
+            previo = union.get(campo)
+            if previo and previo != info and not {previo["type"], info["type"]} <= {"sum", "mean"}:
+                compatible = False
+        if compatible:
+            for campo, info in contexto["aggregations"].items():
+                union.setdefault(campo, info)
+        compartidos.append(clave if compatible else None)
+
+    agregados: Dict[Tuple[str, Tuple[str, ...]], Dict[str, Any]] = {}
+    respuestas = []
+    for contexto, (_, indices), clave in zip(contextos, filtrados, compartidos):
+        if indices is None:
+            respuestas.append(ejecutar_consulta(catalogo, contexto))
+            continue
+        agregado = None
+        if clave is not None and (contexto["group_by"] or contexto["aggregations"]):
+            if clave not in agregados:
+                agregados[clave] = calcular_agregados(catalogo, indices, list(clave[1]), uniones[clave])
+            agregado = agregados[clave]
+        respuestas.append(ejecutar_consulta(catalogo, contexto, indices_filtrados=indices, agregados=agregado))
+    return respuestas
+
+
+class CacheResultados:
+    """Caché LRU con caducidad de resultados de consultas.
+
+    Las entradas se indexan por la firma de los datos de los que depende el plan
+    (``firma_plan``) y el plan canónico, de modo que cualquier cambio en esos datos
+    deja de encontrar los resultados antiguos, que acaban saliendo por antigüedad.
+    Los valores guardados se comparten entre llamadas y no deben modificarse.
+    """
+
+    def __init__(self, max_entradas: int, ttl_segundos: float) -> None:
+        self.max_entradas = max_entradas
+        self.ttl_segundos = ttl_segundos
+        self._entradas: "OrderedDict[Tuple[Tuple[int, ...], str], Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, firma: List[int], clave: str) -> Any:
+        with self._lock:
+            entrada = self._entradas.get((tuple(firma), clave))
+            if entrada is None:
+                return None
+            caduca, respuesta = entrada
+            if caduca < time.monotonic():
+                del self._entradas[(tuple(firma), clave)]
+                return None
+            self._entradas.move_to_end((tuple(firma), clave))
+            return respuesta
+
+    def guardar(self, firma: List[int], clave: str, respuesta: Any) -> None:
+        with self._lock:
+            self._entradas[(tuple(firma), clave)] = (time.monotonic() + self.ttl_segundos, respuesta)
+            self._entradas.move_to_end((tuple(firma), clave))
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def invalidar(self) -> None:
+        with self._lock:
+            self._entradas.clear()
+
+
+class EjecutorConsultas:
+    """Ejecuta las herramientas que leen el catálogo en hilos, fuera del bucle de eventos.
+
+    Así ``fields``, ``schema`` o ``stats`` responden aunque haya recorridos en
+    curso, y NumPy libera el GIL en los recorridos de columnas, de modo que las
+    consultas avanzan a la vez. Como mucho ``simultaneas`` llamadas se ejecutan a
+    la vez y ``en_espera`` esperan turno; las que llegan con la cola llena se
+    rechazan con un error que el cliente puede reintentar. De las consultas que
+    superan el presupuesto solo se ejecutan ``pesadas`` a la vez (véase
+    ``ejecutar_con_admision``).
+    """
+
+    def __init__(self, simultaneas: int, en_espera: int, estadisticas: EstadisticasConsultas, pesadas: int = 1) -> None:
+        self.simultaneas = simultaneas
+        self.en_espera = en_espera
+        self.estadisticas = estadisticas
+        self.en_curso = 0
+        self.pesadas = pesadas
+        self.pesadas_en_curso = 0
+        # Montículo de (coste estimado, llegada, futuro) de las consultas pesadas que esperan turno
+        self.cola_pesadas: List[Tuple[float, int, "asyncio.Future[None]"]] = []
+        self._llegadas = itertools.count()
+        self._hilos: Optional["ThreadPoolExecutor"] = None
+        self._lock = threading.Lock()
+
+    async def ejecutar(self, herramienta: str, funcion: Callable[..., Any], *argumentos: Any) -> Any:
+        async with self._plaza(herramienta):
+            return await self._en_hilo(funcion, *argumentos)
+
+    async def ejecutar_con_admision(
+        self, herramienta: str, admitir: Callable[[], Dict[str, Any]], responder: Callable[[Dict[str, Any]], Any]
+    ) -> Any:
+        """Como ``ejecutar``, pero antes decide con ``admitir`` cómo se ejecuta la llamada.
+
+        ``responder`` recibe la decisión (véase ``admitir_consulta``). Las encoladas
+        esperan turno sin ocupar un hilo hasta que haya menos de ``pesadas`` en
+        curso, y salen de la cola por coste estimado: las más baratas primero.
+        """
+        async with self._plaza(herramienta):
+            admision = await self._en_hilo(admitir)
+            if admision["decision"] != "encolada":
+                return await self._en_hilo(responder, admision)
+            inicio = time.perf_counter()
+            async with self._turno_pesado(admision["coste_estimado_ms"]):
+                admision = dict(admision, espera_ms=round((time.perf_counter() - inicio) * 1000, 3))
+                return await self._en_hilo(responder, admision)
+
+    @contextlib.asynccontextmanager
+    async def _plaza(self, herramienta: str) -> AsyncIterator[None]:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with self._lock:
+            if self.en_curso >= self.simultaneas + self.en_espera:
+                self.estadisticas.registrar_rechazo()
+                raise ToolError(f"Servidor ocupado: {self.en_curso} llamadas en curso; reintenta más tarde")
+            self.en_curso += 1
+            if self._hilos is None:
+                self._hilos = ThreadPoolExecutor(self.simultaneas, thread_name_prefix="consulta")
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.en_curso -= 1
+            if INSTRUMENTACION_ACTIVA:
+                self.estadisticas.registrar_llamada(herramienta, (time.perf_counter() - inicio) * 1000)
+
+    async def _en_hilo(self, funcion: Callable[..., Any], *argumentos: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._hilos, functools.partial(funcion, *argumentos))
+
+    @contextlib.asynccontextmanager
+    async def _turno_pesado(self, coste: float) -> AsyncIterator[None]:
+        with self._lock:
+            turno = None
+            if self.pesadas_en_curso < self.pesadas and not self.cola_pesadas:
+                self.pesadas_en_curso += 1
+            else:
+                turno = asyncio.get_running_loop().create_future()
+                heapq.heappush(self.cola_pesadas, (coste, next(self._llegadas), turno))
+        if turno is not None:
+            try:
+                await turno
+            except asyncio.CancelledError:
+                # Si el turno llegó a concederse, pasa al siguiente
+                if turno.done() and not turno.cancelled():
+                    self._ceder_turno()
+                raise
+        try:
+            yield
+        finally:
+            self._ceder_turno()
+
+    def _ceder_turno(self) -> None:
+        """Pasa el turno de la consulta pesada que termina a la siguiente de la cola, o lo libera."""
+        with self._lock:
+            while self.cola_pesadas:
+                _, _, turno = heapq.heappop(self.cola_pesadas)
+                if not turno.done():
+                    turno.set_result(None)
+                    return
+            self.pesadas_en_curso -= 1
+
+
+def clave_plan(contexto: Dict[str, Any]) -> str:
+    """Forma canónica de un plan para usarla como clave de caché.
+
+    Las fechas relativas ya están resueltas a fechas absolutas en el plan, así que
+    la clave de "últimos 6 meses" cambia sola al cambiar de día.
+    """
+    return json.dumps(contexto, ensure_ascii=False, separators=(",", ":"))
+
+
+# Con CATALOGO_CARGA=perezosa el catálogo se carga con la primera consulta en lugar de al arrancar
+CARGA_EN_SEGUNDO_PLANO = os.environ.get("CATALOGO_CARGA", "fondo") != "perezosa"
+
+DATASET = CargaCatalogo(cargar_catalogo_configurado)
+
+CACHE_RESULTADOS = CacheResultados(TAMANO_CACHE_RESULTADOS, TTL_CACHE_RESULTADOS)
+
+ESTADISTICAS = EstadisticasConsultas()
+
+# Resultados completos ordenados de las consultas que se están paginando
+CACHE_PAGINAS = CacheResultados(TAMANO_CACHE_PAGINAS, TTL_CACHE_RESULTADOS)
+
+EJECUTOR_CONSULTAS = EjecutorConsultas(CONSULTAS_SIMULTANEAS, CONSULTAS_EN_ESPERA, ESTADISTICAS, CONSULTAS_PESADAS)
+
+
+@contextlib.asynccontextmanager
+async def ciclo_servidor(servidor: FastMCP) -> AsyncIterator[Dict[str, Any]]:
+    """Empieza a cargar el catálogo al arrancar el servidor, mientras se negocia el transporte."""
+    import multiprocessing
+
+    if PROCESOS_CONSULTA > 1 and "fork" in multiprocessing.get_all_start_methods():
+        # Los procesos de consulta se crean (con fork) antes de que haya otros hilos en marcha
+        ejecutor_paralelo().submit(int).result()
+    if CARGA_EN_SEGUNDO_PLANO:
+        DATASET.iniciar()
+    yield {}
+
+
+mcp = FastMCP("catalogo", lifespan=ciclo_servidor)
 
 
 @mcp.tool()
 def schema() -> Dict[str, Any]:
     """Devuelve el esquema del dataset con ejemplos."""
-    ejemplo = DATASET[0]
+    # No espera a que se cargue el catálogo: le basta la primera fila de la fuente
+    if DATASET.cargado() is None:
+        ejemplo = primer_registro_configurado()
+    else:
+        with DATASET.lectura() as catalogo:
+            ejemplo = catalogo.filas([0])[0]
     campos = {}
-    for campo, valor in ejemplo.items():
+    for campo, valor in (ejemplo or {}).items():
         campos[campo] = {
             "type": type(valor).__name__,
             "example": valor,
@@ -534,11 +4151,17 @@ def schema() -> Dict[str, Any]:
     return {"schema": campos}
 
 
+def primeras_filas(n: int) -> List[Dict[str, Any]]:
+    with DATASET.lectura() as catalogo:
+        filas = catalogo.filas_vivas()
+        n = max(1, min(int(n), len(filas)))
+        return catalogo.filas(filas[:n])
+
+
 @mcp.tool()
-def sample(n: int = 5) -> List[Dict[str, Any]]:
+async def sample(n: int = 5) -> List[Dict[str, Any]]:
     """Devuelve una muestra de n filas del dataset."""
-    n = max(1, min(int(n), len(DATASET)))
-    return DATASET[:n]
+    return await EJECUTOR_CONSULTAS.ejecutar("sample", primeras_filas, n)
 
 
 @mcp.tool()
@@ -561,51 +4184,372 @@ def fields() -> Dict[str, Any]:
 
 
 @mcp.tool()
-def query_nl(pregunta: str) -> Dict[str, Any]:
-    """Interpreta una consulta en lenguaje natural y devuelve resultados."""
-    contexto = parsear_filtros_y_agregaciones(pregunta)
-    filas_filtradas = aplicar_filtros(DATASET, contexto["filters"], contexto["date_range"])
+async def query_nl(pregunta: str, debug: bool = False, aproximado: bool = False, formato: str = "filas") -> Dict[str, Any]:
+    """Interpreta una consulta en lenguaje natural y devuelve resultados.
 
-    metrics: Dict[str, Any] = {}
-    rows: List[Dict[str, Any]]
+    Con ``debug`` la respuesta incluye una sección con el tiempo de cada etapa y
+    los contadores de filas de la ejecución. Con ``aproximado`` las agregaciones
+    se estiman sobre una muestra del catálogo, con sus márgenes de error. Con
+    ``formato="columnar"`` ``rows`` trae cada columna una vez con sus valores en
+    listas paralelas (véase ``filas_a_columnar``). ``admission`` indica si la
+    consulta se admitió, esperó turno o se degradó a aproximada por su coste.
+    """
+    comprobar_formato(formato)
+    return await EJECUTOR_CONSULTAS.ejecutar_con_admision(
+        "query_nl",
+        functools.partial(admitir_consulta, pregunta, aproximado),
+        functools.partial(responder_consulta, pregunta, debug, aproximado, formato),
+    )
 
-    if contexto["group_by"]:
-        filas_agrupadas, metrics = agrupar_y_agregar(filas_filtradas, contexto["group_by"], contexto["aggregations"])
-        filas_agrupadas = aplicar_orden_y_limite(filas_agrupadas, contexto["order_by"], contexto["limit"])
-        rows = filas_agrupadas
-    else:
-        if contexto["aggregations"]:
-            for campo, info in contexto["aggregations"].items():
-                if campo == "count":
-                    metrics[info["alias"]] = len(filas_filtradas)
-                elif info["type"] == "sum":
-                    total = round(sum(float(fila[campo]) for fila in filas_filtradas), 2)
-                    metrics[info["alias"]] = float(f"{total:.2f}")
-                elif info["type"] == "mean":
-                    valores = [float(fila[campo]) for fila in filas_filtradas]
-                    if valores:
-                        promedio = round(statistics.mean(valores), 2)
-                        metrics[info["alias"]] = float(f"{promedio:.2f}")
-                    else:
-                        metrics[info["alias"]] = 0.0
-        filas_ordenadas = aplicar_orden_y_limite(filas_filtradas, contexto["order_by"], contexto["limit"])
-        rows = filas_ordenadas
 
-    applied_filters = {}
-    for filtro in contexto["filters"]:
-        campo = filtro["field"]
-        descripcion = filtro["value"] if filtro["type"] == "contains" else f"{filtro['type']} {filtro['value']}"
-        applied_filters.setdefault(campo, []).append(descripcion)
+def comprobar_formato(formato: str) -> None:
+    if formato not in FORMATOS_RESPUESTA:
+        raise ToolError(f"Formato no válido: {formato!r}; usa {' o '.join(FORMATOS_RESPUESTA)}")
 
-    summary = construir_summary(contexto, contexto["filters"], len(rows))
 
-    return {
-        "summary": summary,
-        "rows": rows[:50],
-        "metrics": metrics,
-        "applied_filters": applied_filters,
+def codificar_json(datos: Any) -> str:
+    """JSON compacto de una respuesta, con orjson si está instalado."""
+    if orjson is None:
+        return json.dumps(datos, ensure_ascii=False, separators=(",", ":"), default=str)
+    return orjson.dumps(datos, default=str, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+
+def resultado_codificado(datos: Any, estructurado: Dict[str, Any]) -> ToolResult:
+    """Resultado de herramienta con el texto ya codificado, en lugar del serializador genérico de FastMCP."""
+    return ToolResult(content=[TextContent(type="text", text=codificar_json(datos))], structured_content=estructurado)
+
+
+def motivo_no_aproximable(catalogo: Catalogo, contexto: PlanLogico) -> Optional[str]:
+    """Por qué el modo aproximado no puede estimar un plan, o ``None`` si puede."""
+    if not contexto["aggregations"]:
+        return "la consulta no agrega"
+    return sinopsis_vigente(catalogo).motivo_exacto(catalogo, contexto)
+
+
+def admitir_consulta(pregunta: str, aproximado: bool = False) -> Dict[str, Any]:
+    """Control de admisión de ``query_nl``: cómo se ejecuta una consulta según su coste estimado.
+
+    ``decision`` es ``admitida``, ``encolada`` (espera turno entre las consultas
+    pesadas, véase ``EjecutorConsultas``) o ``degradada`` (se responde en modo
+    aproximado), según ``CATALOGO_ADMISION``; con ``rechazar`` la consulta recibe
+    un error. Las que la sinopsis no puede estimar no se degradan, se encolan.
+    Si lo que se excede es la memoria estimada, esperar no sirve: se degradan si
+    se puede y, si no, se rechazan. Las que se cancelaron en una ejecución anterior
+    sobre los mismos datos se degradan sin volver a intentarlo.
+    """
+    with DATASET.lectura() as catalogo:
+        contexto = parsear_filtros_y_agregaciones(pregunta)
+        clave = ("aproximado:" if aproximado else "") + clave_plan(contexto)
+        firma = firma_plan(catalogo, contexto)
+        if CACHE_RESULTADOS.obtener(firma, clave) is not None:
+            return {"decision": "admitida"}
+        plan = planificar(catalogo, contexto, limite_filtrado(contexto))
+        coste, memoria = plan.costes[plan.acceso], plan.memoria_estimada
+        if aproximado and motivo_no_aproximable(catalogo, contexto) is None:
+            # La estimación recorre la muestra, salvo que el cálculo exacto sea más barato
+            muestra = len(sinopsis_vigente(catalogo).filas)
+            coste, memoria = min(coste, muestra * COSTE_FILA_MUESTRA), min(memoria, muestra * 16)
+        admision = {
+            "decision": "admitida",
+            "coste_estimado_ms": round(coste / 1e6, 3),
+            "memoria_estimada_mb": round(memoria / 2 ** 20, 3),
+        }
+        cancelacion = None if aproximado else CACHE_RESULTADOS.obtener(firma, "cancelada:" + clave)
+        if cancelacion is not None:
+            return dict(admision, decision="degradada", motivo=f"{cancelacion} en una ejecución anterior")
+        excede_coste = bool(PRESUPUESTO_CONSULTA_MS) and coste / 1e6 > PRESUPUESTO_CONSULTA_MS
+        excede_memoria = bool(MEMORIA_MAXIMA_CONSULTA) and memoria > MEMORIA_MAXIMA_CONSULTA
+        if not excede_coste and not excede_memoria:
+            return admision
+        if excede_memoria:
+            motivo = f"memoria estimada por encima del límite de {MEMORIA_MAXIMA_CONSULTA // 2 ** 20} MB"
+        else:
+            motivo = f"coste estimado por encima del presupuesto de {PRESUPUESTO_CONSULTA_MS:.0f} ms"
+        if POLITICA_ADMISION != "rechazar" and (excede_memoria or POLITICA_ADMISION == "degradar"):
+            if not aproximado and motivo_no_aproximable(catalogo, contexto) is None:
+                return dict(admision, decision="degradada", motivo=motivo)
+        if POLITICA_ADMISION == "rechazar" or excede_memoria:
+            ESTADISTICAS.registrar_admision("rechazada")
+            raise ToolError(
+                f"Consulta rechazada: {motivo} (unos {admision['coste_estimado_ms']:.0f} ms y "
+                f"{admision['memoria_estimada_mb']:.0f} MB); acota los filtros o usa aproximado=True"
+            )
+        return dict(admision, decision="encolada", motivo=motivo)
+
+
+def responder_consulta(
+    pregunta: str, debug: bool = False, aproximado: bool = False, formato: str = "filas", admision: Optional[Dict[str, Any]] = None
+) -> Any:
+    """Respuesta de ``query_nl``, leída de una sola instantánea del catálogo.
+
+    ``admision`` es la decisión de ``admitir_consulta``. La ejecución se corta al
+    pasar de ``CATALOGO_TIEMPO_MAXIMO_MS`` o ``CATALOGO_MEMORIA_MAXIMA_MB``; entonces
+    se responde en modo aproximado si se puede y, si no, con un error. En formato
+    columnar se devuelve ya codificada (``resultado_codificado``).
+    """
+    with DATASET.lectura() as catalogo:
+        admision = admision or {"decision": "admitida"}
+        aproximada = aproximado or admision["decision"] == "degradada"
+        traza = Traza() if debug or INSTRUMENTACION_ACTIVA else TRAZA_NULA
+        with traza.etapa("parse"):
+            contexto = parsear_filtros_y_agregaciones(pregunta)
+            # Las degradadas siempre estiman; las aproximadas pedidas calculan el exacto si es barato
+            clave = ("aproximado:" if aproximado else "degradada:" if aproximada else "") + clave_plan(contexto)
+        firma = firma_plan(catalogo, contexto)
+        respuesta = CACHE_RESULTADOS.obtener(firma, clave)
+        acierto_cache = respuesta is not None
+        if respuesta is None:
+            limites = LimitesConsulta(TIEMPO_MAXIMO_CONSULTA_MS, MEMORIA_MAXIMA_CONSULTA)
+            try:
+                if aproximada:
+                    respuesta = ejecutar_aproximada(catalogo, contexto, traza, limites, exacto_si_barato=aproximado)
+                else:
+                    respuesta = ejecutar_consulta(catalogo, contexto, traza, limites=limites)
+            except ConsultaCancelada as cancelacion:
+                if aproximada or motivo_no_aproximable(catalogo, contexto) is not None:
+                    ESTADISTICAS.registrar_admision("cancelada")
+                    raise ToolError(f"Consulta cancelada: {cancelacion}; acota los filtros") from cancelacion
+                traza.contar("plan_cancelado", 1)
+                admision = dict(admision, decision="degradada", motivo=str(cancelacion))
+                # Las repeticiones sobre los mismos datos se degradan ya al admitirlas (``admitir_consulta``)
+                CACHE_RESULTADOS.guardar(firma, "cancelada:" + clave, str(cancelacion))
+                clave = "degradada:" + clave_plan(contexto)
+                respuesta = ejecutar_aproximada(catalogo, contexto, traza, exacto_si_barato=False)
+            CACHE_RESULTADOS.guardar(firma, clave, respuesta)
+        ESTADISTICAS.registrar_admision(admision["decision"])
+        if traza.activa:
+            ESTADISTICAS.registrar(traza, acierto_cache)
+        respuesta = dict(respuesta, admission=admision)
+        if debug:
+            respuesta["debug"] = {"cache": "hit" if acierto_cache else "miss", **traza.resumen()}
+        if formato == "columnar":
+            respuesta["rows"] = filas_a_columnar(respuesta["rows"])
+            return resultado_codificado(respuesta, respuesta)
+        return respuesta
+
+
+@mcp.tool()
+async def query_nl_batch(preguntas: List[str], formato: str = "filas") -> List[Dict[str, Any]]:
+    """Responde varias consultas en lenguaje natural en una sola llamada, en el mismo orden.
+
+    Las consultas que comparten filtros, rangos de fechas o agrupaciones reutilizan
+    el mismo recorrido del catálogo. ``formato`` es el de ``query_nl``.
+    """
+    comprobar_formato(formato)
+    return await EJECUTOR_CONSULTAS.ejecutar("query_nl_batch", responder_lote, preguntas, formato)
+
+
+def responder_lote(preguntas: List[str], formato: str = "filas") -> Any:
+    with DATASET.lectura() as catalogo:
+        contextos = [parsear_filtros_y_agregaciones(pregunta) for pregunta in preguntas]
+        claves = [clave_plan(contexto) for contexto in contextos]
+        firmas = {clave: firma_plan(catalogo, contexto) for clave, contexto in zip(claves, contextos)}
+        respuestas: Dict[str, Dict[str, Any]] = {}
+        pendientes: Dict[str, Dict[str, Any]] = {}
+        for clave, contexto in zip(claves, contextos):
+            if clave in respuestas or clave in pendientes:
+                continue
+            respuesta = CACHE_RESULTADOS.obtener(firmas[clave], clave)
+            if respuesta is None:
+                pendientes[clave] = contexto
+            else:
+                respuestas[clave] = respuesta
+        for clave, respuesta in zip(pendientes, ejecutar_lote(catalogo, list(pendientes.values()))):
+            CACHE_RESULTADOS.guardar(firmas[clave], clave, respuesta)
+            respuestas[clave] = respuesta
+        if formato == "columnar":
+            columnares = {clave: dict(respuesta, rows=filas_a_columnar(respuesta["rows"])) for clave, respuesta in respuestas.items()}
+            lista = [columnares[clave] for clave in claves]
+            return resultado_codificado(lista, {"result": lista})
+        return [respuestas[clave] for clave in claves]
+
+
+@mcp.tool()
+async def query_page(cursor: str, tamano: int = 0, formato: str = "filas") -> Dict[str, Any]:
+    """Devuelve la página de resultados a la que apunta un cursor de query_nl o query_page.
+
+    ``tamano`` cambia el número de filas por página (hasta 1000, o 10000 en formato
+    columnar); con 0 se mantiene el del cursor. La respuesta incluye ``next_cursor``
+    mientras queden filas. ``formato`` es el de ``query_nl``.
+    """
+    comprobar_formato(formato)
+    return await EJECUTOR_CONSULTAS.ejecutar("query_page", responder_pagina, cursor, tamano, formato)
+
+
+def responder_pagina(cursor: str, tamano: int = 0, formato: str = "filas") -> Any:
+    with DATASET.lectura() as catalogo:
+        firma, contexto, desplazamiento, tamano_cursor = decodificar_cursor(cursor)
+        if firma != firma_plan(catalogo, contexto):
+            raise ToolError("El catálogo ha cambiado desde que se creó el cursor; repite la consulta")
+        maximo = TAMANO_MAXIMO_PAGINA_COLUMNAR if formato == "columnar" else TAMANO_MAXIMO_PAGINA
+        tamano = max(1, min(int(tamano) or tamano_cursor, maximo))
+        clave = clave_plan(contexto)
+        resultado = CACHE_PAGINAS.obtener(firma, clave)
+        if resultado is None:
+            resultado = resultado_ordenado(catalogo, contexto)
+            CACHE_PAGINAS.guardar(firma, clave, resultado)
+        pagina = resultado[desplazamiento:desplazamiento + tamano]
+        if formato == "columnar":
+            rows = filas_a_columnar(list(pagina)) if contexto["group_by"] else catalogo.filas_columnar(pagina)
+        else:
+            rows = list(pagina) if contexto["group_by"] else catalogo.filas(pagina)
+        respuesta = {
+            "rows": rows,
+            "offset": desplazamiento,
+            "total_rows": len(resultado),
+        }
+        if desplazamiento + tamano < len(resultado):
+            respuesta["next_cursor"] = codificar_cursor(firma, contexto, desplazamiento + tamano, tamano)
+        if formato == "columnar":
+            return resultado_codificado(respuesta, respuesta)
+        return respuesta
+
+
+@mcp.tool()
+async def explain(pregunta: str) -> Dict[str, Any]:
+    """Muestra cómo se respondería una consulta en lenguaje natural, sin ejecutarla.
+
+    ``plan_logico`` es la interpretación de la pregunta y ``plan_fisico`` la vía de
+    acceso elegida, los predicados en orden de evaluación con su selectividad
+    estimada, los filtros descartados por redundantes y el coste estimado de cada
+    alternativa.
+    """
+    return await EJECUTOR_CONSULTAS.ejecutar("explain", explicar_consulta, pregunta)
+
+
+def explicar_consulta(pregunta: str) -> Dict[str, Any]:
+    with DATASET.lectura() as catalogo:
+        contexto = parsear_filtros_y_agregaciones(pregunta)
+        plan = planificar(catalogo, contexto, limite_filtrado(contexto))
+        return {"plan_logico": contexto, "plan_fisico": plan.describir()}
+
+
+def validar_fila(catalogo: Catalogo, fila: Any) -> int:
+    try:
+        fila = int(fila)
+    except (TypeError, ValueError) as error:
+        raise ToolError(f"Fila no válida: {fila!r}") from error
+    if not 0 <= fila < len(catalogo) or catalogo.esta_borrada(fila):
+        raise ToolError(f"No existe la fila {fila}")
+    return fila
+
+
+def convertir_valor(campo: str, valor: Any) -> Any:
+    """Valida y convierte el valor de un campo recibido en ``upsert``.
+
+    Los importes y el stock no pueden ser negativos, el stock tiene que ser un
+    entero y ambos tienen que caber en un ``int32`` (los importes, en céntimos),
+    como las columnas donde se guardan; así se rechazan antes de escribir nada del lote.
+    """
+    maximo = np.iinfo(np.int32).max
+    try:
+        if campo == "cantidad_en_stock":
+            if isinstance(valor, (bool, np.bool_)):
+                raise ValueError("no es un entero")
+            convertido: Any = int(valor)
+            if convertido != float(valor) or not 0 <= convertido <= maximo:
+                raise ValueError("fuera de rango")
+            return convertido
+        if campo in CAMPOS_DECIMALES:
+            convertido = float(valor)
+            if not math.isfinite(convertido) or not 0 <= round(convertido * ESCALA_IMPORTES) < maximo:
+                raise ValueError("fuera de rango")
+            return convertido
+        if campo == "fechacompra":
+            ordinal_fecha(str(valor))
+        return str(valor)
+    except (TypeError, ValueError, OverflowError) as error:
+        raise ToolError(f"Valor no válido para {campo}: {valor!r}") from error
+
+
+@mcp.tool()
+async def upsert(registros: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Modifica o añade filas del catálogo en memoria, sin recargarlo.
+
+    Un registro con ``fila`` (posición de la fila en la fuente, desde 0) cambia los
+    campos ``cantidad_en_stock``, ``pvp`` y ``compra`` que incluya. Sin ``fila`` es
+    una compra nueva con todos los campos; ``fechacompra`` es hoy si no se indica.
+    ``beneficio`` siempre se calcula a partir de ``pvp`` y ``compra``. Las consultas
+    en curso no ven el cambio; las siguientes lo ven completo.
+    """
+    return await EJECUTOR_CONSULTAS.ejecutar("upsert", modificar_registros, registros)
+
+
+def modificar_registros(registros: List[Dict[str, Any]]) -> Dict[str, Any]:
+    with DATASET.escritura() as catalogo:
+        return aplicar_registros(catalogo, registros)
+
+
+def aplicar_registros(catalogo: Catalogo, registros: List[Dict[str, Any]]) -> Dict[str, Any]:
+    cambios: List[Tuple[int, Dict[str, Any]]] = []
+    altas: List[Dict[str, Any]] = []
+    for registro in registros:
+        registro = dict(registro)
+        if "fila" in registro:
+            fila = validar_fila(catalogo, registro.pop("fila"))
+            no_actualizables = sorted(set(registro) - set(CAMPOS_ACTUALIZABLES))
+            if no_actualizables:
+                raise ToolError(f"Solo se pueden modificar {', '.join(CAMPOS_ACTUALIZABLES)}; no {', '.join(no_actualizables)}")
+            cambios.append((fila, {campo: convertir_valor(campo, valor) for campo, valor in registro.items()}))
+            continue
+        registro.setdefault("fechacompra", datetime.date.today().isoformat())
+        registro.pop("beneficio", None)
+        desconocidos = sorted(set(registro) - set(CAMPOS))
+        faltan = [campo for campo in CAMPOS if campo != "beneficio" and campo not in registro]
+        if desconocidos or faltan:
+            raise ToolError(f"Registro nuevo no válido: faltan {faltan}, sobran {desconocidos}")
+        alta = {campo: convertir_valor(campo, valor) for campo, valor in registro.items()}
+        alta["beneficio"] = calcular_beneficio(alta["pvp"], alta["compra"])
+        altas.append(alta)
+    if cambios:
+        catalogo.actualizar_filas(cambios)
+    nuevas = catalogo.agregar_registros(altas) if altas else []
+    return {"actualizadas": len(cambios), "filas_nuevas": nuevas}
+
+
+@mcp.tool()
+async def delete(filas: List[int]) -> Dict[str, Any]:
+    """Borra filas del catálogo por su posición; las posiciones de las demás no cambian."""
+    return await EJECUTOR_CONSULTAS.ejecutar("delete", borrar_registros, filas)
+
+
+def borrar_registros(filas: List[int]) -> Dict[str, Any]:
+    with DATASET.escritura() as catalogo:
+        filas = [validar_fila(catalogo, fila) for fila in filas]
+        return {"borradas": catalogo.borrar_filas(filas) if filas else 0}
+
+
+@mcp.tool()
+def stats(reiniciar: bool = False) -> Dict[str, Any]:
+    """Devuelve histogramas de latencia por etapa y contadores acumulados de query_nl.
+
+    ``herramientas`` tiene la latencia de cada herramienta que lee el catálogo,
+    incluida la espera de turno, ``rechazadas`` las llamadas que no cupieron y
+    ``admision`` cuántas consultas se admitieron, encolaron, degradaron o rechazaron.
+    """
+    resumen = ESTADISTICAS.resumen()
+    resumen["instrumentacion_activa"] = INSTRUMENTACION_ACTIVA
+    resumen["concurrencia"] = {
+        "en_curso": EJECUTOR_CONSULTAS.en_curso,
+        "simultaneas": EJECUTOR_CONSULTAS.simultaneas,
+        "en_espera": EJECUTOR_CONSULTAS.en_espera,
+        "pesadas": EJECUTOR_CONSULTAS.pesadas,
+        "pesadas_en_curso": EJECUTOR_CONSULTAS.pesadas_en_curso,
+        "pesadas_en_cola": len(EJECUTOR_CONSULTAS.cola_pesadas),
     }
+    if reiniciar:
+        ESTADISTICAS.reiniciar()
+    return resumen
 
 
 if __name__ == "__main__":
-    mcp.run()
+    if len(sys.argv) == 4 and sys.argv[1] == "exportar":
+        guardar_columnar(cargar_catalogo(sys.argv[2]), sys.argv[3])
+    elif len(sys.argv) in (4, 5) and sys.argv[1] == "generar":
+        semilla = int(sys.argv[4]) if len(sys.argv) == 5 else SEMILLA_SINTETICA
+        escribir_sintetico(sys.argv[3], int(sys.argv[2]), semilla, max(PROCESOS_CONSULTA, 1))
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "http":
+        puerto = int(sys.argv[2]) if len(sys.argv) == 3 else 8000
+        mcp.run(transport="http", host=os.environ.get("CATALOGO_HOST", "127.0.0.1"), port=puerto)
+    else:
+        mcp.run()